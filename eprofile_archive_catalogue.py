@@ -0,0 +1,184 @@
+"""
+Catalogue of the E-PROFILE files in the archive, so the concat and ingest code can find archived 5-minute L2
+files and daily files without globbing and stat-ing the archive filesystem.
+
+The catalogue is a local SQLite file holding the path and size of every archived file, keyed on the WIGOS id and
+instrument letter ('0-20000-0-06610_A', see eprofile_station_cache.station_key) and the date from the filename.
+It is built by a bulk scan of the archive:
+
+usage: python eprofile_archive_catalogue.py [-c catalogue file] [-b archive base path] [-v]
+
+and then kept up to date by the ingest scripts as they deposit and remove files. Until it has been built, or if
+the catalogue file can't be used, lookups raise CatalogueUnavailable and callers go to the filesystem instead.
+
+"""
+
+import os
+import sys
+import time
+import getopt
+import sqlite3
+import logging
+
+from eprofile_station_cache import SqliteStore
+from eprofile_filenames import parse_l2_filename
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_BASE_PATH = '/badc/eprofile/data'
+CATALOGUE_FILE = '/datacentre/processing3/eprofile/archive_catalogue.sqlite'
+
+
+class CatalogueUnavailable(Exception):
+    '''
+    the catalogue can't answer the lookup and the filesystem should be used instead
+    '''
+
+
+def parse_archive_name(filename):
+    '''
+    catalogue key of an L2 or daily file
+
+    :param filename: path or basename
+    :return: (key, date as YYYYMMDD, 'single' or 'daily'), None if not an L2 filename
+    '''
+    record = parse_l2_filename(filename)
+    if not record:
+        return None
+    return record.instrument, record.date, 'daily' if record.is_daily else 'single'
+
+
+class ArchiveCatalogue(SqliteStore):
+    '''
+    SQLite catalogue of archived single and daily files
+
+    :param cache_file: SQLite file, '' to always use the filesystem
+    '''
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS archive_file (path TEXT PRIMARY KEY, key TEXT, date TEXT, kind TEXT, '
+              'size INTEGER)',
+              'CREATE INDEX IF NOT EXISTS archive_file_day ON archive_file (key, date, kind)',
+              'CREATE TABLE IF NOT EXISTS catalogue_info (name TEXT PRIMARY KEY, value TEXT)')
+
+    def __init__(self, cache_file=CATALOGUE_FILE):
+        super().__init__(cache_file)
+
+    def _day(self, sample_file):
+        parsed = parse_archive_name(sample_file)
+        if not parsed:
+            raise CatalogueUnavailable(f'{sample_file} is not an L2 filename')
+        return parsed[:2]
+
+    def _query(self, sql, params):
+        conn = self._connection()
+        if conn is None:
+            raise CatalogueUnavailable('no catalogue file')
+        try:
+            if not conn.execute("SELECT value FROM catalogue_info WHERE name = 'built'").fetchall():
+                raise CatalogueUnavailable(f'{self.cache_file} has not been built')
+            return conn.execute(sql, params).fetchall()
+        except sqlite3.Error as ex:
+            raise CatalogueUnavailable(f'{self.cache_file} error: {ex}')
+
+    def single_files(self, sample_file):
+        '''
+        archived 5-minute files for the instrument and day of a file
+
+        :param sample_file: L2 or daily file of the instrument and day
+        :return: list of paths
+        '''
+        key, date = self._day(sample_file)
+        rows = self._query("SELECT path FROM archive_file WHERE key = ? AND date = ? AND kind = 'single'",
+                           (key, date))
+        return [row[0] for row in rows]
+
+    def daily_file(self, sample_file):
+        '''
+        archived daily file for the instrument and day of a file
+
+        :param sample_file: L2 or daily file of the instrument and day
+        :return: path, '' if there is no daily file in the archive
+        '''
+        key, date = self._day(sample_file)
+        rows = self._query("SELECT path FROM archive_file WHERE key = ? AND date = ? AND kind = 'daily'",
+                           (key, date))
+        return rows[0][0] if rows else ''
+
+    def add(self, path, size):
+        '''
+        record a file deposited in the archive
+        '''
+        parsed = parse_archive_name(path)
+        if parsed:
+            self._execute('INSERT OR REPLACE INTO archive_file VALUES (?, ?, ?, ?, ?)', (path, *parsed, size))
+
+    def remove(self, path):
+        '''
+        record a file removed from the archive
+        '''
+        self._execute('DELETE FROM archive_file WHERE path = ?', (path,))
+
+    def remove_many(self, paths):
+        '''
+        record files removed from the archive, in one transaction
+        '''
+        self._execute('DELETE FROM archive_file WHERE path = ?', [(path,) for path in paths], many=True)
+
+    def rebuild(self, base_path=ARCHIVE_BASE_PATH):
+        '''
+        replace the catalogue with a scan of the archive
+
+        :param base_path: top of the archive, holding the single files and the daily_files directory
+        :return: number of files catalogued
+        '''
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(base_path):
+            dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+            for name in file_names:
+                parsed = parse_archive_name(name)
+                if parsed:
+                    path = os.path.join(dir_path, name)
+                    entries.append((path, *parsed, os.stat(path).st_size))
+
+        conn = self._connection()
+        if conn is None:
+            raise CatalogueUnavailable('no catalogue file')
+        with conn:
+            conn.execute('DELETE FROM archive_file')
+            conn.executemany('INSERT OR REPLACE INTO archive_file VALUES (?, ?, ?, ?, ?)', entries)
+            conn.execute("INSERT OR REPLACE INTO catalogue_info VALUES ('built', ?)", (str(time.time()),))
+
+        log.info(f'{len(entries)} archived files catalogued from {base_path}')
+        return len(entries)
+
+
+# shared by the concat and ingest scripts, the file can be set from their stream config
+ARCHIVE_CATALOGUE = ArchiveCatalogue()
+
+
+def main(arg_list):
+
+    try:
+        opts, args = getopt.getopt(arg_list, "c:b:v")
+    except getopt.GetoptError as ex:
+        print(__doc__)
+        raise ex
+
+    base_path = ARCHIVE_BASE_PATH
+    catalogue = ARCHIVE_CATALOGUE
+
+    for opt, argu in opts:
+        if "-c" in opt:
+            catalogue = ArchiveCatalogue(argu)
+        elif "-b" in opt:
+            base_path = argu
+        elif "-v" in opt:
+            logging.basicConfig(level=logging.INFO)
+
+    start = time.perf_counter()
+    n_files = catalogue.rebuild(base_path)
+    print(f'{n_files} files catalogued in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,245 @@
+"""
+Long running, event driven version of eprofile_concat_for_ingest.main.
+
+Rather than listing the whole arrivals area each run, the arrivals directories are watched with Linux inotify and
+each new 5-minute L2 file is added to the daily file it belongs to. Once no new file has arrived for an
+instrument-day for debounce_seconds, that instrument-day alone is concatenated with concat_single_inst. The
+arrivals are still listed every rescan_seconds (and straight away if the kernel's event queue overflows) to pick up
+any files the events missed, and any new directories to watch.
+
+The process, its imports, the station cache and archive catalogue connections and, for jobs > 1, the pool of
+worker processes all stay up between events.
+
+usage: python eprofile_arrivals_watcher.py, with the stream config as for eprofile_concat_for_ingest and options:
+    watch_dirs: comma separated directories to watch as well as those holding arrivals files
+    debounce_seconds: quiet time before an instrument-day is concatenated (default 60)
+    rescan_seconds: time between listings of the arrivals (default 900)
+    run_seconds: stop after this long, 0 to run until killed (default 0)
+
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from contextlib import nullcontext
+
+from eprofile_filenames import parse_l2_filename
+from eprofile_concat_for_ingest import (concat_pool, concat_settings, check_arrivals, plan_concat_tasks,
+                                        run_concat_tasks)
+from stream_config import StreamConfig
+from ingest_lib import Arrivals
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie and length of name of an inotify_event
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify():
+    '''
+    minimal inotify through the C library, for files finished being written into, or moved into, watched
+    directories
+    '''
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'no inotify in the C library')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, directory, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        if directory in self.watches.values():
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'unable to watch {directory}')
+        self.watches[wd] = directory
+
+    def read_events(self, timeout):
+        '''
+        wait up to timeout seconds for events
+
+        :return: list of (path, mask), path '' for a queue overflow
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_IGNORED:
+                # the directory has gone
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            events.append((os.path.join(directory, name) if directory and name else '', mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ArrivalsWatcher():
+    '''
+    concatenates instrument-days as their files arrive
+
+    :param config: StreamConfig
+    '''
+
+    def __init__(self, config):
+        self.log = logging.getLogger(__name__)
+        self.config = config
+        self.arrivals = Arrivals(stream_config=config)
+        self.concat_kwargs, self.jobs, self.metrics_jsonl, self.metrics_prometheus = concat_settings(config)
+        self.debounce = config.getint('debounce_seconds', default=60)
+        self.rescan_interval = config.getint('rescan_seconds', default=900)
+
+        # daily file: (files to concatenate into it, time of the last file to arrive)
+        self.pending = {}
+        self.last_rescan = None
+        self.pool = None
+
+        try:
+            self.inotify = Inotify()
+        except OSError as ex:
+            self.log.warning(f'inotify unavailable, only rescanning every {self.rescan_interval} s: {ex}')
+            self.inotify = None
+
+        if 'watch_dirs' in config.options():
+            for directory in config['watch_dirs'].split(','):
+                self.watch(directory.strip())
+
+    def watch(self, directory):
+        if self.inotify is not None and directory:
+            try:
+                self.inotify.add_watch(directory)
+            except OSError as ex:
+                self.log.warning(ex)
+
+    def add_files(self, file_list, arrived):
+        '''
+        :param file_list: new arrivals
+        :param arrived: time the files arrived
+        '''
+        for filename_out, files in plan_concat_tasks(file_list).items():
+            pending_files, last_arrived = self.pending.get(filename_out, (set(), arrived))
+            pending_files.update(files)
+            self.pending[filename_out] = (pending_files, max(last_arrived, arrived))
+
+    def rescan(self):
+        '''
+        list the arrivals to catch anything the events missed, as settled files, and watch any new directories
+        '''
+        file_list = self.arrivals.arrivals_files()
+        for directory in sorted({os.path.dirname(fn) for fn in file_list}):
+            self.watch(directory)
+        self.add_files(file_list, time.time() - self.debounce)
+        self.last_rescan = time.time()
+        self.log.info(f'rescan found {len(file_list)} arrivals, {len(self.pending)} instrument-days pending')
+
+    def run_ready(self):
+        '''
+        concatenate the instrument-days that have had no new files for the debounce time
+        '''
+        now = time.time()
+        concat_tasks = {}
+        for filename_out, (files, last_arrived) in list(self.pending.items()):
+            if now - last_arrived >= self.debounce:
+                del self.pending[filename_out]
+                files = check_arrivals([fn for fn in sorted(files) if os.path.exists(fn)], self.config)
+                if files:
+                    concat_tasks[filename_out] = files
+
+        if concat_tasks:
+            self.log.info(f'concatenating {len(concat_tasks)} instrument-days')
+            try:
+                run_concat_tasks(concat_tasks, self.concat_kwargs, self.jobs, self.metrics_jsonl,
+                                 self.metrics_prometheus, run_labels={'stream': self.config.name}, pool=self.pool)
+            except RuntimeError as ex:
+                # logged per instrument-day already, and the files are still in the arrivals for the next rescan
+                self.log.error(ex)
+
+    def _timeout(self):
+        # until the next rescan or the next instrument-day is due, whichever is sooner
+        deadlines = [self.last_rescan + self.rescan_interval]
+        deadlines.extend(last_arrived + self.debounce for _, last_arrived in self.pending.values())
+        return max(0., min(deadlines) - time.time())
+
+    def run(self, max_seconds=0):
+        '''
+        :param max_seconds: stop after this long, 0 to run until killed
+        '''
+        stop = time.time() + max_seconds if max_seconds else None
+        with concat_pool(self.jobs) if self.jobs > 1 else nullcontext() as self.pool:
+            while stop is None or time.time() < stop:
+                if self.last_rescan is None or time.time() - self.last_rescan >= self.rescan_interval:
+                    self.rescan()
+
+                timeout = self._timeout()
+                if stop is not None:
+                    timeout = min(timeout, max(0., stop - time.time()))
+
+                if self.inotify is None:
+                    time.sleep(timeout)
+                    events = []
+                else:
+                    events = self.inotify.read_events(timeout)
+
+                arrived = time.time()
+                new_files = []
+                for path, mask in events:
+                    if mask & IN_Q_OVERFLOW:
+                        self.log.warning('inotify queue overflowed, rescanning the arrivals')
+                        self.last_rescan = arrived - self.rescan_interval
+                    elif parse_l2_filename(path):
+                        new_files.append(path)
+                if new_files:
+                    self.add_files(new_files, arrived)
+
+                self.run_ready()
+
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+def main():
+    config = StreamConfig()
+    verbose = config.getint('verbose', default=0)
+    if verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    elif verbose == 2:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    watcher = ArrivalsWatcher(config)
+    watcher.run(config.getint('run_seconds', default=0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Backfill driver for eprofile_contat_backprocessor: back-processes the archived single files of a date range, one
+instrument-day directory at a time, across a pool of worker processes.
+
+The instrument-day directories (alc_base_path/country/station/operator-instrument_id/YYYY/MM/DD) are found by walking
+the archive with eprofile_concat_for_ingest.find_alc_day_dirs, keeping the instruments whose country/station/instrument
+path matches the filter. Each directory is passed to backprocess_dir, which concatenates it and moves the daily file
+on to the arrivals.
+
+Every finished directory is appended to a checkpoint journal (JSON lines) as it completes. Directories journalled as
+done are skipped when the driver is run again, so a killed backfill picks up where it stopped; failed directories
+are tried again. Progress, rate and the estimated time to completion are logged every PROGRESS_INTERVAL seconds.
+
+usage: python eprofile_backfill.py -s YYYYMMDD -e YYYYMMDD [-f filter] [-j jobs] [-c journal] [-E engine] [-v]
+    s: first day
+    e: last day (included), defaults to the first day
+    f: comma separated shell patterns matched against country/station/instrument, e.g. 'switzerland/payerne/*'
+    j: number of worker processes (default 4)
+    c: checkpoint journal (default JOURNAL)
+    E: concatenation engine: xarray (default) or netcdf4
+    v: verbose
+
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import datetime
+import logging
+from concurrent.futures import as_completed
+
+from eprofile_concat_for_ingest import concat_pool, find_alc_day_dirs
+from eprofile_contat_backprocessor import alc_base_path, backprocess_dir
+from eprofile_metrics import append_jsonl
+
+JOURNAL = '/gws/nopw/j04/cedaproc/eprofile_for_ingest/eprofile/backfill_journal.jsonl'
+
+PROGRESS_INTERVAL = 60
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+def read_journal(journal):
+    '''
+    :param journal: checkpoint journal
+    :return: set of the directories journalled as done
+    '''
+    done = set()
+    if not os.path.exists(journal):
+        return done
+
+    with open(journal) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short when the driver was killed
+            if entry.get('status') == DONE:
+                done.add(entry['dir'])
+            else:
+                done.discard(entry.get('dir'))
+    return done
+
+
+def _backfill_day(day_dir, engine):
+    '''
+    back-process one directory in a worker, returning a journal entry rather than raising so one bad day
+    doesn't stop the backfill
+    '''
+    log = logging.getLogger(__name__)
+    start = time.perf_counter()
+    entry = {'dir': day_dir}
+    try:
+        entry['output'] = backprocess_dir(day_dir, engine)
+        entry['status'] = DONE
+    except Exception as ex:
+        log.exception(f'back-processing failed for {day_dir}')
+        entry['status'] = FAILED
+        entry['error'] = f'{type(ex).__name__}: {ex}'
+    entry['seconds'] = round(time.perf_counter() - start, 3)
+    entry['time'] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    return entry
+
+
+def backfill(day_dirs, journal=JOURNAL, jobs=4, engine='xarray'):
+    '''
+    back-process directories across a pool of worker processes, journalling each as it finishes and skipping
+    those already journalled as done
+
+    :param day_dirs: instrument-day directories
+    :param journal: checkpoint journal
+    :param jobs: number of worker processes
+    :param engine: concatenation engine
+    :return: (number done, number failed)
+    '''
+    log = logging.getLogger(__name__)
+
+    already_done = read_journal(journal)
+    to_do = [day_dir for day_dir in day_dirs if day_dir not in already_done]
+    log.info(f'{len(day_dirs)} directories, {len(day_dirs) - len(to_do)} already done, {len(to_do)} to process')
+
+    progress = {DONE: 0, FAILED: 0}
+    start = last_report = time.perf_counter()
+
+    def report():
+        finished = progress[DONE] + progress[FAILED]
+        seconds = time.perf_counter() - start
+        rate = finished / max(seconds, 1e-6)
+        eta = datetime.timedelta(seconds=round((len(to_do) - finished) / rate)) if rate else 'unknown'
+        log.info(f'{finished}/{len(to_do)} directories, {progress[FAILED]} failed, '
+                 f'{rate * 3600:.0f} directories/h, ETA {eta}')
+
+    def finished(entry):
+        nonlocal last_report
+        append_jsonl(journal, [entry])
+        progress[entry['status']] += 1
+        if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.perf_counter()
+            report()
+
+    if jobs > 1:
+        executor = concat_pool(jobs)
+        try:
+            futures = [executor.submit(_backfill_day, day_dir, engine) for day_dir in to_do]
+            for future in as_completed(futures):
+                finished(future.result())
+        finally:
+            # on an interrupt drop the directories not yet started: they aren't journalled, so are run next time
+            executor.shutdown(cancel_futures=True)
+    else:
+        for day_dir in to_do:
+            finished(_backfill_day(day_dir, engine))
+
+    report()
+    return progress[DONE], progress[FAILED]
+
+
+def main(arg_list):
+    try:
+        opts, args = getopt.getopt(arg_list, "vs:e:f:j:c:E:")
+    except getopt.GetoptError as ex:
+        print(__doc__)
+        raise ex
+
+    start_date = end_date = None
+    instrument_filter = ''
+    jobs = 4
+    journal = JOURNAL
+    engine = 'xarray'
+    verbose = 0
+
+    for opt, argu in opts:
+        if opt == '-v':
+            verbose = 1
+        elif opt == '-s':
+            start_date = datetime.datetime.strptime(argu, '%Y%m%d').date()
+        elif opt == '-e':
+            end_date = datetime.datetime.strptime(argu, '%Y%m%d').date()
+        elif opt == '-f':
+            instrument_filter = argu
+        elif opt == '-j':
+            jobs = int(argu)
+        elif opt == '-c':
+            journal = argu
+        elif opt == '-E':
+            engine = argu
+
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    log = logging.getLogger(__name__)
+    # progress is reported even when not verbose
+    log.setLevel(logging.INFO)
+
+    if start_date is None:
+        print(__doc__)
+        sys.exit(2)
+
+    instruments = [pattern.strip() for pattern in instrument_filter.split(',') if pattern.strip()]
+    day_dirs = find_alc_day_dirs(start_date, end_date or start_date, alc_base_path, instruments=instruments)
+    done, failed = backfill(day_dirs, journal, jobs, engine)
+    if failed:
+        log.error(f'{failed} directories failed, see {journal}; run again to retry them')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
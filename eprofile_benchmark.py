@@ -0,0 +1,276 @@
+"""
+Benchmarks for the E-PROFILE concatenation code, run on synthetic L2 files
+
+usage: python eprofile_benchmark.py [-b benchmark] [-n files per day] [-a altitude bins] [-s stations]
+                                    [-e concat engine] [-d working directory]
+
+benchmarks (-b, default engines):
+  engines   xarray and netcdf4 concatenation of a day of files
+  suite     the concat and ingest path for a network of -s stations (default 8): instrument_file_grouper,
+            concat_single_inst on a fresh day, the same day topped up by rewriting and by appending in place,
+            and moveToIngest depositing into a local archive
+  encoding  write time, size and read times of a daily file for each output encoding profile, on a CHM15k and a
+            CL51 day (-a is ignored, each instrument has its own number of altitude bins)
+
+"""
+
+import os
+import sys
+import getopt
+import shutil
+import tempfile
+import datetime
+import logging
+import time
+import numpy as np
+
+from netCDF4 import Dataset
+
+from eprofile_synthetic_l2 import write_l2_day, write_l2_network, INSTRUMENT_LAYOUTS
+
+WIGOS_ID = '0-20000-0-06610'
+BENCH_DATE = datetime.date(2021, 10, 18)
+
+# instrument types used in the encoding benchmark
+BENCH_INSTRUMENTS = ('CHM15k', 'CL51')
+
+
+class BenchStreamOptions(dict):
+    '''
+    stream options for running the ingest code outside a CEDA stream, with the options() lookup of StreamConfig
+    '''
+    def options(self):
+        return list(self.keys())
+
+
+def compare_daily_files(file_a, file_b):
+    '''
+    compare the raw variable data of two daily files
+
+    :return: dict of variable name: True if the bytes are identical. Time variables that differ are
+    reported with the largest difference in milliseconds instead
+    '''
+    result = {}
+    with Dataset(file_a) as ds_a, Dataset(file_b) as ds_b:
+        ds_a.set_auto_maskandscale(False)
+        ds_b.set_auto_maskandscale(False)
+        for name, var in ds_a.variables.items():
+            values_a = var[...]
+            values_b = ds_b.variables[name][...]
+            if values_a.dtype == values_b.dtype and values_a.tobytes() == values_b.tobytes():
+                result[name] = True
+            elif ' since ' in getattr(var, 'units', ''):
+                result[name] = float(np.abs(values_a - values_b).max() * 86400000.)
+            else:
+                result[name] = False
+    return result
+
+
+def bench_concat_engines(work_dir, n_files=288, n_altitude=1024):
+    '''
+    time concat_single_inst with each concatenation engine on a day of new files with no existing daily file
+
+    :return: dict of engine: seconds taken
+    '''
+    from eprofile_concat_for_ingest import concat_single_inst
+
+    source_dir = os.path.join(work_dir, 'arrivals', 'block-03')
+    files = write_l2_day(source_dir, WIGOS_ID, BENCH_DATE, n_files=n_files, n_altitude=n_altitude)
+
+    timings = {}
+    outputs = {}
+    for engine in ('xarray', 'netcdf4'):
+        out_dir = os.path.join(work_dir, engine, 'quarantine', 'block-03')
+        os.makedirs(out_dir, exist_ok=True)
+        filename_out = os.path.join(out_dir, f'L2_{WIGOS_ID}_A{BENCH_DATE:%Y%m%d}.nc')
+
+        start = time.perf_counter()
+        concat_single_inst(list(files), filename_out, engine=engine)
+        timings[engine] = time.perf_counter() - start
+        outputs[engine] = filename_out
+
+    print(f'concat of {n_files} files x {n_altitude} altitude bins:')
+    for engine, seconds in timings.items():
+        size = os.stat(outputs[engine]).st_size / 1e6
+        print(f'  {engine:10s} {seconds:8.2f} s  {size:8.1f} MB')
+    print(f"  speedup: {timings['xarray'] / timings['netcdf4']:.1f}x")
+
+    for name, same in compare_daily_files(outputs['xarray'], outputs['netcdf4']).items():
+        if same is not True:
+            print(f'  {name}: differs ({same} ms)' if same else f'  {name}: differs')
+
+    return timings
+
+
+def time_reads(filename, name='attenuated_backscatter_0'):
+    '''
+    time reads of a (time, altitude) variable of a daily file, each from a freshly opened file
+
+    :return: dict of read: seconds, for a time series at one altitude, one profile and the whole variable
+    '''
+    reads = {'time series': lambda var: var[:, var.shape[1] // 2],
+             'profile': lambda var: var[var.shape[0] // 2, :],
+             'full': lambda var: var[...]}
+
+    timings = {}
+    for read, how in reads.items():
+        with Dataset(filename) as ds:
+            start = time.perf_counter()
+            how(ds.variables[name])
+            timings[read] = time.perf_counter() - start
+    return timings
+
+
+def bench_encoding_profiles(work_dir, n_files=288):
+    '''
+    time writing a daily file with each output encoding profile, and reading back from it, for a day of files
+    from each of BENCH_INSTRUMENTS
+
+    :return: dict of (instrument type, profile): dict of write seconds, size in MB and read seconds
+    '''
+    from eprofile_concat_engines import concat_netcdf4, ENCODING_PROFILES
+
+    results = {}
+    for instrument_type in BENCH_INSTRUMENTS:
+        layout = INSTRUMENT_LAYOUTS[instrument_type]
+        source_dir = os.path.join(work_dir, 'arrivals', instrument_type)
+        files = write_l2_day(source_dir, WIGOS_ID, BENCH_DATE, n_files=n_files, instrument_type=instrument_type,
+                             **layout)
+
+        print(f"{instrument_type}: {n_files} files x {layout['n_altitude']} altitude bins")
+        print(f"  {'profile':16s} {'write s':>8s} {'MB':>8s} {'series ms':>10s} {'profile ms':>10s} {'full ms':>8s}")
+        for profile in ENCODING_PROFILES:
+            filename_out = os.path.join(work_dir, f'{instrument_type}_{profile}.nc')
+
+            start = time.perf_counter()
+            concat_netcdf4(files, filename_out, 'eprofile_benchmark.py', encoding_profile=profile)
+            write_time = time.perf_counter() - start
+
+            size = os.stat(filename_out).st_size / 1e6
+            reads = time_reads(filename_out)
+            results[(instrument_type, profile)] = dict(write=write_time, size=size, **reads)
+            print(f"  {profile:16s} {write_time:8.2f} {size:8.1f} {reads['time series'] * 1e3:10.1f} "
+                  f"{reads['profile'] * 1e3:10.1f} {reads['full'] * 1e3:8.1f}")
+
+    return results
+
+
+def bench_suite(work_dir, n_stations=8, n_files=288, n_altitude=None, engine='netcdf4'):
+    '''
+    time each stage of the concat and ingest path on a synthetic network. Half of the day arrives first and is
+    concatenated fresh, then the second half arrives and is added to the daily files, then the daily files are
+    ingested into an archive under work_dir
+
+    :return: dict of stage: seconds taken
+    '''
+    import eprofile_concat_for_ingest
+    import eprofile_ingester_concat
+    from eprofile_concat_for_ingest import instrument_file_grouper, concat_single_inst, STATION_CACHE
+    from eprofile_ingester_concat import moveToIngest
+    from eprofile_archive_catalogue import ARCHIVE_CATALOGUE
+
+    # keep everything under work_dir
+    archive_dir = os.path.join(work_dir, 'archive')
+    eprofile_concat_for_ingest.alc_base_path = archive_dir
+    eprofile_ingester_concat.ARCHIVE_BASE_PATH = archive_dir
+    STATION_CACHE.cache_file = os.path.join(work_dir, 'station_cache.sqlite')
+    ARCHIVE_CATALOGUE.cache_file = ''
+
+    arrivals_dir = os.path.join(work_dir, 'arrivals', 'block-03')
+    first_half = n_files // 2
+    files = write_l2_network(arrivals_dir, BENCH_DATE, n_stations=n_stations, n_files=first_half,
+                             n_altitude=n_altitude, instrument_types=tuple(INSTRUMENT_LAYOUTS))
+    later_files = write_l2_network(os.path.join(work_dir, 'arrivals', 'block-04'), BENCH_DATE,
+                                   n_stations=n_stations, n_files=n_files - first_half, first_file=first_half,
+                                   n_altitude=n_altitude, instrument_types=tuple(INSTRUMENT_LAYOUTS))
+
+    timings = {}
+
+    def concat_all(grouped, out_dir, **kwargs):
+        os.makedirs(out_dir, exist_ok=True)
+        outputs = []
+        for instrument, days_to_concat in grouped.items():
+            for date, files_to_concat in days_to_concat.items():
+                filename_out = os.path.join(out_dir, ''.join(['L2_', instrument, date, '.nc']))
+                concat_single_inst(list(files_to_concat), filename_out, engine=engine, **kwargs)
+                outputs.append(filename_out)
+        return outputs
+
+    start = time.perf_counter()
+    grouped = instrument_file_grouper(files)
+    timings['instrument_file_grouper'] = time.perf_counter() - start
+    later_grouped = instrument_file_grouper(later_files)
+
+    for mode, append_in_place in (('rewrite', False), ('append', True)):
+        out_dir = os.path.join(work_dir, mode, 'quarantine', 'block-03')
+
+        start = time.perf_counter()
+        concat_all(grouped, out_dir, append_in_place=append_in_place)
+        timings[f'concat fresh ({mode})'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        outputs = concat_all(later_grouped, out_dir, append_in_place=append_in_place)
+        timings[f'concat incremental ({mode})'] = time.perf_counter() - start
+
+    stream_options = BenchStreamOptions(deleterchoice='keep')
+    start = time.perf_counter()
+    for daily_file in outputs:
+        moveToIngest(daily_file, stream_options)
+    timings['moveToIngest (append)'] = time.perf_counter() - start
+
+    print(f'{n_stations} stations x {n_files} files, {engine} engine:')
+    for stage, seconds in timings.items():
+        print(f'  {stage:32s} {seconds:8.2f} s')
+
+    return timings
+
+
+def main(arg_list):
+
+    try:
+        opts, args = getopt.getopt(arg_list, "b:n:a:s:e:d:")
+    except getopt.GetoptError as ex:
+        print(__doc__)
+        raise ex
+
+    benchmark = 'engines'
+    n_files = 288
+    n_altitude = None
+    n_stations = 8
+    engine = 'netcdf4'
+    work_dir = ''
+
+    for opt, argu in opts:
+        if "-b" in opt:
+            benchmark = argu
+        elif "-n" in opt:
+            n_files = int(argu)
+        elif "-a" in opt:
+            n_altitude = int(argu)
+        elif "-s" in opt:
+            n_stations = int(argu)
+        elif "-e" in opt:
+            engine = argu
+        elif "-d" in opt:
+            work_dir = argu
+
+    logging.basicConfig(level=logging.WARNING)
+
+    temp_dir = tempfile.mkdtemp(dir=work_dir or None)
+    try:
+        if benchmark == 'engines':
+            bench_concat_engines(temp_dir, n_files=n_files, n_altitude=n_altitude or 1024)
+        elif benchmark == 'encoding':
+            bench_encoding_profiles(temp_dir, n_files=n_files)
+        elif benchmark == 'suite':
+            bench_suite(temp_dir, n_stations=n_stations, n_files=n_files,
+                        n_altitude=n_altitude, engine=engine)
+        else:
+            print(__doc__)
+            raise ValueError(f'unknown benchmark {benchmark}')
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
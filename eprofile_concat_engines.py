@@ -0,0 +1,685 @@
+"""
+Concatenation engines for E-PROFILE daily files working directly through netCDF4
+
+These sit alongside the xarray based concatenation in the concat scripts and are used where
+the cost of re-reading and rewriting a whole daily file each run can be avoided.
+
+"""
+
+import os
+import fcntl
+import heapq
+import shutil
+import logging
+import numpy as np
+
+from netCDF4 import Dataset, num2date, date2num
+
+from eprofile_provenance import (dataset_attrs, update_provenance, update_comment, HeaderHarvest, MANIFEST_ATTR,
+                                 MANIFEST_PREFIX_ATTR)
+
+# common reference used to compare time stamps held with different units in different files
+TIME_KEY_UNITS = 'milliseconds since 1970-01-01 00:00:00'
+
+# units time is stored with in the daily files
+DAILY_TIME_UNITS = 'days since 1970-01-01 00:00:00.000'
+
+# E-PROFILE L2 files hold 5 minutes of profiles, typically 20 of them 15 seconds apart, 5760 a day
+SLOT_SECONDS = 15
+DAY_MS = 86400000
+
+# ioctl to reflink (clone) a file, from <linux/fs.h>
+FICLONE = 0x40049409
+
+# time steps buffered between writes to the concatenated file, a day of 5 minute profiles
+WRITE_STEPS = 288
+
+# output encodings for the daily files, chosen by name with the encoding_profile stream option.
+# chunk_time: time steps per chunk, chunk_other: largest chunk along the other dimensions (0 for the full length)
+ENCODING_PROFILES = {
+    # netCDF library defaults, as the daily files have always been written
+    'default': None,
+    # no compression, one chunk per variable for a day of profiles
+    'fast-write': {'zlib': False, 'shuffle': False, 'chunk_time': 288, 'chunk_other': 0},
+    # deflate with shuffle, chunks of a day by 256 altitude bins so a time series at a height reads few chunks
+    'archive-compact': {'zlib': True, 'complevel': 5, 'shuffle': True, 'chunk_time': 288, 'chunk_other': 256},
+}
+
+
+def variable_encoding(profile, dimensions, shape, dtype):
+    '''
+    encoding settings for a variable of a daily file under an encoding profile
+
+    :param profile: name in ENCODING_PROFILES, None for 'default'
+    :param dimensions: dimension names of the variable
+    :param shape: shape of the variable in the output file
+    :param dtype: numpy dtype of the variable
+    :return: dict of zlib, complevel, shuffle and chunksizes for netCDF4 createVariable (also valid as xarray
+             encoding), {} for the library defaults
+    '''
+    if (profile or 'default') not in ENCODING_PROFILES:
+        raise ValueError(f"unknown encoding profile {profile}, choose from {', '.join(ENCODING_PROFILES)}")
+
+    settings = ENCODING_PROFILES[profile or 'default']
+    if not settings or not dimensions or np.dtype(dtype).kind not in 'biuf':
+        return {}
+
+    chunks = []
+    for dim, size in zip(dimensions, shape):
+        limit = settings['chunk_time'] if dim == 'time' else settings['chunk_other']
+        chunks.append(max(1, min(size, limit) if limit else size))
+
+    encoding = {'zlib': settings['zlib'], 'shuffle': settings['shuffle'], 'chunksizes': tuple(chunks)}
+    if settings['zlib']:
+        encoding['complevel'] = settings['complevel']
+    return encoding
+
+
+def time_keys(values, units, calendar='standard'):
+    '''
+    convert raw time values to integer milliseconds since 1970 so that time stamps from files
+    holding time with different units can be compared exactly
+
+    :param values: raw time values
+    :param units: CF units string of the values
+    :param calendar: CF calendar of the values
+    :return: int64 array of keys
+    '''
+    dates = num2date(values, units, calendar, only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    return np.rint(date2num(dates, TIME_KEY_UNITS, calendar)).astype('int64')
+
+
+def convert_time_values(values, units_in, units_out, calendar='standard'):
+    '''
+    convert raw time values from one set of CF time units to another. Values are passed straight through
+    where the units only differ in how they are written (e.g. 'days since 1970-01-01' and
+    'days since 1970-01-01 00:00:00.000') so no rounding is introduced
+    '''
+    step_in, step_out = units_in.split(' since ')[0].strip(), units_out.split(' since ')[0].strip()
+    ref_in = num2date(0, units_in, calendar, only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    ref_out = num2date(0, units_out, calendar, only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+
+    if step_in == step_out and ref_in == ref_out:
+        return values
+
+    dates = num2date(values, units_in, calendar, only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    return date2num(dates, units_out, calendar)
+
+
+def is_time_units(variable):
+    '''
+    check if a netCDF4 variable holds CF time values ("<units> since <reference>")
+    '''
+    return ' since ' in getattr(variable, 'units', '')
+
+
+def _contiguous_runs(dst_idx):
+    '''
+    split sorted destination indices into (start, stop, offset) runs so that they can be written as slices
+    '''
+    runs = []
+    start = 0
+    for i in range(1, len(dst_idx) + 1):
+        if i == len(dst_idx) or dst_idx[i] != dst_idx[i - 1] + 1:
+            runs.append((dst_idx[start], dst_idx[i - 1] + 1, start))
+            start = i
+    return runs
+
+
+def plan_append(daily_keys, new_keys_per_file):
+    '''
+    work out where each time step of the new files goes in the daily file.
+
+    Time steps already in the daily file are overwritten in place (newest arrival wins), time steps later than
+    the end of the daily file are appended. A time step that would have to be inserted into the middle of the
+    daily file can't be done in place, so None is returned and the caller needs to do a full concatenation.
+
+    :param daily_keys: time keys of the daily file
+    :param new_keys_per_file: list of time key arrays, one per new file in order of arrival
+    :return: list of (src_idx, dst_idx) index arrays per file or None
+    '''
+    index_of = {key: i for i, key in enumerate(daily_keys)}
+    size = len(daily_keys)
+    last_key = daily_keys[-1] if size else None
+
+    plan = []
+    for keys in new_keys_per_file:
+        placement = {}
+        for src_i, key in enumerate(keys):
+            if key in index_of:
+                placement[index_of[key]] = src_i
+            elif last_key is None or key > last_key:
+                index_of[key] = size
+                placement[size] = src_i
+                size += 1
+                last_key = key
+            else:
+                return None
+
+        dst_idx = np.array(sorted(placement), dtype='int64')
+        src_idx = np.array([placement[d] for d in dst_idx], dtype='int64')
+        plan.append((src_idx, dst_idx))
+
+    return plan
+
+
+def append_to_daily_file(daily_file, new_files, script_name, harvest=None):
+    '''
+    Add the time steps of new 5-minute L2 files to an existing daily file rather than rewriting the whole day.
+    Only possible when time is an unlimited dimension in the daily file and all new time steps are either already
+    in the file (replaced, as newest wins) or come after its last time step.
+
+    The new time steps are written into a clone of the daily file (a reflink where the filesystem can do it, a
+    copy otherwise) that is renamed over it once complete, so a run that dies part way through leaves the daily
+    file as it was. The source files are removed after this returns, so they can't be relied on to redo the day.
+
+    :param daily_file: existing daily file (the quarantine copy)
+    :param new_files: list of new source files not yet included in the daily file
+    :param script_name: name of the concat script to go into the history
+    :param harvest: HeaderHarvest to gather the global attributes of the new files into as they are opened
+    :return: True if the files were appended, False if a full concatenation is needed
+    '''
+    log = logging.getLogger(__name__)
+    if harvest is None:
+        harvest = HeaderHarvest()
+
+    temp_filename_out = os.path.join(os.path.dirname(daily_file), '.append_' + os.path.basename(daily_file))
+
+    # open all the new files and check they fit onto the end of the daily file before copying it
+    sources = []
+    try:
+        with Dataset(daily_file) as daily:
+            if 'time' not in daily.dimensions or not daily.dimensions['time'].isunlimited():
+                log.info(f'{daily_file} does not have an unlimited time dimension, can not append in place')
+                return False
+
+            daily.set_auto_maskandscale(False)
+            daily_time = daily.variables['time']
+            calendar = getattr(daily_time, 'calendar', 'standard')
+            daily_keys = time_keys(daily_time[:], daily_time.units, calendar) if len(daily_time) else []
+
+        for fn in new_files:
+            src = Dataset(fn)
+            src.set_auto_maskandscale(False)
+            sources.append(src)
+            harvest.add(fn, src)
+
+        new_keys = [time_keys(src.variables['time'][:], src.variables['time'].units,
+                              getattr(src.variables['time'], 'calendar', calendar)) for src in sources]
+        plan = plan_append(list(daily_keys), new_keys)
+
+        if plan is None:
+            log.info(f'new time steps fall inside the existing day in {daily_file}, can not append in place')
+            return False
+
+        try:
+            _reflink(daily_file, temp_filename_out)
+        except OSError:
+            shutil.copyfile(daily_file, temp_filename_out)
+
+        try:
+            with Dataset(temp_filename_out, 'a') as daily:
+                daily.set_auto_maskandscale(False)
+
+                time_vars = [name for name, var in daily.variables.items()
+                             if 'time' in var.dimensions and is_time_units(var)]
+                data_vars = [name for name, var in daily.variables.items()
+                             if 'time' in var.dimensions and name not in time_vars]
+
+                for name in time_vars + data_vars:
+                    dst_var = daily.variables[name]
+                    time_axis = dst_var.dimensions.index('time')
+
+                    for src, (src_idx, dst_idx) in zip(sources, plan):
+                        if name not in src.variables or not len(dst_idx):
+                            continue
+                        src_var = src.variables[name]
+                        values = np.take(src_var[:], src_idx, axis=src_var.dimensions.index('time'))
+                        if name in time_vars:
+                            values = convert_time_values(values, src_var.units, dst_var.units,
+                                                         getattr(dst_var, 'calendar', calendar))
+
+                        for start, stop, offset in _contiguous_runs(dst_idx):
+                            slicer = [slice(None)] * dst_var.ndim
+                            slicer[time_axis] = slice(start, stop)
+                            dst_var[tuple(slicer)] = np.take(values, range(offset, offset + stop - start),
+                                                             axis=time_axis)
+
+                file_comments = daily.comment if 'comment' in daily.ncattrs() else ''
+                daily.comment = update_comment(file_comments, harvest.comments(new_files))
+
+                attrs = dataset_attrs(daily)
+                update_provenance(attrs, new_files, script_name)
+                daily.setncatts({att: attrs[att] for att in ('history', MANIFEST_ATTR, MANIFEST_PREFIX_ATTR)})
+
+            os.rename(temp_filename_out, daily_file)
+        finally:
+            if os.path.exists(temp_filename_out):
+                os.remove(temp_filename_out)
+
+    finally:
+        for src in sources:
+            src.close()
+
+    log.info(f'appended {len(new_files)} files to {daily_file}')
+    return True
+
+
+def finalise_daily_file(daily_file, encoding_profile=None):
+    '''
+    Daily files built up in place have an unlimited time dimension. Before they are ingested they are rewritten
+    once with time as a limited dimension, as needed for OPeNDAP, giving the same layout as a full concatenation.
+
+    :param daily_file: daily file to check and rewrite if needed
+    :param encoding_profile: name in ENCODING_PROFILES for the rewritten file
+    :return: True if the file was rewritten
+    '''
+    log = logging.getLogger(__name__)
+
+    with Dataset(daily_file) as daily:
+        if 'time' not in daily.dimensions or not daily.dimensions['time'].isunlimited():
+            return False
+
+    temp_filename_out = os.path.join(os.path.dirname(daily_file), '.final_' + os.path.basename(daily_file))
+
+    # straight copy of the raw values so nothing gets decoded and re-encoded on the way through
+    with Dataset(daily_file) as src, Dataset(temp_filename_out, 'w', format=src.data_model) as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+
+        dst.setncatts({att: src.getncattr(att) for att in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, len(dim))
+
+        for name, var in src.variables.items():
+            attrs = {att: var.getncattr(att) for att in var.ncattrs()}
+            fill_value = attrs.pop('_FillValue', None)
+            new_var = dst.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value,
+                                         **variable_encoding(encoding_profile, var.dimensions, var.shape,
+                                                             var.dtype))
+            new_var.setncatts(attrs)
+            new_var[...] = var[...]
+
+    os.rename(temp_filename_out, daily_file)
+    log.info(f'{daily_file} rewritten with time as a limited dimension')
+    return True
+
+
+def merge_runs(keys):
+    '''
+    k-way merge of the sorted runs along a time axis. The inputs are each in time order (the existing daily file,
+    then each 5-minute file), so rather than sorting the whole axis the runs where time keeps increasing are merged
+    through a heap keyed on the next time of each run. Whatever of the leading run comes before the next time of
+    any other run is taken in one go, so the heap is only touched where the runs overlap. Duplicate times keep the
+    later run (new arrivals win over the existing concat file), as with np.unique over the reversed time axis.
+
+    :param keys: time keys along the concatenated time axis
+    :return: list of (start, stop) index ranges of keys, in output order
+    '''
+    keys = np.asarray(keys)
+    if not len(keys):
+        return []
+
+    starts = np.concatenate(([0], np.nonzero(np.diff(keys) <= 0)[0] + 1))
+    stops = np.append(starts[1:], len(keys))
+
+    # later runs first among equal times
+    heap = [(keys[start], -run, int(start), int(stop)) for run, (start, stop) in enumerate(zip(starts, stops))]
+    heapq.heapify(heap)
+
+    merged = []
+    last_key = None
+    while heap:
+        key, neg_run, pos, stop = heapq.heappop(heap)
+        if key == last_key:
+            # already taken from a later run
+            pos += 1
+        else:
+            end = stop
+            if heap:
+                end = max(pos + 1, pos + int(np.searchsorted(keys[pos:stop], heap[0][0], side='left')))
+            merged.append((pos, end))
+            last_key = keys[end - 1]
+            pos = end
+        if pos < stop:
+            heapq.heappush(heap, (keys[pos], neg_run, pos, stop))
+
+    return merged
+
+
+def merge_plan(keys_per_file):
+    '''
+    work out which time steps of which file go where in the concatenated output, through merge_runs. Times are
+    made unique keeping the last file in the list that holds them and come out in time order.
+
+    :param keys_per_file: list of time key arrays, one per file in concatenation order
+    :return: (number of output time steps, list of (file index, src start, src stop, out start) in output order)
+    '''
+    offsets = np.cumsum([0] + [len(keys) for keys in keys_per_file])
+    keys_all = np.concatenate(keys_per_file) if keys_per_file else np.array([], dtype='int64')
+
+    segments = []
+    out_start = 0
+    for start, stop in merge_runs(keys_all):
+        # a run can carry on across files, split it where each file ends
+        while start < stop:
+            i = int(np.searchsorted(offsets, start, side='right')) - 1
+            piece_stop = min(stop, int(offsets[i + 1]))
+            segments.append((i, start - int(offsets[i]), piece_stop - int(offsets[i]), out_start))
+            out_start += piece_stop - start
+            start = piece_stop
+
+    return out_start, segments
+
+
+def slot_plan(keys_per_file, slot_seconds=SLOT_SECONDS):
+    '''
+    as merge_plan, but for time steps that sit on a fixed daily grid (5760 slots for profiles 15 seconds apart).
+    Each time step goes straight to its slot in the day, later files overwriting earlier ones, so there
+    is no sort or merge over the concatenated time axis.
+
+    :param keys_per_file: list of time key arrays, one per file in concatenation order
+    :param slot_seconds: spacing of the grid, which must divide the day into a whole number of milliseconds
+    :return: as merge_plan, or None if any time step is off the grid or outside the day so the caller
+             needs to use merge_plan. The reason is logged as a warning
+    '''
+    log = logging.getLogger(__name__)
+    slot_ms = int(round(slot_seconds * 1000))
+    if slot_ms <= 0 or DAY_MS % slot_ms:
+        log.warning(f'a {slot_seconds} second grid does not divide the day, sorting instead')
+        return None
+    if not keys_per_file or not len(keys_per_file[0]):
+        return None
+    n_slots = DAY_MS // slot_ms
+
+    day_start = keys_per_file[0][0] - keys_per_file[0][0] % DAY_MS
+
+    owner_file = np.full(n_slots, -1, dtype='int64')
+    owner_idx = np.zeros(n_slots, dtype='int64')
+    for i, keys in enumerate(keys_per_file):
+        offset = np.asarray(keys, dtype='int64') - day_start
+        slots, remainder = np.divmod(offset, slot_ms)
+        if remainder.any():
+            log.warning(f'{np.count_nonzero(remainder)} time steps of file {i} are off the {slot_seconds} second grid, '
+                        f'sorting instead')
+            return None
+        if (slots < 0).any() or (slots >= n_slots).any():
+            log.warning(f'time steps of file {i} fall outside the day of the first, sorting instead')
+            return None
+        # write order does the deduplication: the last file (and last time step) to hit a slot wins
+        owner_file[slots] = i
+        owner_idx[slots] = np.arange(len(keys))
+
+    filled = owner_file >= 0
+    files = owner_file[filled]
+    src_idx = owner_idx[filled]
+
+    # consecutive slots filled from consecutive time steps of the same file are copied as one segment
+    breaks = np.nonzero((np.diff(files) != 0) | (np.diff(src_idx) != 1))[0] + 1
+    seg_starts = np.concatenate(([0], breaks))
+    seg_stops = np.append(breaks, len(files))
+    segments = [(int(files[start]), int(src_idx[start]), int(src_idx[start]) + int(stop - start), int(start))
+                for start, stop in zip(seg_starts, seg_stops)]
+
+    return len(files), segments
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
+
+
+class PinnedFile():
+    '''
+    An existing daily file held steady so it can be read where it is while it is concatenated, in place of taking
+    a copy of it. Tried in turn:
+    - a hard link at link_path, where the file is on the same filesystem and we may link to it. What is read is
+      then the file as it was found even if it is replaced by a newer version, moved on down the pipeline or
+      deleted meanwhile, but the link shares the file's inode so it is not protected from being modified in place
+      (e.g. by eprofile_shrink_comments)
+    - a reflink (copy on write clone) at link_path, where the filesystem supports them, which is a copy of the file
+      as it was found whatever happens to it meanwhile
+    - otherwise, as for a file in the archive on another filesystem, the file is read in place
+    For a hard link or a file read in place, changed() tells if the file was modified, replaced or removed while it
+    was being read, in which case the output made from it shouldn't be used.
+
+    :param path: existing file
+    :param link_path: where to put the link, normally a hidden name next to the daily file being made
+    '''
+
+    def __init__(self, path, link_path):
+        self.link_path = link_path
+
+        if os.path.lexists(link_path):
+            os.remove(link_path)  # left behind by a run that died
+
+        try:
+            os.link(path, link_path)
+            self.method = 'hardlink'
+        except OSError:
+            try:
+                _reflink(path, link_path)
+                self.method = 'reflink'
+            except OSError:
+                self.method = 'in place'
+
+        self.path = path if self.method == 'in place' else link_path
+        # a reflink is a copy of its own, the others share the inode of a file that others may write to
+        self._signature = None if self.method == 'reflink' else self._stat_signature(self.path)
+        logging.getLogger(__name__).debug(f'{path} pinned by {self.method} as {self.path}')
+
+    @staticmethod
+    def _stat_signature(path):
+        stat = os.stat(path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def changed(self):
+        '''
+        :return: True if the file read has been modified, replaced or removed since it was pinned
+        '''
+        if self._signature is None:
+            return False
+        try:
+            return self._stat_signature(self.path) != self._signature
+        except FileNotFoundError:
+            return True
+
+    def release(self):
+        if self.method != 'in place' and os.path.lexists(self.link_path):
+            os.remove(self.link_path)
+
+
+class DailyFileLock():
+    '''
+    Exclusive lock on a daily file, so that it is never written by two processes at once (concatenations of the
+    same instrument-day from overlapping runs, or a concatenation and eprofile_shrink_comments). It is held on a
+    hidden lock file next to the daily file, which is removed on release while the lock is still held so that none
+    are left behind. A process that opened the lock file before it was removed finds that it has locked a file that
+    is no longer there and tries again with the lock file now in its place.
+
+    :param daily_file: daily file
+    '''
+
+    def __init__(self, daily_file):
+        self.lock_filename = os.path.join(os.path.dirname(daily_file), f'.{os.path.basename(daily_file)}.lock')
+        self._lock_file = None
+
+    def acquire(self):
+        '''
+        :return: True if the lock is now held, False if another process holds it
+        '''
+        while True:
+            lock_file = open(self.lock_filename, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+
+            held = os.fstat(lock_file.fileno())
+            try:
+                current = os.stat(self.lock_filename)
+            except FileNotFoundError:
+                current = None
+            if current and (current.st_dev, current.st_ino) == (held.st_dev, held.st_ino):
+                self._lock_file = lock_file
+                return True
+            lock_file.close()
+
+    def release(self):
+        if self._lock_file:
+            os.remove(self.lock_filename)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def _time_slicer(ndim, time_axis, index):
+    slicer = [slice(None)] * ndim
+    slicer[time_axis] = index
+    return tuple(slicer)
+
+
+def concat_netcdf4(pattern_in, filename_out, script_name, existing_file='', time_as_limited_dim=True,
+                   metadata_fixes=None, slot_seconds=None, encoding_profile=None, harvest=None):
+    '''
+    Concatenate L2 files along time straight through netCDF4, without xarray/dask. All inputs have the same
+    layout, so each variable is read in time order, a piece of a file at a time as set out by merge_plan (or
+    slot_plan), and written out front to back. Raw values are copied so variable data is byte for byte that of the
+    source files.
+
+    Follows the xarray concatenation in concat_single_inst: duplicate times are dropped keeping the latest file,
+    variables without time come from the first file, time is stored as 'days since 1970-01-01 00:00:00.000',
+    quality_flag is stored as int32 and history and comment are updated from the source files.
+
+    :param pattern_in: files to concatenate, with the existing concat file first if there is one
+    :param filename_out: file to write
+    :param script_name: name of the concat script to go into the history
+    :param existing_file: the existing concat file in pattern_in, if any
+    :param time_as_limited_dim: True: store time as limited dimension for compatibilty with OpenDAP
+    :param metadata_fixes: optional function(global_attrs, var_attrs) for any script specific attribute fixes
+    :param slot_seconds: if set, place time steps on a fixed daily grid of this spacing (see slot_plan) rather
+                         than sorting, falling back to the sort where times are off the grid
+    :param encoding_profile: name in ENCODING_PROFILES for the chunking and compression of the output
+    :param harvest: HeaderHarvest to gather the global attributes of the source files into as they are opened
+    '''
+    log = logging.getLogger(__name__)
+    if harvest is None:
+        harvest = HeaderHarvest()
+
+    sources = []
+    try:
+        for fn in pattern_in:
+            src = Dataset(fn)
+            src.set_auto_maskandscale(False)
+            sources.append(src)
+            if fn != existing_file:
+                harvest.add(fn, src)
+
+        first = sources[0]
+        if 'time' not in first.variables:
+            raise ValueError(f'no time variable in {pattern_in[0]}')
+
+        keys_per_file = []
+        for fn, src in zip(pattern_in, sources):
+            for name in first.variables:
+                if name not in src.variables:
+                    raise ValueError(f'{name} missing from {fn}')
+            src_time = src.variables['time']
+            keys_per_file.append(time_keys(src_time[:], src_time.units, getattr(src_time, 'calendar', 'standard')))
+
+        slots = slot_plan(keys_per_file, slot_seconds) if slot_seconds else None
+        n_time, segments = slots or merge_plan(keys_per_file)
+
+        # attributes for the output, following the updates done to the xarray dataset
+        global_attrs = {att: first.getncattr(att) for att in first.ncattrs()}
+        var_attrs = {name: {att: var.getncattr(att) for att in var.ncattrs()} for name, var in first.variables.items()}
+
+        source_files = [fn for fn in pattern_in if fn != existing_file]
+        update_provenance(global_attrs, source_files, script_name)
+        global_attrs['comment'] = update_comment(global_attrs.get('comment', ''), harvest.comments(source_files))
+
+        var_attrs['time']['long_name'] = "End time (UTC) of the measurement"
+        for name in ('time', 'start_time'):
+            if name in var_attrs:
+                var_attrs[name]['units'] = DAILY_TIME_UNITS
+                var_attrs[name].setdefault('calendar', 'proleptic_gregorian')  # as added by xarray
+
+        if 'quality_flag' in var_attrs:
+            qf_attrs = var_attrs['quality_flag']
+            if 'comments' not in qf_attrs:
+                qf_attrs['comments'] = f"""flag_values: 0,1,2.  flag_meanings: 0: valid data;  1: do_not_use; 2: no_information.
+The invalid flag (=1) is attributed to all data >1000m above cloud base, the other points have a valid flag (=0)"""
+            else:
+                qf_attrs['comments'] = f"{qf_attrs['comments']}.\nThe invalid flag (=1) is attributed to all data >1000m above cloud base, the other points have a valid flag (=0)"
+
+            values = qf_attrs['flag_values']
+            if isinstance(values, str):
+                values = values.split(',')
+            qf_attrs['flag_values'] = np.array([int(v) for v in np.atleast_1d(values)], dtype=np.int32)
+
+        if metadata_fixes:
+            metadata_fixes(global_attrs, var_attrs)
+
+        with Dataset(filename_out, 'w', format='NETCDF4') as dst:
+            dst.set_auto_maskandscale(False)
+            dst.setncatts(global_attrs)
+
+            for name, dim in first.dimensions.items():
+                if name == 'time':
+                    dst.createDimension(name, n_time if time_as_limited_dim else None)
+                else:
+                    dst.createDimension(name, len(dim))
+
+            for name, var in first.variables.items():
+                attrs = dict(var_attrs[name])
+                fill_value = attrs.pop('_FillValue', None)
+                if fill_value is not None and np.issubdtype(np.asarray(fill_value).dtype, np.floating) \
+                        and np.isnan(fill_value):
+                    fill_value = None
+                # time is converted to days, which sources holding it as integers (e.g. seconds) can't take
+                if name == 'quality_flag':
+                    datatype = np.dtype('int32')
+                elif name in ('time', 'start_time'):
+                    datatype = np.dtype('float64')
+                else:
+                    datatype = var.datatype
+                shape = [n_time if dim == 'time' else len(first.dimensions[dim]) for dim in var.dimensions]
+
+                dst_var = dst.createVariable(name, datatype, var.dimensions, fill_value=fill_value,
+                                             **variable_encoding(encoding_profile, var.dimensions, shape, datatype))
+                dst_var.setncatts(attrs)
+
+                if 'time' not in var.dimensions:
+                    dst_var[...] = var[...]
+                    continue
+
+                time_axis = var.dimensions.index('time')
+
+                # the segments come in output order, so the output is written front to back a block at a time
+                # rather than being built up in memory for the whole day
+                pending = []
+                written = 0
+                for n, (i, src_start, src_stop, out_start) in enumerate(segments):
+                    src_var = sources[i].variables[name]
+                    values = src_var[_time_slicer(src_var.ndim, time_axis, slice(src_start, src_stop))]
+                    if name in ('time', 'start_time'):
+                        values = convert_time_values(values, src_var.units, DAILY_TIME_UNITS,
+                                                     getattr(src_var, 'calendar', 'standard'))
+                    pending.append(np.asarray(values, dtype=datatype))
+
+                    end = out_start + src_stop - src_start
+                    if end - written >= WRITE_STEPS or n == len(segments) - 1:
+                        block = pending[0] if len(pending) == 1 else np.concatenate(pending, axis=time_axis)
+                        dst_var[_time_slicer(dst_var.ndim, time_axis, slice(written, end))] = block
+                        pending = []
+                        written = end
+
+    finally:
+        for src in sources:
+            src.close()
+
+    log.info(f'{len(pattern_in)} files concatenated to {filename_out} with {n_time} time steps')
@@ -13,19 +13,34 @@ Graham Parton, CEDA, 06/2021
 import os
 import glob
 import re
+import fnmatch
 import warnings
 import datetime
+import multiprocessing
 import xarray as xr
 import numpy as np
 import sys
 import getopt
 import logging
-import shutil
+import time
+import dask
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from hashlib import md5
 from time import localtime
 
 from netCDF4 import Dataset
 
+from eprofile_concat_engines import (append_to_daily_file, concat_netcdf4, merge_runs, variable_encoding,
+                                     ENCODING_PROFILES, PinnedFile, DailyFileLock)
+from eprofile_provenance import dataset_attrs, read_manifest, update_provenance, update_comment, HeaderHarvest
+from eprofile_station_cache import StationCache
+from eprofile_archive_catalogue import ARCHIVE_CATALOGUE, CatalogueUnavailable
+from eprofile_metrics import (StageMetrics, NULL_METRICS, emit_metrics, reset_peak_rss, peak_rss_bytes,
+                              current_rss_bytes)
+from eprofile_filenames import parse_l2_filenames, group_by_instrument_day
+from eprofile_integrity import validate_files, quarantine_files, L2_REQUIRED_VARIABLES
+
 # ingest CEDA specific tools to work witin CEDA ingestion system
 from deposit_client import DepositClient
 from arrivals_deleter import ArrivalsDeleter
@@ -96,67 +111,165 @@ alc_filename_start = 'L2_'
 alc_file_ext = '.nc'
 alc_force_time_first = True  # True: force time to be the first dimension in concatenated NetCDF file
 alc_delete_after_concat = False  # True: delete short-time files (usually 5 min) after concatenation to daily file
+alc_chunk_copies = 4  # copies of a chunk held at once under a memory budget, as it is read, deduplicated, converted and written
+alc_budget_open_files = 16  # files xarray keeps open at once under a memory budget (it otherwise keeps up to 128)
 
 
 # ==================== end configuration ==========================
 
 
 # =========================== code ================================
-def concat_all_alc(year, month, day):
-    """select all ALC files on which concatenation should be run on,
-    group by instrument and execute concatenation routine"""
+def _scandir_dirs(path):
+    '''
+    names of the subdirectories of a directory, omitting hidden ones. Uses the file type from the directory
+    listing so no stat is needed per entry
+    '''
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if not entry.name.startswith('.') and entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
 
-    for dir_country in os.listdir(alc_base_path):
 
-        path_country = os.path.join(alc_base_path, dir_country)
-        if os.path.isfile(path_country) or dir_country.startswith('.'):
-            continue  # omit files or hidden directories
+def _station_day_dirs(path_stn, months, instruments=None):
+    '''
+    find the instrument-day directories of one station
 
-        for dir_stn in os.listdir(path_country):
+    :param path_stn: station directory, holding one directory per instrument
+    :param months: dict of (year, month): set of days to look for
+    :param instruments: shell patterns for the country/station/instrument of the instruments to keep, None for all
+    :return: list of (month directory, YYYYMMDD, day directory)
+    '''
+    path_country, dir_stn = os.path.split(path_stn)
+    station = f'{os.path.basename(path_country)}/{dir_stn}'
 
-            path_stn = path_country + '/' + dir_stn
-            if os.path.isfile(path_stn) or dir_stn.startswith('.'):
-                continue  # omit files or hidden directories
+    found = []
+    for dir_inst in _scandir_dirs(path_stn):
+        if instruments and not any(fnmatch.fnmatch(f'{station}/{dir_inst}', pattern) for pattern in instruments):
+            continue
+        path_inst = os.path.join(path_stn, dir_inst)
 
-            for dir_inst in os.listdir(path_stn):
+        for (year, month), days in months.items():
+            path_month = '%s/%d/%02d' % (path_inst, year, month)
 
-                path_inst = path_stn + '/' + dir_inst
-                if os.path.isfile(path_inst) or dir_inst.startswith('.'):
-                    continue  # omit files or hidden directories
+            for dir_day in _scandir_dirs(path_month):
+                if not dir_day.isdigit() or int(dir_day) not in days:
+                    continue
+                found.append((path_month, '%d%02d%s' % (year, month, dir_day), os.path.join(path_month, dir_day)))
+    return found
 
-                path_month = '%s/%d/%02d' % (path_inst, year, month)
-                path_day = '%s/%d/%02d/%02d' % (path_inst, year, month, day)
-                search_pattern = path_day + '/' + alc_filename_start + '*%d%02d%02d*' % (
-                year, month, day) + alc_file_ext
-                files_matching = glob.glob(search_pattern)  # need to match pattern here, therefore using glob
-                unique_instday_pattern = list(set(([s[0:-7] for s in files_matching])))
 
-                for fp in unique_instday_pattern:
-                    pattern_act = fp + '*' + alc_file_ext
-                    filename_out = path_month + '/' + os.path.basename(fp) + alc_file_ext
-                    concat_single_inst(pattern_act, filename_out, alc_force_time_first, alc_delete_after_concat)
+def _day_instdays(path_month, date_string, path_day):
+    '''
+    group the single files of an instrument-day directory by the daily file they go into
 
+    :return: list of (list of files, daily filename_out)
+    '''
+    files_by_instday = {}
+    with os.scandir(path_day) as entries:
+        for entry in entries:
+            if entry.name.startswith(alc_filename_start) and entry.name.endswith(alc_file_ext) \
+                    and date_string in entry.name:
+                files_by_instday.setdefault(entry.path[0:-7], []).append(entry.path)
 
-def add_prefix(filename):
-    prefix = md5(str(localtime()).encode('utf-8')).hexdigest()
-    return f"{prefix}_{filename}"
+    return [(sorted(files_matching), path_month + '/' + os.path.basename(fp) + alc_file_ext)
+            for fp, files_matching in files_by_instday.items()]
 
 
-def get_eprofile_archive_path_details(inc_file):
+def _walk_alc_archive(start_date, end_date, base_path, jobs, scan_day, instruments=None):
     '''
-    function to take a sample file and work out components that are used for archive destination for the data
+    walk the archive of single files over a date range, fanning out over the station directories in a thread pool
 
-    :param inc_file:
-    :return: inst_name_dict
+    :param scan_day: function(month directory, YYYYMMDD, day directory) returning a list of what was found in an
+                     instrument-day directory
+    :return: list of everything found
+    '''
+    months = {}
+    date = start_date
+    while date <= end_date:
+        months.setdefault((date.year, date.month), set()).add(date.day)
+        date += datetime.timedelta(days=1)
+
+    station_dirs = []
+    for dir_country in _scandir_dirs(base_path):
+        if dir_country == 'daily_files':
+            continue  # omit the concatenated files
+        path_country = os.path.join(base_path, dir_country)
+        station_dirs.extend(os.path.join(path_country, dir_stn) for dir_stn in _scandir_dirs(path_country))
+
+    def scan_station(path_stn):
+        return [item for day_dir in _station_day_dirs(path_stn, months, instruments) for item in scan_day(*day_dir)]
+
+    found = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for station_found in executor.map(scan_station, station_dirs):
+            found.extend(station_found)
+    return found
+
+
+def find_alc_instdays(start_date, end_date, base_path=alc_base_path, jobs=8):
     '''
+    walk the archive of single files for all the instrument-days in a date range, fanning out over the station
+    directories in a thread pool
+
+    :param start_date: datetime.date of the first day
+    :param end_date: datetime.date of the last day (included)
+    :param base_path: top of the archive
+    :param jobs: number of threads
+    :return: list of (list of files, daily filename_out)
+    '''
+    return _walk_alc_archive(start_date, end_date, base_path, jobs, _day_instdays)
 
-    dataset = Dataset(inc_file)
 
-    date_string = os.path.basename(inc_file).split('_')[2][1:-3]
-    ins_num = dataset.instrument_id
-    inst_type = INSTRUMENT_DICT[dataset.instrument_type]
+def find_alc_day_dirs(start_date, end_date, base_path=alc_base_path, jobs=8, instruments=None):
+    '''
+    walk the archive of single files for the instrument-day directories
+    (base_path/country/station/operator-instrument_id/YYYY/MM/DD) in a date range, as find_alc_instdays but without
+    listing the files in them
+
+    :param start_date: datetime.date of the first day
+    :param end_date: datetime.date of the last day (included)
+    :param base_path: top of the archive
+    :param jobs: number of threads
+    :param instruments: shell patterns matched against country/station/instrument, e.g. 'switzerland/payerne/*',
+                        for the instruments to keep, None for all
+    :return: list of directories, in date order
+    '''
+    day_dirs = _walk_alc_archive(start_date, end_date, base_path, jobs,
+                                 lambda path_month, date_string, path_day: [(date_string, path_day)], instruments)
+    return [path_day for _, path_day in sorted(day_dirs)]
+
+
+def concat_all_alc(year, month, day, end_date=None, jobs=8):
+    """select all ALC files on which concatenation should be run on,
+    group by instrument and execute concatenation routine
+    - end_date:
+        datetime.date to run over all days from year/month/day to end_date in one traversal of the archive
+    - jobs:
+        number of threads walking the archive"""
+    log = logging.getLogger(__name__)
+
+    start_date = datetime.date(year, month, day)
+    instdays = find_alc_instdays(start_date, end_date or start_date, jobs=jobs)
+    log.info(f'{len(instdays)} instrument-days to concatenate from {start_date} to {end_date or start_date}')
 
-    loc_details = dataset.site_location.split(',')
+    for files_matching, filename_out in instdays:
+        concat_single_inst(files_matching, filename_out, delete_after_concat=alc_delete_after_concat)
+
+
+def add_prefix(filename):
+    prefix = md5(str(localtime()).encode('utf-8')).hexdigest()
+    return f"{prefix}_{filename}"
+
+
+def resolve_station_details(header):
+    '''
+    map the global attributes of a file to the station components of the archive path
+
+    :param header: dict of instrument_id, instrument_type, site_location and title
+    :return: dict of operator, instrument_type, country, location and inst_id
+    '''
+    loc_details = header['site_location'].split(',')
     location_name = re.sub('\_', '-', loc_details[0]).lower()
 
     if location_name == 'aberystwyth':  # correcting for incorrect setting in incoming filename
@@ -168,27 +281,114 @@ def get_eprofile_archive_path_details(inc_file):
     if location_name == 'chilbolton':
         location_name = 'chilbolton-atmospheric-observatory'
 
-    title_details = dataset.title.split(' ')
+    title_details = header['title'].split(' ')
 
-    ingestState = False
     try:
-        inst_name_dict = {'operator': OPERATOR_DICT['-'.join(title_details[2:])],
-                          'instrument_type': inst_type,
-                          'country': loc_details[1].replace('_', '-').lower(),
-                          'location': location_name,
-                          'inst_id': ins_num,
-                          'year': date_string[0:4],
-                          'month': date_string[4:6],
-                          'day': date_string[6:8],
-                          'version': 'v1_0'
-                          }
+        return {'operator': OPERATOR_DICT['-'.join(title_details[2:])],
+                'instrument_type': INSTRUMENT_DICT[header['instrument_type']],
+                'country': loc_details[1].replace('_', '-').lower(),
+                'location': location_name,
+                'inst_id': header['instrument_id']
+                }
     except KeyError as e:
-        log.error("%s: %s" % (e, '|'.join(title_details)))
-        inst_name_dict = None
+        raise KeyError(f"{e}: {'|'.join(title_details)}")
+
+
+# station details are constant per instrument, so cache them rather than open a file for every lookup
+STATION_CACHE = StationCache(resolve_station_details)
+
+
+def get_eprofile_archive_path_details(inc_file):
+    '''
+    function to take a sample file and work out components that are used for archive destination for the data
+
+    :param inc_file:
+    :return: inst_name_dict
+    '''
+    log = logging.getLogger(__name__)
+
+    date_string = os.path.basename(inc_file).split('_')[2][1:-3]
+
+    try:
+        inst_name_dict = STATION_CACHE.lookup(inc_file)
+    except KeyError as e:
+        log.error(e.args[0])
+        return None
+
+    inst_name_dict.update({'year': date_string[0:4],
+                           'month': date_string[4:6],
+                           'day': date_string[6:8],
+                           'version': 'v1_0'
+                           })
 
     return inst_name_dict
 
 
+def refresh_station_cache(harvest, source_files):
+    '''
+    check the station cache entry of an instrument with the header of one of its files read during the
+    concatenation, so that looking up the station details for the next concatenation needn't open a file
+
+    :param harvest: HeaderHarvest of the concatenation
+    :param source_files: files that went into the daily file
+    '''
+    log = logging.getLogger(__name__)
+
+    if not source_files:
+        return
+    try:
+        STATION_CACHE.lookup(source_files[-1], header=harvest.header(source_files[-1]))
+    except (KeyError, OSError) as ex:
+        log.debug(f'station cache not refreshed from {source_files[-1]}: {ex}')
+
+
+def find_archived_single_files(sample_file):
+    '''
+    archived single files for the instrument and day of a file, from the archive catalogue if it is available
+
+    :param sample_file: L2 or daily file of the instrument and day
+    :return: list of paths
+    '''
+    log = logging.getLogger(__name__)
+
+    try:
+        return ARCHIVE_CATALOGUE.single_files(sample_file)
+    except CatalogueUnavailable as ex:
+        log.debug(f'archive catalogue: {ex}')
+
+    inst_name_dict = get_eprofile_archive_path_details(sample_file)
+    if not inst_name_dict:
+        return []
+
+    arch_dest = alc_base_path + '/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(year)s/%(month)s/%(day)s/' % inst_name_dict
+    return glob.glob(os.path.join(arch_dest, 'L2*.nc'))
+
+
+def find_archived_daily_file(daily_file, inc_file):
+    '''
+    archived copy of a daily file, from the archive catalogue if it is available
+
+    :param daily_file: daily file being made
+    :param inc_file: one of the files going into it, to read the archive path details from if needed
+    :return: path, '' if there is no daily file in the archive
+    '''
+    log = logging.getLogger(__name__)
+
+    try:
+        return ARCHIVE_CATALOGUE.daily_file(daily_file)
+    except CatalogueUnavailable as ex:
+        log.debug(f'archive catalogue: {ex}')
+
+    log.info(f"getting details from {inc_file} to determine target file in archive")
+    inst_name_dict = get_eprofile_archive_path_details(inc_file)
+    if not inst_name_dict:
+        return ''
+
+    arch_dest = alc_base_path + '/daily_files/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(year)s' % inst_name_dict
+    archived_file_path = os.path.join(arch_dest, os.path.basename(daily_file))
+    return archived_file_path if os.path.exists(archived_file_path) else ''
+
+
 def find_ingested_single_files(arrivals_filelist):
     '''
     Function to take source list of files (pattern_in from arrivals area)
@@ -201,33 +401,28 @@ def find_ingested_single_files(arrivals_filelist):
     log = logging.getLogger(__name__)
 
     new_files = []
-    inst_name_dict = get_eprofile_archive_path_details(arrivals_filelist[0])
+    archived_file_list = find_archived_single_files(arrivals_filelist[0])
 
-    if inst_name_dict:
-        arch_dest = '/badc/eprofile/data/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(year)s/%(month)s/%(day)s/' % inst_name_dict
-        archived_file_list = glob.glob(os.path.join(arch_dest, 'L2*.nc'))
+    if archived_file_list:
         arrivals_filelist_dict = {}
         archived_filelist_dict = {}
 
-        if archived_file_list:
-
-            for arrivals_file in arrivals_filelist:
-                arrivals_filelist_dict[re.search('(L2_([\w-]{1,})_([\w]{13}).nc)', arrivals_file).groups()[0]] = arrivals_file
+        for record in parse_l2_filenames(arrivals_filelist):
+            arrivals_filelist_dict[record.basename] = record.path
 
-            for archived_file in archived_file_list:
-                archived_filelist_dict[
-                    re.search('(L2_([\w-]{1,})_([\w]{13}).nc)', archived_file).groups()[0]] = archived_file
+        for record in parse_l2_filenames(archived_file_list):
+            archived_filelist_dict[record.basename] = record.path
 
 
-            log.info('getting list of ingested files needed for concat...')
-            arrivals_filelist_set = set(arrivals_filelist_dict.keys())
-            archived_filelist_set = set(archived_filelist_dict.keys())
+        log.info('getting list of ingested files needed for concat...')
+        arrivals_filelist_set = set(arrivals_filelist_dict.keys())
+        archived_filelist_set = set(archived_filelist_dict.keys())
 
-            if arrivals_filelist_set - archived_filelist_set and arrivals_filelist_set & archived_filelist_set:
-                for archived_item in arrivals_filelist_set & archived_filelist_set:
-                    del archived_filelist_dict[archived_item]
+        if arrivals_filelist_set - archived_filelist_set and arrivals_filelist_set & archived_filelist_set:
+            for archived_item in arrivals_filelist_set & archived_filelist_set:
+                del archived_filelist_dict[archived_item]
 
-            new_files = list(archived_filelist_dict.values())
+        new_files = list(archived_filelist_dict.values())
 
 
     if new_files:
@@ -236,8 +431,99 @@ def find_ingested_single_files(arrivals_filelist):
     return arrivals_filelist
 
 
+def get_new_files(pattern_in, existing_file):
+    '''
+    Check the manifest of an existing concat file against the source files to make sure we're not trying to
+    include files that have already been concatenated into it. The source list is topped up with
+    already ingested single files for the day where we have less than a full day of files.
+
+    :param pattern_in: list of source files
+    :param existing_file: existing concat file
+    :return: sorted list of source files not yet in the existing file
+    '''
+    log = logging.getLogger(__name__)
+
+    pattern_in_dict = {}
+    # first, get the filenames from the paths for the source files
+
+    if len(pattern_in) < 288:
+        '''
+        so, if we have less than 288 files then we'll try to pull back from the single file directory that matches here
+        '''
+
+        pattern_in = find_ingested_single_files(pattern_in)
+    for record in parse_l2_filenames(pattern_in, daily=False):
+        pattern_in_dict[record.basename] = record.path
+
+    log.info('doing check on manifest from concat file and list of new files')
+    pat_in_set = set(pattern_in_dict.keys())
+
+    # pull back list of files already added to existing file to make sure we don't add these
+    with Dataset(existing_file) as dataset:
+        hist_set = read_manifest(dataset_attrs(dataset))
+
+    if not pat_in_set - hist_set:
+        return []
+
+    for hist_item in pat_in_set & hist_set:
+        log.debug(f'already concatenated: {pattern_in_dict[hist_item]}')
+        del pattern_in_dict[hist_item]
+
+    new_files_list = list(pattern_in_dict.values())
+    new_files_list.sort()
+
+    return new_files_list
+
+
+def remove_source_files(files_to_remove, filename_out, deleterchoice):
+    '''
+    delete original short files after they have been concatenated to daily file
+    '''
+    log = logging.getLogger(__name__)
+    log.info('removing all files matching %s' % (files_to_remove))
+
+    # remove files
+    if deleterchoice in ['arrivals', 'notArrivals']:
+        for file_to_remove in files_to_remove:
+            if os.path.exists(file_to_remove) and file_to_remove != filename_out:
+
+                log.debug('Removing %r', file_to_remove)
+
+                if deleterchoice == 'arrivals':
+                    AD.delete(file_to_remove)
+                elif deleterchoice == 'notArrivals':
+
+                    os.remove(file_to_remove)
+
+
+def budget_time_chunk(sample_file, memory_budget_mb):
+    '''
+    time steps per dask chunk that keep a concatenation within a memory budget, from the size of a time step
+    of all the time varying variables and the memory the process is already using
+
+    :param sample_file: file with the layout of the files being concatenated
+    :param memory_budget_mb: maximum resident memory of the process in MB
+    :return: time steps per chunk, at least 1
+    '''
+    log = logging.getLogger(__name__)
+
+    with Dataset(sample_file) as dataset:
+        step_bytes = sum(np.dtype(var.dtype).itemsize *
+                         int(np.prod([len(dataset.dimensions[dim]) for dim in var.dimensions if dim != 'time']))
+                         for var in dataset.variables.values() if 'time' in var.dimensions)
+
+    available = memory_budget_mb * 2**20 - current_rss_bytes()
+    if available <= 0:
+        log.warning(f'already using more than the memory budget of {memory_budget_mb} MB, reading one time step '
+                    f'at a time')
+        return 1
+
+    return max(1, available // (alc_chunk_copies * max(step_bytes, 1)))
+
+
 def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, ignore_previous_concat=False,
-                       time_as_limited_dim=True, deleterchoice='keep'):
+                       time_as_limited_dim=True, deleterchoice='keep', append_in_place=False, engine='xarray',
+                       slot_seconds=None, encoding_profile=None, collect_metrics=False, memory_budget_mb=None):
     """concatenate data from NetCDF and save to concatenated file.
     If a concatentated file already exists, these data are included.
     Optional transposing to force time to first dimension
@@ -247,10 +533,58 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
     - ignore_previous_concat:
         True: previously concatenated file will be ignored and overwritten
     - time_as_limited_dim:
-        True: Store time as limited dimension in output file for compatibilty with OpenDAP"""
+        True: Store time as limited dimension in output file for compatibilty with OpenDAP
+    - append_in_place:
+        True: add new time steps to the existing quarantine file in place where possible rather than rewriting
+        the whole day. Time is then kept as unlimited dimension until the file is finalised on ingest
+    - engine:
+        'xarray': concatenate with xr.open_mfdataset
+        'netcdf4': concatenate straight through netCDF4 (see eprofile_concat_engines.concat_netcdf4)
+    - slot_seconds:
+        netcdf4 engine only. Place profiles straight into their slot on a fixed daily grid of this spacing in
+        seconds (15 for 20 profiles to a 5 minute file) instead of sorting and deduplicating the time axis
+    - encoding_profile:
+        chunking and compression of the output, a name from eprofile_concat_engines.ENCODING_PROFILES
+        ('default', 'fast-write', 'archive-compact')
+    - collect_metrics:
+        True: time each stage and count the files and bytes read and written (see eprofile_metrics)
+    - memory_budget_mb:
+        xarray engine only. Maximum resident memory of the process in MB: the files are opened in dask chunks
+        sized to fit (see budget_time_chunk) and written out a chunk at a time, and the peak reached is logged.
+        The netcdf4 engine already holds only one variable at a time
+
+    returns the metrics record for the instrument-day if collect_metrics, otherwise None"""
     log = logging.getLogger(__name__)
     log.info('concatenating ' + filename_out)
 
+    if collect_metrics or memory_budget_mb:
+        reset_peak_rss()
+    metrics = StageMetrics(filename_out, engine=engine, append_in_place=append_in_place) if collect_metrics \
+        else NULL_METRICS
+    # global attributes of the source files, gathered as they are opened for their data
+    harvest = HeaderHarvest()
+
+    if append_in_place and os.path.exists(filename_out):
+        # the quarantine file is ours to update, so see if the new files can just be added onto the end of it
+        with metrics.stage('new_files'):
+            new_files_list = get_new_files(pattern_in, filename_out)
+        if not new_files_list:
+            log.info(f'-> nothing new to add to {filename_out}')
+            metrics.status = 'nothing_new'
+            return metrics.record()
+
+        with metrics.stage('append'):
+            appended = append_to_daily_file(filename_out, new_files_list, os.path.basename(__file__), harvest=harvest)
+        if appended:
+            metrics.status = 'appended'
+            refresh_station_cache(harvest, new_files_list)
+            metrics.read_files(new_files_list)
+            if delete_after_concat:
+                with metrics.stage('delete_sources'):
+                    remove_source_files(new_files_list, filename_out, deleterchoice)
+            log.info(f'-> done with {filename_out}')
+            return metrics.record()
+
     # before we get going we're going to get a temporary output filename that we'll use for the output file whilst it is in production
     # this is to make sure we're not getting caught up with any pre-existing 1/2 baked output files by accident..
     # once we've a fully baked output file we'll rename it to the final filename we want for ingestion
@@ -258,224 +592,201 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
     temp_filename_out = os.path.join(os.path.dirname(filename_out), add_prefix(os.path.basename(filename_out)))
 
     # first pull back file from pipeline... first stop is to check the quarantine area, then the readytoingest area then the archive
-    temp_name = ''
-    
-    
+    existing_file = ''
+
     if os.path.exists(filename_out):
         # first, let's check the quarantine area
-        temp_name = filename_out.replace('L2_', '.L2_')
-
-        shutil.copy2(filename_out, temp_name)
+        existing_file = filename_out
 
     else:
         readyToIngest_path = filename_out.replace('quarantine', 'readyToIngest')
         # now the 'readyToIngest' area
 
         if os.path.exists(readyToIngest_path):
-            temp_name = filename_out.replace('L2_', '.L2_')
-            shutil.copy2(readyToIngest_path, os.path.join(temp_name))
+            existing_file = readyToIngest_path
 
         # now the archive
         else:
-            # first, let's work out what that archived file path would be. To do this we need some info
-            # from the global attributes of one of the new files:
-            inc_file = pattern_in[0]
-            log.info(f"getting details from {inc_file} to determine target file in archive")
-
-            inst_name_dict = get_eprofile_archive_path_details(inc_file)
-
-            if inst_name_dict:
-                arch_dest = '/badc/eprofile/data/daily_files/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(year)s' % inst_name_dict
+            # look up the archived daily file in the archive catalogue, or work out its path from the global
+            # attributes of one of the new files
+            with metrics.stage('archive_probe'):
+                existing_file = find_archived_daily_file(filename_out, pattern_in[0])
 
-                archived_file_path = os.path.join(arch_dest,os.path.basename(filename_out))
-                # finally, let's check the archive
-
-                if os.path.exists(archived_file_path):
-                    temp_name = filename_out.replace('L2_', '.L2_')
-                    shutil.copy2(archived_file_path, os.path.join(temp_name))
+    temp_name = ''
+    pinned = None
+    if existing_file:
+        # so, we have an existing file to concat with. It is read where it is rather than copied, pinned by a link
+        # so that it can't be replaced under us while we work, and checked afterwards for changes (see PinnedFile)
+        with metrics.stage('pin_existing'):
+            pinned = PinnedFile(existing_file, filename_out.replace('L2_', '.L2_'))
+        temp_name = pinned.path
 
-    if temp_name:
-        # so, we have an existing file to concat with.
         # first thing to do is to make sure we're not trying to include files that have already been
         # concatenated into the exiting concat file. This is done by pulling back the file list from the
         # history section and comparing that with the list of filenames from the source area (arrivals for
         # new files, archive for existing files that we want to concat as the back-processing)
 
-        pattern_in_dict = {}
-        already_concatted_list_to_remove = []
-        # first, get the filenames from the paths for the source files
-
-        if len(pattern_in) < 288:
-            '''
-            so, if we have less than 288 files then we'll try to pull back from the single file directory that matches here
-            '''
-
-            pattern_in = find_ingested_single_files(pattern_in)
-        for pat_in in pattern_in:
-            pattern_in_dict[re.search('(L2_([\w-]{1,})_([\w]{13}).nc)', pat_in).groups()[0]] = pat_in
-
-        log.info('doing check on history from concat file and list of new files')
-        pat_in_set = set(pattern_in_dict.keys())
-
-        # pull back list of files already added to existing file to make sure we don't add these
-        dataset = Dataset(temp_name)
-        hist_set = set(re.findall('(L2_[\w-]{1,}.nc)', dataset.history))
-        if pat_in_set - hist_set:
-            if pat_in_set & hist_set:
-                for hist_item in pat_in_set & hist_set:
-                    already_concatted_list_to_remove.append(pattern_in_dict[hist_item])
-                    print(hist_item,pattern_in_dict[hist_item])
-                    del pattern_in_dict[hist_item]
-
-            new_files_list = list(pattern_in_dict.values())
-            new_files_list.sort()
-        
-            pattern_in = [temp_name]
-            pattern_in.extend(new_files_list)
-            
-        else:
-            pattern_in = []
-        if already_concatted_list_to_remove:
-            print(already_concatted_list_to_remove)
+        with metrics.stage('new_files'):
+            new_files_list = get_new_files(pattern_in, temp_name)
+        if not new_files_list:
+            pinned.release()
+            log.info(f'-> nothing new to add to {existing_file}')
+            metrics.status = 'nothing_new'
+            return metrics.record()
+
+        pattern_in = [temp_name]
+        pattern_in.extend(new_files_list)
+
+    # the files being added, not the existing daily file: where that can't be pinned by a link it is read in place
+    # in readyToIngest or the archive, and must never be taken for a source file and deleted
+    source_files = [fn for fn in pattern_in if fn != temp_name]
+
+    metrics.read_files(pattern_in)
+
     try:
         log.info(f'now moving to do concat file.... of {len(pattern_in)} new files')
-        if pattern_in:
+        if pattern_in and engine == 'netcdf4':
+            with metrics.stage('concat_netcdf4'):
+                concat_netcdf4(pattern_in, temp_filename_out, os.path.basename(__file__), existing_file=temp_name,
+                               time_as_limited_dim=time_as_limited_dim and not append_in_place,
+                               slot_seconds=slot_seconds, encoding_profile=encoding_profile, harvest=harvest)
+
+        elif pattern_in:
             #if 'block-07' in pattern_in[0]:
             #    import pdb;pdb.set_trace()
-            with xr.open_mfdataset(pattern_in, concat_dim="time", combine='nested', data_vars='minimal',
-                                   coords='minimal',
-                                   compat='override', 
-                                   join='override') as ds:  # for working with xr version 0.10.2 installed on JASMIN
-                if 'block-06' in pattern_in[0]:
-                    print(pattern_in)
-                # if time_as_first_dim: #now handled by setting time dim to limited (unlimited dim must be first for OpenDAP)
-                #     ds = ds.transpose('time','altitude','layer')
-
-                # make observations unique for each time step preferring new arrivals
-                _, ind_rev = np.unique(ds['time'][::-1],
-                                       return_index=True)  # run on reversed time to keep last (new file, as pre-existing concat file is first in row)
-                ind = -ind_rev - 1  # flip indices
-                ds2 = ds.isel(
-                    time=ind)  # choose only unique obs times. will result in an ordered time sequence at the same time
-
-                # update file history
-
-                if 'history' in ds2.attrs:
-                    file_hist = ds2.attrs['history'] + ' \n'
-                else:
-                    file_hist = ''
-                file_hist_entry = datetime.datetime.now().strftime('%Y%m%dT%H:%M:%S')
-                if 'concatenated by' not in file_hist:
-                    lead_file_hist = f'{file_hist_entry}: concatenated by {os.path.basename(__file__)} from: '
-                else:
-                    lead_file_hist = f'{file_hist_entry}: additional files added to concatenated file by {os.path.basename(__file__)}: '
-
-                contrib = []
-                #pattern_in.sort()
-                for fn in pattern_in:
-
-                    if fn != temp_name:
-                        base_name = os.path.basename(fn)
-                        if base_name not in file_hist:
-                            contrib.append(os.path.split(fn)[1])
-
-                if contrib:
-                    file_hist += f"{lead_file_hist} {', '.join(contrib)}"
-                ds2.attrs['history'] = file_hist
-
-                # update file commments
-
-                file_comments = ''
-                if 'comment' in ds2.attrs:
-                    if ds2.attrs['comment']:
-                        file_comments = ds2.attrs['comment'] + ' \n'
-
-                contrib = []
-                for fn in pattern_in:
-                    if fn != temp_name:
-                        source_file = Dataset(fn)
-                        if source_file.comment:
-                            base_name = os.path.basename(fn)
-                            contrib.append(f"{base_name}: {source_file.comment}")
-
-                if contrib:
-                    file_comments += f"{file_comments} {'|'.join(contrib)}"
-                ds2.attrs['comment'] = file_comments
-
-                ds2.time.attrs['long_name'] = "End time (UTC) of the measurement"
-                ds2.time.encoding['units'] = 'days since 1970-01-01 00:00:00.000'
-                ds2.start_time.encoding['units'] = 'days since 1970-01-01 00:00:00.000'
-
-                # switch the quality_flag to int32 from int64
-
-                v = ds2['quality_flag']
-
-                new_qf = v.astype("int32")
-
-                ds2['quality_flag'] = new_qf
-                ds2.quality_flag.attrs[
-                    'comments'] = f"{ds2.quality_flag.attrs['comments']}.\nThe invalid flag (=1) is attributed to all data >1000m above cloud base, the other points have a valid flag (=0)"
-                values = ds2['quality_flag'].flag_values
-                values_numeric = [int(v) for v in values]
-
-                ds2.quality_flag.attrs['flag_values'] = np.array(values_numeric, dtype=np.int32)
-
-                log.info('getting ready to output file')
-                # remove the XArray default of fillValues being added in:
-
-                for var in ds2.variables:
-
-                    if '_FillValue' not in ds2[var].encoding.keys():
-                        ds2[var].encoding['_FillValue'] = None
-                    elif np.isnan(ds2[var].encoding['_FillValue']):
-                        ds2[var].encoding['_FillValue'] = None
-
-                # save concatenated dataset
-                if time_as_limited_dim:
-                    ds2.to_netcdf(temp_filename_out, unlimited_dims=[])
-                else:
-                    ds2.to_netcdf(temp_filename_out)
+            # under a memory budget read in chunks of time steps rather than a whole file at a time, and keep
+            # fewer of the files open at once
+            time_chunk = budget_time_chunk(pattern_in[0], memory_budget_mb) if memory_budget_mb else None
+            with xr.set_options(file_cache_maxsize=alc_budget_open_files) if time_chunk else nullcontext():
+                with metrics.stage('open'):
+                    ds = xr.open_mfdataset(pattern_in, concat_dim="time", combine='nested', data_vars='minimal',
+                                           coords='minimal',
+                                           compat='override',
+                                           join='override',  # for working with xr version 0.10.2 installed on JASMIN
+                                           chunks={'time': time_chunk} if time_chunk else None,
+                                           preprocess=harvest.preprocess)
+                with ds:
+                    if 'block-06' in pattern_in[0]:
+                        print(pattern_in)
+                    # if time_as_first_dim: #now handled by setting time dim to limited (unlimited dim must be first for OpenDAP)
+                    #     ds = ds.transpose('time','altitude','layer')
+
+                    # make observations unique for each time step preferring new arrivals. The existing concat file
+                    # and each new file are in time order already, so these runs are merged (see merge_runs) rather
+                    # than sorting the whole time axis
+                    with metrics.stage('dedup'):
+                        ranges = merge_runs(ds['time'].values)
+                        if len(ranges) == 1:
+                            ind = slice(*ranges[0])  # already in order with no repeats, so no copy needed
+                        else:
+                            ind = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+                        ds2 = ds.isel(time=ind)
+                        if time_chunk:
+                            # merge the small per file chunks so the write goes a budget sized chunk at a time, sized
+                            # again now the open files are taking up memory
+                            time_chunk = min(time_chunk, budget_time_chunk(pattern_in[0], memory_budget_mb))
+                            ds2 = ds2.chunk({'time': time_chunk})
+
+                    # update file history
+
+                    update_provenance(ds2.attrs, source_files, os.path.basename(__file__))
+
+                    # update file commments
+
+                    with metrics.stage('comments'):
+                        ds2.attrs['comment'] = update_comment(ds2.attrs.get('comment', ''),
+                                                              harvest.comments(source_files))
+
+                    ds2.time.attrs['long_name'] = "End time (UTC) of the measurement"
+                    ds2.time.encoding['units'] = 'days since 1970-01-01 00:00:00.000'
+                    ds2.start_time.encoding['units'] = 'days since 1970-01-01 00:00:00.000'
+
+                    # switch the quality_flag to int32 from int64
+
+                    v = ds2['quality_flag']
+
+                    new_qf = v.astype("int32")
+
+                    ds2['quality_flag'] = new_qf
+                    ds2.quality_flag.attrs[
+                        'comments'] = f"{ds2.quality_flag.attrs['comments']}.\nThe invalid flag (=1) is attributed to all data >1000m above cloud base, the other points have a valid flag (=0)"
+                    values = ds2['quality_flag'].flag_values
+                    values_numeric = [int(v) for v in values]
+
+                    ds2.quality_flag.attrs['flag_values'] = np.array(values_numeric, dtype=np.int32)
+
+                    log.info('getting ready to output file')
+                    # remove the XArray default of fillValues being added in:
+
+                    for var in ds2.variables:
+
+                        if '_FillValue' not in ds2[var].encoding.keys():
+                            ds2[var].encoding['_FillValue'] = None
+                        elif np.isnan(ds2[var].encoding['_FillValue']):
+                            ds2[var].encoding['_FillValue'] = None
+
+                        # chunking and compression from the encoding profile, replacing any from the source files
+                        var_encoding = variable_encoding(encoding_profile, ds2[var].dims, ds2[var].shape, ds2[var].dtype)
+                        if var_encoding:
+                            for key in ('chunksizes', 'original_shape', 'zlib', 'complevel', 'shuffle', 'contiguous'):
+                                ds2[var].encoding.pop(key, None)
+                            ds2[var].encoding.update(var_encoding)
+
+                    # save concatenated dataset
+                    # the synchronous scheduler computes and writes one chunk at a time, where threads would each
+                    # hold chunks in memory
+                    with metrics.stage('write'), \
+                            dask.config.set(scheduler='synchronous') if time_chunk else nullcontext():
+                        if append_in_place:
+                            # keep time unlimited so that the next run can append to the file
+                            ds2.to_netcdf(temp_filename_out, unlimited_dims=['time'])
+                        elif time_as_limited_dim:
+                            ds2.to_netcdf(temp_filename_out, unlimited_dims=[])
+                        else:
+                            ds2.to_netcdf(temp_filename_out)
 
     except RuntimeError as e:
         log.error(f"{e}: {[pattern_in]}")
         raise
     except ValueError as e:
         log.error(f"{e}: {[pattern_in]}")
-        return
+        metrics.status = 'failed'
+        return metrics.record()
     except:
         raise
     else:
         if pattern_in:
 
-            ds.close()
+            if 'ds' in locals():
+                ds.close()
             if 'ds2' in locals():
                 ds2.close()
+            if pinned and pinned.changed():
+                os.remove(temp_filename_out)
+                raise RuntimeError(f'{existing_file} changed while it was being read, to be tried again')
             os.rename(temp_filename_out, filename_out)
-        if temp_name:
-            os.remove(temp_name)
+            metrics.wrote_file(filename_out)
+            refresh_station_cache(harvest, source_files)
+            if memory_budget_mb:
+                peak_mb = peak_rss_bytes() / 2**20
+                log.info(f'{filename_out}: peak memory {peak_mb:.0f} MB of a {memory_budget_mb} MB budget')
+                if peak_mb > memory_budget_mb:
+                    log.warning(f'{filename_out}: peak memory {peak_mb:.0f} MB over the budget of '
+                                f'{memory_budget_mb} MB')
+    finally:
+        if pinned:
+            pinned.release()
 
     # delete original short files after they have been concatenated to daily file
 
     # TODO: Need to incorporate arrivals deleter in here or archive remove function when back processing
 
     if delete_after_concat and os.path.isfile(filename_out):
-        log.info('removing all files matching %s' % (pattern_in))
-        
-        # remove files
-        if deleterchoice in ['arrivals', 'notArrivals']:
-            for file_to_remove in pattern_in:
-                if os.path.exists(file_to_remove) and file_to_remove != filename_out :
-
-                    log.debug('Removing %r', file_to_remove)
-
-                    if deleterchoice == 'arrivals':
-                        AD.delete(file_to_remove)
-                    elif deleterchoice == 'notArrivals':
-
-                        os.remove(file_to_remove)
-                
+        with metrics.stage('delete_sources'):
+            remove_source_files(source_files, filename_out, deleterchoice)
 
     log.info(f'-> done with {filename_out}')
+    return metrics.record()
 
 
 def instrument_file_grouper(file_list):
@@ -483,24 +794,222 @@ def instrument_file_grouper(file_list):
     First need to split up elegable files for ingestion by instrument and then into the day so that we're going to concat files into
     the right parent file. We do this by parsing each file and getting the wigos ID and storing in a dictionary
     """
-    wigos_regex = 'L2_(?P<wigos>[a-zA-Z0-9\-]*)_(?P<date_prefix>\w{1})(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})(\d{4})\.nc'
     dict_to_return = {}
-    for file_to_parse in file_list:
+    for (instrument, date), records in group_by_instrument_day(parse_l2_filenames(file_list, daily=False)).items():
+        dict_to_return.setdefault(instrument, {})[date] = [record.path for record in records]
+
+    return dict_to_return
+
 
-        wigos_bits = re.search(wigos_regex, file_to_parse).groupdict()
+def concat_task(files_to_concat, filename_out, concat_kwargs):
+    '''
+    run concat_single_inst for one instrument-day, in a worker process or in the main one. The daily file is locked
+    (see DailyFileLock) so that it is never written by two processes at once, including from an overlapping run of
+    this script
+
+    :return: (filename_out, status, seconds taken, error message, metrics record) where status is 'done', 'locked'
+             or 'failed' and the metrics record is None unless concat_kwargs has collect_metrics
+    '''
+    log = logging.getLogger(__name__)
+    start = time.time()
 
-        wigos_id = wigos_bits['wigos'] + '_' + wigos_bits['date_prefix']
-        date = wigos_bits['year'] + wigos_bits['month'] + wigos_bits['day']
-        if wigos_id in dict_to_return:
-            if date in dict_to_return[wigos_id]:
-                dict_to_return[wigos_id][date].append(file_to_parse)
-            else:
-                dict_to_return[wigos_id][date] = [file_to_parse]
+    def unfinished_record(status):
+        if not concat_kwargs.get('collect_metrics'):
+            return None
+        metrics = StageMetrics(filename_out, engine=concat_kwargs.get('engine', 'xarray'),
+                               append_in_place=concat_kwargs.get('append_in_place', False))
+        metrics.status = status
+        return metrics.record()
+
+    lock = DailyFileLock(filename_out)
+    if not lock.acquire():
+        return filename_out, 'locked', time.time() - start, '', unfinished_record('locked')
+
+    try:
+        record = concat_single_inst(files_to_concat, filename_out, **concat_kwargs)
+    except Exception as e:
+        log.exception(f'concat failed for {filename_out}')
+        return filename_out, 'failed', time.time() - start, f'{type(e).__name__}: {e}', unfinished_record('failed')
+    finally:
+        lock.release()
+
+    return filename_out, 'done', time.time() - start, '', record
+
+
+def concat_pool(jobs):
+    '''
+    pool of worker processes for concatenation. The workers are started by a clean server process rather than
+    forked from this one, as forking a process that has run xarray and dask, with their threads and locks, can leave
+    a worker deadlocked
+
+    :param jobs: number of worker processes
+    :return: ProcessPoolExecutor
+    '''
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('forkserver'))
 
+
+def run_parallel_concat(concat_tasks, concat_kwargs, jobs, records=None, pool=None):
+    '''
+    concatenate independent instrument-days in a pool of worker processes, or one after the other in this process
+    if jobs is 1, logging how each one finished
+
+    :param concat_tasks: dict of filename_out: list of files to concatenate into it
+    :param concat_kwargs: keyword arguments for concat_single_inst
+    :param jobs: number of worker processes
+    :param records: list to add the metrics record of each instrument-day to, if collecting metrics
+    :param pool: pool to reuse (see concat_pool), e.g. between runs of a long running process, rather than start one
+    :return: dict of status: list of output files
+    '''
+    log = logging.getLogger(__name__)
+    log.info(f'concatenating {len(concat_tasks)} instrument-days with {jobs} processes')
+
+    def results():
+        if jobs <= 1 and pool is None:
+            for filename_out, files_to_concat in concat_tasks.items():
+                yield concat_task(files_to_concat, filename_out, concat_kwargs)
+            return
+
+        with concat_pool(jobs) if pool is None else nullcontext(pool) as executor:
+            futures = [executor.submit(concat_task, files_to_concat, filename_out, concat_kwargs)
+                       for filename_out, files_to_concat in concat_tasks.items()]
+            for future in as_completed(futures):
+                yield future.result()
+
+    finished = {'done': [], 'locked': [], 'failed': []}
+    for filename_out, status, seconds, message, record in results():
+        finished[status].append(filename_out)
+        if records is not None and record:
+            records.append(record)
+        if status == 'failed':
+            log.error(f'{filename_out}: failed after {seconds:.1f} s: {message}')
+        elif status == 'locked':
+            log.warning(f'{filename_out}: skipped, being written by another process')
         else:
-            dict_to_return[wigos_id] = {date: [file_to_parse]}
+            log.info(f'{filename_out}: done in {seconds:.1f} s')
 
-    return dict_to_return
+    log.info(', '.join(f'{len(files)} {status}' for status, files in finished.items()))
+
+    if finished['failed']:
+        raise RuntimeError(f"concatenation failed for {len(finished['failed'])} instrument-days: {finished['failed']}")
+
+    return finished
+
+
+def concat_settings(config):
+    '''
+    read the concatenation settings from the stream config, and point the station cache and archive catalogue at
+    the files set there
+
+    :return: (keyword arguments for concat_single_inst, number of jobs, metrics JSON lines file, metrics
+             Prometheus textfile)
+    '''
+    # append new files to the daily files in quarantine rather than rewriting them each run
+    append_in_place = bool(config.getint('append_in_place', default=0))
+
+    # concatenation engine: 'xarray' (default) or 'netcdf4'
+    if 'concat_engine' in config.options():
+        engine = config['concat_engine']
+    else:
+        engine = 'xarray'
+
+    # slot spacing in seconds for the fixed daily time grid used by the netcdf4 engine, 0 to sort instead. Configs
+    # from before slot_seconds may give it in minutes as slot_minutes
+    if 'slot_seconds' in config.options():
+        slot_seconds = float(config['slot_seconds']) or None
+    elif 'slot_minutes' in config.options():
+        slot_seconds = float(config['slot_minutes']) * 60 or None
+    else:
+        slot_seconds = None
+
+    # chunking and compression of the daily files, see eprofile_concat_engines.ENCODING_PROFILES
+    if 'encoding_profile' in config.options():
+        encoding_profile = config['encoding_profile']
+    else:
+        encoding_profile = None
+    if encoding_profile and encoding_profile not in ENCODING_PROFILES:
+        raise ValueError(f"unknown encoding_profile {encoding_profile}, choose from {', '.join(ENCODING_PROFILES)}")
+
+    # number of instrument-days to concatenate in parallel
+    jobs = config.getint('jobs', default=1)
+
+    # maximum resident memory in MB of each process concatenating with xarray, 0 for no limit
+    memory_budget_mb = config.getint('memory_budget_mb', default=0) or None
+
+    # stage timings of each instrument-day, as JSON lines appended to a file and/or a Prometheus textfile
+    metrics_jsonl = config['metrics_jsonl'] if 'metrics_jsonl' in config.options() else ''
+    metrics_prometheus = config['metrics_prometheus'] if 'metrics_prometheus' in config.options() else ''
+
+    # SQLite file caching the station details used for archive paths, '' to read them from every file
+    if 'station_cache' in config.options():
+        STATION_CACHE.cache_file = config['station_cache']
+
+    # SQLite catalogue of the archive (see eprofile_archive_catalogue), '' to look in the archive directly
+    if 'archive_catalogue' in config.options():
+        ARCHIVE_CATALOGUE.cache_file = config['archive_catalogue']
+
+    concat_kwargs = dict(delete_after_concat=True, ignore_previous_concat=False, time_as_limited_dim=True,
+                         deleterchoice=config.deleterchoice, append_in_place=append_in_place, engine=engine,
+                         slot_seconds=slot_seconds, encoding_profile=encoding_profile,
+                         collect_metrics=bool(metrics_jsonl or metrics_prometheus), memory_budget_mb=memory_budget_mb)
+
+    return concat_kwargs, jobs, metrics_jsonl, metrics_prometheus
+
+
+def check_arrivals(file_list, config):
+    '''
+    check the files first so that a truncated or corrupt file is left out, rather than failing its whole day.
+    check_variables also opens each file to check it has the variables needed, and bad files are moved into
+    bad_file_dir if that is set
+
+    :return: the files that passed
+    '''
+    if config.getint('integrity_check', default=1):
+        required_variables = L2_REQUIRED_VARIABLES if config.getint('check_variables', default=0) else ()
+        bad_files = validate_files(file_list, required_variables=required_variables)
+        if bad_files:
+            if 'bad_file_dir' in config.options():
+                quarantine_files(bad_files, config['bad_file_dir'])
+            file_list = [fn for fn in file_list if fn not in bad_files]
+    return file_list
+
+
+def plan_concat_tasks(file_list):
+    '''
+    split the files up by instrument and day
+
+    :return: dict of daily file in the quarantine area: list of files to concatenate into it
+    '''
+    log = logging.getLogger(__name__)
+
+    files_to_concat_by_instrument_day = group_by_instrument_day(parse_l2_filenames(file_list, daily=False))
+
+    # one task per output file, so only one process ever writes to a given daily file
+    concat_tasks = {}
+    for (instrument, date), records_to_concat in files_to_concat_by_instrument_day.items():
+        files_to_concat = [record.path for record in records_to_concat]
+        block = records_to_concat[0].block
+
+        log.debug(f'{files_to_concat}')
+        filename_out = os.path.join(PROCESSING_DIR, block, ''.join(['L2_', instrument, date, '.nc']))
+        log.info(f'{filename_out}, {files_to_concat}')
+
+        concat_tasks.setdefault(filename_out, []).extend(files_to_concat)
+
+    return concat_tasks
+
+
+def run_concat_tasks(concat_tasks, concat_kwargs, jobs, metrics_jsonl='', metrics_prometheus='', run_labels=None,
+                     pool=None):
+    '''
+    concatenate each instrument-day, in a pool of processes if jobs > 1, and write out the metrics
+
+    :param pool: pool to reuse (see concat_pool) rather than start one
+    '''
+    records = []
+    try:
+        run_parallel_concat(concat_tasks, concat_kwargs, jobs, records, pool)
+    finally:
+        emit_metrics(records, metrics_jsonl, metrics_prometheus, run_labels=run_labels)
 
 
 # ========================== end code ===============================
@@ -527,26 +1036,21 @@ def main():
     
     log.info("Config file: %r \n Stream: %r", config.configfile, config.name)
 
+    concat_kwargs, jobs, metrics_jsonl, metrics_prometheus = concat_settings(config)
+
     arrivals = Arrivals(stream_config=config)
 
     file_list = arrivals.arrivals_files()
     log.debug(file_list)
 
-    # now we have the list of files for the block that is being processed, time to split this up into instrument lists
-
-    files_to_concat_by_instrument_dict = instrument_file_grouper(file_list)
-
-    for instrument, days_to_concat in files_to_concat_by_instrument_dict.items():
+    file_list = check_arrivals(file_list, config)
 
-        for date, files_to_concat in days_to_concat.items():
-            block = re.search('(block[\-0-9]{0,3}|misc)', files_to_concat[0]).groups()[0]
+    # now we have the list of files for the block that is being processed, time to split this up into instrument lists
 
-            log.debug(f'{files_to_concat}')
-            filename_out = os.path.join(PROCESSING_DIR, block, ''.join(['L2_', instrument, date, '.nc']))
-            log.info(f'{filename_out}, {files_to_concat}')
+    concat_tasks = plan_concat_tasks(file_list)
 
-            concat_single_inst(files_to_concat, filename_out, delete_after_concat=True,
-                               ignore_previous_concat=False, time_as_limited_dim=True, deleterchoice=config.deleterchoice)
+    run_concat_tasks(concat_tasks, concat_kwargs, jobs, metrics_jsonl, metrics_prometheus,
+                     run_labels={'stream': config.name})
 
             # file_processed = moveToIngest(file_to_ingest)
             # file_processed.remove_src_file()
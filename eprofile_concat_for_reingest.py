@@ -29,6 +29,8 @@ from time import localtime
 
 from netCDF4 import Dataset
 
+from eprofile_provenance import dataset_attrs, read_manifest, update_provenance
+
 # ingest CEDA specific tools to work witin CEDA ingestion system
 from deposit_client import DepositClient
 from arrivals_deleter import ArrivalsDeleter
@@ -312,7 +314,7 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
 
         # pull back list of files already added to existing file to make sure we don't add these
         dataset = Dataset(temp_name)
-        hist_set = set(re.findall('(L2_[\w-]{1,}.nc)', dataset.history))
+        hist_set = read_manifest(dataset_attrs(dataset))
 
         if pat_in_set - hist_set and pat_in_set & hist_set:
             for hist_item in pat_in_set & hist_set:
@@ -349,28 +351,8 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
 
                 # update file history
 
-                if 'history' in ds2.attrs:
-                    file_hist = ds2.attrs['history'] + ' \n'
-                else:
-                    file_hist = ''
-                file_hist_entry = datetime.datetime.now().strftime('%Y%m%dT%H:%M:%S')
-                if 'concatenated by' not in file_hist:
-                    lead_file_hist = f'{file_hist_entry}: concatenated by {os.path.basename(__file__)} from: '
-                else:
-                    lead_file_hist = f'{file_hist_entry}: additional files added to concatenated file by {os.path.basename(__file__)}: '
-
-                contrib = []
-                pattern_in.sort()
-                for fn in pattern_in:
-
-                    if fn != temp_name:
-                        base_name = os.path.basename(fn)
-                        if base_name not in file_hist:
-                            contrib.append(os.path.split(fn)[1])
-
-                if contrib:
-                    file_hist += f"{lead_file_hist} {', '.join(contrib)}"
-                ds2.attrs['history'] = file_hist
+                update_provenance(ds2.attrs, [fn for fn in pattern_in if fn != temp_name],
+                                  os.path.basename(__file__))
 
                 # update file commments
 
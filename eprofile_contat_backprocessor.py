@@ -17,18 +17,19 @@ import os
 import glob
 import re
 import warnings
-import datetime
 import xarray as xr
 import numpy as np
 import sys
 import getopt
 import logging
-import shutil
 from hashlib import md5
 from time import localtime
 
 from netCDF4 import Dataset
 
+from eprofile_concat_engines import concat_netcdf4, PinnedFile
+from eprofile_provenance import dataset_attrs, read_manifest, update_provenance, update_comment, HeaderHarvest
+
 # ingest CEDA specific tools to work witin CEDA ingestion system
 
 # CEDA processing area where daily concat files are held prior to ingestion after quarantine period of 48 hours
@@ -137,27 +138,31 @@ def add_prefix(filename):
     return f"{prefix}_{filename}"
 
 
-def get_eprofile_archive_path_details(inc_file):
+def get_eprofile_archive_path_details(inc_file, harvest=None):
     '''
     function to take a sample file and work out components that are used for archive destination for the data
 
     :param inc_file:
+    :param harvest: HeaderHarvest holding the header of inc_file, which is read into it if it isn't there already
     :return: inst_name_dict
     '''
+    log = logging.getLogger(__name__)
 
-    dataset = Dataset(inc_file)
+    if harvest is None:
+        harvest = HeaderHarvest()
+    header = harvest.header(inc_file)
 
     date_string = os.path.basename(inc_file).split('_')[2][1:-3]
-    ins_num = dataset.instrument_id
-    inst_type = INSTRUMENT_DICT[dataset.instrument_type]
+    ins_num = header['instrument_id']
+    inst_type = INSTRUMENT_DICT[header['instrument_type']]
 
-    loc_details = dataset.site_location.split(',')
+    loc_details = header['site_location'].split(',')
     location_name = re.sub('\_', '-', loc_details[0]).lower()
 
     if location_name == 'aberystwyth':  # correcting for incorrect setting in incoming filename
         location_name = 'capel-dewi'
 
-    title_details = dataset.title.split(' ')
+    title_details = header['title'].split(' ')
 
     ingestState = False
     try:
@@ -178,19 +183,20 @@ def get_eprofile_archive_path_details(inc_file):
     return inst_name_dict
 
 
-def find_ingested_single_files(arrivals_filelist):
+def find_ingested_single_files(arrivals_filelist, harvest=None):
     '''
     Function to take source list of files (pattern_in from arrivals area)
     and seeks to see if there are other files for the same concat run already ingested that can be incorporated
 
     :param pattern_in:
+    :param harvest: HeaderHarvest to read the header of the first file through
     :return: full_file_list
 
     '''
     log = logging.getLogger(__name__)
 
     new_files = []
-    inst_name_dict = get_eprofile_archive_path_details(arrivals_filelist[0])
+    inst_name_dict = get_eprofile_archive_path_details(arrivals_filelist[0], harvest)
 
     if inst_name_dict:
         arch_dest = '/badc/eprofile/data/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(year)s/%(month)s/%(day)s/' % inst_name_dict
@@ -225,8 +231,23 @@ def find_ingested_single_files(arrivals_filelist):
     return arrivals_filelist
 
 
+def fix_daily_metadata(global_attrs, var_attrs):
+    '''
+    attribute fixes made to back-processed daily files, for use with the netcdf4 concatenation engine
+    '''
+    # resolve mislabel of Conventions global attribute:
+    if 'Convention' in global_attrs:
+        global_attrs['Conventions'] = global_attrs.pop('Convention')
+
+    var_attrs['latitude']['units'] = 'degree_north'
+    var_attrs['longitude']['units'] = 'degree_east'
+
+    var_attrs['cloud_amount']['long_name'] = 'Cloud amount in octa'
+    var_attrs['cloud_amount']['units'] = '1'
+
+
 def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, ignore_previous_concat=False,
-                       time_as_limited_dim=True, deleterchoice='keep'):
+                       time_as_limited_dim=True, deleterchoice='keep', engine='xarray'):
     """concatenate data from NetCDF and save to concatenated file.
     If a concatentated file already exists, these data are included.
     Optional transposing to force time to first dimension
@@ -236,10 +257,16 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
     - ignore_previous_concat:
         True: previously concatenated file will be ignored and overwritten
     - time_as_limited_dim:
-        True: Store time as limited dimension in output file for compatibilty with OpenDAP"""
+        True: Store time as limited dimension in output file for compatibilty with OpenDAP
+    - engine:
+        'xarray': concatenate with xr.open_mfdataset
+        'netcdf4': concatenate straight through netCDF4 (see eprofile_concat_engines.concat_netcdf4)"""
     log = logging.getLogger(__name__)
     log.info('concatenating ' + filename_out)
 
+    # global attributes of the source files, each file read once whether for its header or its data
+    harvest = HeaderHarvest()
+
     # before we get going we're going to get a temporary output filename that we'll use for the output file whilst it is in production
     # this is to make sure we're not getting caught up with any pre-existing 1/2 baked output files by accident..
     # once we've a fully baked output file we'll rename it to the final filename we want for ingestion
@@ -247,21 +274,18 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
     temp_filename_out = os.path.join(os.path.dirname(filename_out), add_prefix(os.path.basename(filename_out)))
 
     # first pull back file from pipeline... first stop is to check the quarantine area, then the readytoingest area then the archive
-    temp_name = ''
+    existing_file = ''
 
     if os.path.exists(filename_out):
         # first, let's check the quarantine area
-        temp_name = filename_out.replace('L2_', '.L2_')
-
-        shutil.copy2(filename_out, temp_name)
+        existing_file = filename_out
 
     else:
         readyToIngest_path = filename_out.replace('quarantine', 'readyToIngest')            #starts here
         # now the 'readyToIngest' area
 
         if os.path.exists(readyToIngest_path):
-            temp_name = filename_out.replace('L2_', '.L2_')
-            shutil.copy2(readyToIngest_path, os.path.join(temp_name))
+            existing_file = readyToIngest_path
 
         # now the archive
         else:
@@ -270,7 +294,7 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
             inc_file = pattern_in[0]
             log.info(f"getting details from {inc_file} to determine target file in archive")
 
-            inst_name_dict = get_eprofile_archive_path_details(inc_file)
+            inst_name_dict = get_eprofile_archive_path_details(inc_file, harvest)
 
             if inst_name_dict:
                 arch_dest = '/badc/eprofile/data/daily_files/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(year)s' % inst_name_dict
@@ -279,11 +303,16 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
                 # finally, let's check the archive
 
                 if os.path.exists(archived_file_path):
-                    temp_name = filename_out.replace('L2_', '.L2_')
-                    shutil.copy2(archived_file_path, os.path.join(temp_name))
+                    existing_file = archived_file_path
+
+    temp_name = ''
+    pinned = None
+    if existing_file:
+        # so, we have an existing file to concat with. It is read where it is rather than copied, pinned by a link
+        # so that it can't be replaced under us while we work, and checked afterwards for changes (see PinnedFile)
+        pinned = PinnedFile(existing_file, filename_out.replace('L2_', '.L2_'))
+        temp_name = pinned.path
 
-    if temp_name:
-        # so, we have an existing file to concat with.
         # first thing to do is to make sure we're not trying to include files that have already been
         # concatenated into the exiting concat file. This is done by pulling back the file list from the
         # history section and comparing that with the list of filenames from the source area (arrivals for
@@ -298,7 +327,7 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
             so, if we have less than 288 files then we'll try to pull back from the single file directory that matches here
             '''
 
-            pattern_in = find_ingested_single_files(pattern_in)
+            pattern_in = find_ingested_single_files(pattern_in, harvest)
         for pat_in in pattern_in:
             pattern_in_dict[re.search('(L2_([\w-]{1,})_([\w]{13}).nc)', pat_in).groups()[0]] = pat_in
 
@@ -306,31 +335,40 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
         pat_in_set = set(pattern_in_dict.keys())
 
         # pull back list of files already added to existing file to make sure we don't add these
-        dataset = Dataset(temp_name)
-        hist_set = set(re.findall('(L2_[\w-]{1,}.nc)', dataset.history))
+        with Dataset(temp_name) as dataset:
+            hist_set = read_manifest(dataset_attrs(dataset))
 
-        if pat_in_set - hist_set and pat_in_set & hist_set:
-            for hist_item in pat_in_set & hist_set:
-                del pattern_in_dict[hist_item]
+        if not pat_in_set - hist_set:
+            # nothing new, so no need to remake the daily file. One already in quarantine is still passed on
+            pinned.release()
+            if existing_file == filename_out:
+                log.info(f'-> nothing new to add to {filename_out}')
+                return filename_out
+            log.info(f'-> nothing new to add to {existing_file}, skipping')
+            return None
 
-            pattern_in_source = list(pattern_in_dict.values())
-            pattern_in_source.sort()
-            #import pdb;pdb.set_trace()             #used for debugging
+        for hist_item in pat_in_set & hist_set:
+            del pattern_in_dict[hist_item]
 
-            # now stick the lists of files to concat together with the existing concat file
-            pattern_in = [temp_name].extend(pattern_in_source)
-            
+        pattern_in_source = list(pattern_in_dict.values())
+        pattern_in_source.sort()
 
-        else:
-            pattern_in = []
+        # now stick the lists of files to concat together with the existing concat file
+        pattern_in = [temp_name] + pattern_in_source
 
     try:
         log.info(f'now moving to do concat file.... of {len(pattern_in)} new files')            #next goes here
-        if pattern_in:
+        if pattern_in and engine == 'netcdf4':
+            concat_netcdf4(pattern_in, temp_filename_out, os.path.basename(__file__), existing_file=temp_name,
+                           time_as_limited_dim=time_as_limited_dim, metadata_fixes=fix_daily_metadata,
+                           harvest=harvest)
+
+        elif pattern_in:
 
             with xr.open_mfdataset(pattern_in, concat_dim="time", data_vars='minimal',
                                    coords='minimal',
-                                   compat='override') as ds:  # for working with xr version 0.10.2 installed on JASMIN
+                                   compat='override',
+                                   preprocess=harvest.preprocess) as ds:  # for working with xr version 0.10.2 installed on JASMIN
            
                 # if time_as_first_dim: #now handled by setting time dim to limited (unlimited dim must be first for OpenDAP)
                 #     ds = ds.transpose('time','altitude','layer')
@@ -348,49 +386,14 @@ def concat_single_inst(pattern_in, filename_out, delete_after_concat=False, igno
                 
                 # update file history
 
-                if 'history' in ds2.attrs:
-                    file_hist = ds2.attrs['history'] + ' \n'
-                else:
-                    file_hist = ''
-                
-                file_hist_entry = datetime.datetime.now().strftime('%Y%m%dT%H:%M:%S')
-                
-                if 'concatenated by' not in file_hist:
-                    lead_file_hist = f'{file_hist_entry}: concatenated by {os.path.basename(__file__)} from: '
-                else:
-                    lead_file_hist = f'{file_hist_entry}: additional files added to concatenated file by {os.path.basename(__file__)}: '
-
-                contrib = []
-                pattern_in.sort()
-                for fn in pattern_in:
-
-                    if fn != temp_name:
-                        base_name = os.path.basename(fn)
-                        if base_name not in file_hist:
-                            contrib.append(os.path.split(fn)[1])
-
-                if contrib:
-                    file_hist += f"{lead_file_hist} {', '.join(contrib)}"
-                ds2.attrs['history'] = file_hist
+                update_provenance(ds2.attrs, [fn for fn in pattern_in if fn != temp_name],
+                                  os.path.basename(__file__))
 
                 # update file commments
 
-                file_comments = ''
-                if 'comment' in ds2.attrs:
-                    if ds2.attrs['comment']:
-                        file_comments = ds2.attrs['comment'] + ' \n'
-
-                contrib = []
-                for fn in pattern_in:
-                    if fn != temp_name:
-                        source_file = Dataset(fn)
-                        if source_file.comment:
-                            base_name = os.path.basename(fn)
-                            contrib.append(f"{base_name}: {source_file.comment}")
-
-                if contrib:
-                    file_comments += f"{lead_file_comments} {'|'.join(contrib)}"
-                ds2.attrs['comment'] = file_comments
+                # from the headers gathered as the files were opened, rather than opening them all again
+                ds2.attrs['comment'] = update_comment(ds2.attrs.get('comment', ''),
+                                                      harvest.comments([fn for fn in pattern_in if fn != temp_name]))
 
                 ds2.time.attrs['long_name'] = "End time (UTC) of the measurement"
                 ds2.time.encoding['units'] = 'days since 1970-01-01 00:00:00.000'
@@ -440,28 +443,29 @@ The invalid flag (=1) is attributed to all data >1000m above cloud base, the oth
                     ds2.to_netcdf(temp_filename_out, unlimited_dims=[])
                 else:
                     ds2.to_netcdf(temp_filename_out)
-        else:
-            shutil.copy2(temp_name, filename_out)
-            
 
-        
     except RuntimeError as e:
         log.error(f"{e}: {[pattern_in]}")
         raise
     except ValueError as e:
         log.error(f"{e}: {[pattern_in]}")       #ends up here
-        return
+        raise
     except:
         raise
     else:
         if pattern_in:
 
-            ds.close()
+            if 'ds' in locals():
+                ds.close()
             if 'ds2' in locals():
                 ds2.close()
+            if pinned and pinned.changed():
+                os.remove(temp_filename_out)
+                raise RuntimeError(f'{existing_file} changed while it was being read, to be tried again')
             os.rename(temp_filename_out, filename_out)
-        if temp_name:
-            os.remove(temp_name)
+    finally:
+        if pinned:
+            pinned.release()
     log.info(f'-> done with {filename_out}')
     return filename_out
 
@@ -496,6 +500,7 @@ def moveToIngest(file_to_ingest):
     if os.path.exists(file_to_ingest):
         os.chmod(file_to_ingest,0o660)
         os.rename(file_to_ingest,dst)
+        return dst
     
     
 
@@ -503,7 +508,7 @@ def moveToIngest(file_to_ingest):
 
 # ========================= execution ===============================
 
-def main(start_dir, verbose = 2):
+def main(start_dir, verbose = 2, engine = 'xarray'):
     """
     Ingests the files.
     """
@@ -520,15 +525,26 @@ def main(start_dir, verbose = 2):
 
     log = logging.getLogger(__name__)
     logging.info('Running in verbose mode')
-    
-    
+
+    backprocess_dir(start_dir, engine)
+
+
+def backprocess_dir(start_dir, engine='xarray'):
+    """
+    concatenate the single files of one directory (an instrument-day of the archive) and move the daily file on
+    to the arrivals
+
+    :param start_dir: directory of single files
+    :param engine: concatenation engine
+    :return: path of the daily file in the arrivals, None if there was nothing new to concatenate
+    """
+    log = logging.getLogger(__name__)
+
     files_to_concat = glob.glob(os.path.join(start_dir,'L2*.nc'))
     log.debug(files_to_concat)
 
     # now we have the list of files for the block that is being processed, time to split this up into instrument lists
 
-    
-    
     if files_to_concat:
         log.debug(f'{files_to_concat}')
 
@@ -536,16 +552,13 @@ def main(start_dir, verbose = 2):
 
         filename_out = os.path.join(PROCESSING_DIR, file_out)
         log.info(f'{filename_out}, {files_to_concat}')
-        
-        
 
         file_to_ingest = concat_single_inst(files_to_concat, filename_out, delete_after_concat=False,
-                               ignore_previous_concat=False, time_as_limited_dim=True)
-
-#file_to_ingest sometimes is returned as a None type (something to do with date created)
+                               ignore_previous_concat=False, time_as_limited_dim=True, engine=engine)
 
-        file_processed = moveToIngest(file_to_ingest)
-            
+        # file_to_ingest is None when there was nothing new to add to an existing daily file
+        if file_to_ingest:
+            return moveToIngest(file_to_ingest)
 
 
 if __name__ == "__main__":
@@ -553,12 +566,14 @@ if __name__ == "__main__":
     arg_list = sys.argv[1:]
 
     try:
-        opts, args = getopt.getopt(arg_list, "vt:p:")
+        opts, args = getopt.getopt(arg_list, "vt:p:e:")
 
 
         """
         v = verbose
         t = test only - works on just a sample set
+        p = directory of single files to concatenate
+        e = concatenation engine: xarray (default) or netcdf4
         """
     except getopt.GetoptError as ex:
         print('woops - problem with trying to call the script')
@@ -570,6 +585,7 @@ if __name__ == "__main__":
     
     verbose = 0
     test_run = 0
+    engine = 'xarray'
    
     log = logging.getLogger(__name__)
 
@@ -583,6 +599,8 @@ if __name__ == "__main__":
             print('will run test for %s new instruments'% test_run)
         elif "-p" in opt:
             start_dir = argu
+        elif "-e" in opt:
+            engine = argu
         
         # make a logger for this process
         if verbose:
@@ -593,4 +611,4 @@ if __name__ == "__main__":
         log.info('Running in verbose mode')
     print(start_dir, os.path.exists(start_dir))
     if start_dir and os.path.exists(start_dir):
-        main(start_dir,verbose)
+        main(start_dir,verbose,engine)
@@ -0,0 +1,104 @@
+"""
+Batch versions of the state changes in eprofile_database_functions, for scripts that move many files at once.
+
+eprofile_database_functions makes a state change with a round trip per file id. These make the same change for a
+list of ids with one UPDATE ... WHERE id IN (...) per transition, all inside one transaction, so a run either
+records all of its state changes or none of them.
+
+"""
+
+import datetime
+import logging
+
+import sqlalchemy as db
+
+# the states files go through that the batch changes touch, as held in process_state
+AGGREGATED = 'aggregated'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+# how long a file waits before it is tried again after a failed run
+RETRY_DELAY = datetime.timedelta(hours=1)
+
+# ids per IN (...) list, well inside the bound parameter limits of SQLite and PostgreSQL
+BATCH_SIZE = 500
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def change_state_many(conn, tab, ids):
+    '''
+    Move aggregated files on to delivered, as change_state does for one file.
+
+    :param conn: connection, in a transaction
+    :param tab: file table
+    :param ids: file ids
+    :return: number of files moved on
+    '''
+    count = 0
+    for chunk in _chunks(ids):
+        result = conn.execute(db.update(tab).where(tab.c.id.in_(chunk)).where(tab.c.process_state == AGGREGATED)
+                              .values(process_state=DELIVERED))
+        count += result.rowcount
+    return count
+
+
+def next_run_many(conn, tab2, ids, now=None):
+    '''
+    Count a run against files and put off their next one by RETRY_DELAY, as next_run does for one file.
+
+    :param conn: connection, in a transaction
+    :param tab2: table holding the run counts (other_table), keyed by log_id
+    :param ids: file ids
+    :param now: time of the run, naive UTC as held in when_ran_next, defaults to now
+    :return: number of files put off
+    '''
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    count = 0
+    for chunk in _chunks(ids):
+        result = conn.execute(db.update(tab2).where(tab2.c.log_id.in_(chunk))
+                              .values(times_ran=tab2.c.times_ran + 1, when_ran_next=now + RETRY_DELAY))
+        count += result.rowcount
+    return count
+
+
+def failed_file_many(conn, tab, ids):
+    '''
+    Mark files as failed, as failed_file does for one file.
+
+    :param conn: connection, in a transaction
+    :param tab: file table
+    :param ids: file ids
+    :return: number of files marked failed
+    '''
+    count = 0
+    for chunk in _chunks(ids):
+        result = conn.execute(db.update(tab).where(tab.c.id.in_(chunk)).values(process_state=FAILED))
+        count += result.rowcount
+    return count
+
+
+def apply_transitions_many(conn, tab, tab2, delivered=(), retry=(), failed=()):
+    '''
+    Make the state changes of a run in one transaction, on the connection the run has already checked out so that
+    it also works with a pool of one.
+
+    :param conn: connection, not in a transaction
+    :param tab: file table
+    :param tab2: table holding the run counts (other_table)
+    :param delivered: ids of files sent on
+    :param retry: ids of files to be tried again later
+    :param failed: ids of files that failed
+    :return: numbers of files delivered, put off and failed
+    '''
+    log = logging.getLogger(__name__)
+    with conn.begin():
+        counts = (change_state_many(conn, tab, delivered), next_run_many(conn, tab2, retry),
+                  failed_file_many(conn, tab, failed))
+    log.info(f'{counts[0]} delivered, {counts[1]} put off, {counts[2]} failed')
+    return counts
@@ -0,0 +1,96 @@
+"""
+Parsing of E-PROFILE L2 filenames, shared by the concat and ingest scripts.
+
+5-minute files are named L2_<wigos id>_<instrument letter><YYYYMMDDHHMM>.nc and daily files
+L2_<wigos id>_<instrument letter><YYYYMMDD>.nc. Each path is parsed once into an L2File record, a tuple whose
+string fields are interned, so that arrivals lists of millions of paths can be grouped and sorted without holding
+a dict per file.
+
+"""
+
+import os
+import re
+import sys
+import datetime
+import logging
+from collections import namedtuple
+
+L2_FILENAME_REGEX = re.compile(r'^L2_(?P<wigos>[\w-]+?)_(?P<prefix>\w)(?P<date>\d{8})(?P<hhmm>\d{4})?\.nc$')
+
+# arrivals block in a path, e.g. block-03
+BLOCK_REGEX = re.compile(r'(block[\-0-9]{0,3}|misc)')
+
+
+class L2File(namedtuple('L2File', 'wigos prefix date hhmm block path')):
+    '''
+    parsed L2 filename. Fields are strings: date is YYYYMMDD, hhmm is '' for a daily file and block is '' where
+    the path has no arrivals block. Records sort by instrument, day and time of day.
+    '''
+    __slots__ = ()
+
+    @property
+    def instrument(self):
+        '''
+        wigos id and instrument letter, e.g. '0-20000-0-06610_A'
+        '''
+        return f'{self.wigos}_{self.prefix}'
+
+    @property
+    def day(self):
+        return datetime.date(int(self.date[:4]), int(self.date[4:6]), int(self.date[6:]))
+
+    @property
+    def is_daily(self):
+        return not self.hhmm
+
+    @property
+    def basename(self):
+        return os.path.basename(self.path)
+
+
+def parse_l2_filename(path):
+    '''
+    :param path: path or basename of an L2 or daily file
+    :return: L2File, None if the name is not that of an L2 file
+    '''
+    match = L2_FILENAME_REGEX.match(os.path.basename(path))
+    if not match:
+        return None
+    wigos, prefix, date, hhmm = match.groups()
+    block = BLOCK_REGEX.search(path)
+    return L2File(sys.intern(wigos), sys.intern(prefix), sys.intern(date), sys.intern(hhmm or ''),
+                  sys.intern(block.group(1)) if block else '', path)
+
+
+def parse_l2_filenames(paths, daily=None):
+    '''
+    parse a list of paths, logging and leaving out any that are not L2 files
+
+    :param paths: iterable of paths
+    :param daily: True to keep only daily files, False to keep only 5-minute files, None for both
+    :return: list of L2File
+    '''
+    log = logging.getLogger(__name__)
+
+    records = []
+    for path in paths:
+        record = parse_l2_filename(path)
+        if not record:
+            log.warning(f"{path} doesn't look like an L2 file")
+        elif daily is None or record.is_daily == daily:
+            records.append(record)
+    return records
+
+
+def group_by_instrument_day(records):
+    '''
+    group parsed files by instrument and day, each group in time order
+
+    :param records: iterable of L2File
+    :return: dict of (instrument, date): list of L2File
+    '''
+    groups = {}
+    for record in records:
+        groups.setdefault((record.wigos, record.prefix, record.date), []).append(record)
+
+    return {(f'{wigos}_{prefix}', date): sorted(group) for (wigos, prefix, date), group in sorted(groups.items())}
@@ -1,12 +1,16 @@
 import os
 import re
 import sys
+import time
 import getopt
 import glob
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from netCDF4 import Dataset
 from ingest_lib import ArrivalsDeleter, Arrivals, StreamConfig, DepositClient, ArchiveClientError
+from eprofile_archive_catalogue import ARCHIVE_CATALOGUE
 AD = ArrivalsDeleter()
 DC = DepositClient()
 
@@ -57,27 +61,35 @@ operatorDict = {'AEMET' : 'aemet',
                     'Valencia-University': 'valentia-university',
                     'ZAMG' : 'zamg'
                     }
+# seconds between progress reports in the asyncio ingest mode
+PROGRESS_INTERVAL = 30
+
+
 class moveToIngest():
     
-    def __init__(self, inc_file, stream_options):
+    def __init__(self, inc_file, stream_options, deposit_now=True):
     
         self.src_file = inc_file
         self.log = logging.getLogger(__name__)
         self.stream_options = stream_options
-        dataset = Dataset(inc_file)
+        self.arch_dest = None
+        with Dataset(inc_file) as dataset:
+            ins_num = dataset.instrument_id
+            instrument_type = dataset.instrument_type
+            site_location = dataset.site_location
+            title = dataset.title
 
         date_string = os.path.basename(inc_file).split('_')[2][1:-3]
-        ins_num = dataset.instrument_id
 
-        inst_type = instDict[dataset.instrument_type]
+        inst_type = instDict[instrument_type]
 
-        loc_details = dataset.site_location.split(',')
+        loc_details = site_location.split(',')
         location_name = re.sub('\_','-',loc_details[0]).lower()
         
         if location_name == 'aberystwyth':  #correcting for incorrect setting in incoming filename
             location_name = 'capel-dewi'
 
-        title_details = dataset.title.split(' ')
+        title_details = title.split(' ')
 
         self.log.info(inc_file)
         self.ingestState = False
@@ -99,35 +111,108 @@ class moveToIngest():
         else:
             #new_filename = '%(operator)s-%(instrument_type)s_%(location)s_%(datetime)s_%(inst_id)s.nc'% inst_name_dict
             
-            arch_dest = '/badc/eprofile/data/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(yyyy)s/%(mm)s/%(dd)s/'% inst_name_dict
+            self.arch_dest = '/badc/eprofile/data/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(yyyy)s/%(mm)s/%(dd)s/'% inst_name_dict
 
-            self.log.debug(os.path.join(arch_dest,os.path.basename(inc_file)))
-            reTry = 0
-            
+            self.log.debug(os.path.join(self.arch_dest,os.path.basename(inc_file)))
 
-            while reTry < 3 and not self.ingestState:
-                try:
-                    if not os.path.exists(arch_dest):
-                        self.log.debug("Make new directory: %r" % arch_dest) 
+            if deposit_now:
+                self.deposit()
 
-                        DC.makedirs(arch_dest)
+    def deposit(self):
+        '''
+        deposit the file into the archive, trying up to three times
+        '''
+        if self.arch_dest is None:
+            return
+        arch_dest = self.arch_dest
+        inc_file = self.src_file
+        reTry = 0
 
+        while reTry < 3 and not self.ingestState:
+            try:
+                if not os.path.exists(arch_dest):
+                    self.log.debug("Make new directory: %r" % arch_dest)
 
-                    DC.deposit(inc_file,os.path.join(arch_dest, os.path.basename(inc_file)), force=True)
-                except ArchiveClientError as client_error:
-                    reTry += 1
-                    if reTry == 3:
-                        self.log.error(client_error)
+                    DC.makedirs(arch_dest)
 
-                else:
-                    self.ingestState = True
+
+                DC.deposit(inc_file,os.path.join(arch_dest, os.path.basename(inc_file)), force=True)
+            except ArchiveClientError as client_error:
+                reTry += 1
+                if reTry == 3:
+                    self.log.error(client_error)
+
+            else:
+                self.ingestState = True
+                ARCHIVE_CATALOGUE.add(os.path.join(arch_dest, os.path.basename(inc_file)),
+                                      os.stat(inc_file).st_size)
             
     def remove_src_file(self):
         if self.ingestState and self.stream_options['deleterchoice'] in ['arrivals','notArrivals']:
             self.log.debug('Removing %r', self.src_file)
            
             AD.delete(self.src_file)
-        
+
+
+async def ingest_async(file_list, stream_options, concurrency):
+    '''
+    ingest files with asyncio: headers are read in a thread of their own (netCDF and HDF5 calls aren't thread
+    safe) while deposits and deletes run in a pool of concurrency threads, so up to that many round trips to the
+    archive are in flight at once. Progress and throughput are logged every PROGRESS_INTERVAL seconds
+
+    :param file_list: files to ingest
+    :param stream_options: stream config
+    :param concurrency: number of files in progress at once
+    :return: number of files deposited
+    '''
+    log = logging.getLogger(__name__)
+    loop = asyncio.get_running_loop()
+
+    queue = asyncio.Queue()
+    for file_to_ingest in file_list:
+        queue.put_nowait(file_to_ingest)
+
+    progress = {'done': 0, 'deposited': 0, 'failed': 0}
+    start = last_report = time.perf_counter()
+
+    def report():
+        seconds = time.perf_counter() - start
+        log.info(f"{progress['done']}/{len(file_list)} files, {progress['deposited']} deposited, "
+                 f"{progress['failed']} failed, {progress['done'] / max(seconds, 1e-6):.1f} files/s")
+
+    with ThreadPoolExecutor(max_workers=1) as header_pool, \
+            ThreadPoolExecutor(max_workers=concurrency) as deposit_pool:
+
+        async def worker():
+            nonlocal last_report
+            while not queue.empty():
+                file_to_ingest = queue.get_nowait()
+                log.debug(file_to_ingest)
+                try:
+                    file_processed = await loop.run_in_executor(header_pool, moveToIngest, file_to_ingest,
+                                                                stream_options, False)
+                    await loop.run_in_executor(deposit_pool, file_processed.deposit)
+                    await loop.run_in_executor(deposit_pool, file_processed.remove_src_file)
+                except Exception:
+                    log.exception(f'ingest failed for {file_to_ingest}')
+                    progress['failed'] += 1
+                else:
+                    if file_processed.ingestState:
+                        progress['deposited'] += 1
+                progress['done'] += 1
+
+                if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.perf_counter()
+                    report()
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    report()
+    if progress['failed']:
+        raise RuntimeError(f"ingest failed for {progress['failed']} files")
+
+    return progress['deposited']
+
 
 def main(argList):
     """
@@ -136,9 +221,10 @@ def main(argList):
     
     #first check to see if ingest area exists and if not create the folders    
     verbose = 0
+    concurrency = 0
     logging.basicConfig(level = logging.WARNING)
     try :
-        opts, args = getopt.getopt(argList, "vd")
+        opts, args = getopt.getopt(argList, "vda:")
     except getopt.GetoptError:
         print('issue with submitted options')#usage()
         sys.exit(2)
@@ -151,6 +237,9 @@ def main(argList):
         elif '-d' in opt:
             verbose = 2
             logging.basicConfig(level = logging.DEBUG)
+        elif '-a' in opt:
+            # asyncio mode, with this many files in progress at once
+            concurrency = int(argu)
 
     log = logging.getLogger(__name__)
     logging.info('Running in verbose mode')
@@ -160,9 +249,19 @@ def main(argList):
         
     # arrivals = Arrivals(stream_config=StreamConfig(name=STREAM, configfile=CONFIG_FILE))
     arrivals = Arrivals()
+
+    # SQLite catalogue of the archive (see eprofile_archive_catalogue) to record the deposits in, the same one that
+    # eprofile_concat_for_ingest reads the ingested single files from
+    if 'archive_catalogue' in arrivals.stream_config.options():
+        ARCHIVE_CATALOGUE.cache_file = arrivals.stream_config['archive_catalogue']
+
     file_list = arrivals.arrivals_files()
     log.debug(file_list)
 
+    if concurrency:
+        asyncio.run(ingest_async(file_list, arrivals.stream_config, concurrency))
+        return
+
     for file_to_ingest in file_list:
         log.debug(file_to_ingest)
         file_processed = moveToIngest(file_to_ingest, arrivals.stream_config)
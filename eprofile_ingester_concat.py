@@ -1,105 +1,267 @@
 import os
-import re
 import sys
 import getopt
-import glob
+import time
+import random
 import logging
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from netCDF4 import Dataset
 from deposit_client import DepositClient
 from arrivals_deleter import ArrivalsDeleter
 from stream_config import StreamConfig
 from ingest_lib import Arrivals, ArchiveClientError
-from eprofile_concat_for_ingest import INSTRUMENT_DICT, OPERATOR_DICT
+from eprofile_concat_for_ingest import STATION_CACHE
+from eprofile_concat_engines import finalise_daily_file
+from eprofile_provenance import dataset_attrs, read_manifest
+from eprofile_filenames import parse_l2_filename
+from eprofile_archive_catalogue import ARCHIVE_CATALOGUE, ARCHIVE_BASE_PATH, CatalogueUnavailable
 AD = ArrivalsDeleter()
 DC = DepositClient()
 
 
+class DepositQueue():
+    '''
+    deposits daily files into the archive from a pool of threads, retrying failed deposits after a delay that
+    doubles each attempt with up to as much again of random jitter. Archive directories are only checked for, or
+    made, the first time they are deposited into
+
+    :param n_concurrent: number of deposits to run at once
+    :param attempts: attempts at each deposit before giving up
+    :param backoff: seconds to wait before the first retry
+    '''
+
+    def __init__(self, n_concurrent=1, attempts=3, backoff=2.):
+        self.n_concurrent = n_concurrent
+        self.attempts = attempts
+        self.backoff = backoff
+        self.log = logging.getLogger(__name__)
+        self._made_dirs = set()
+        self._lock = threading.Lock()
+
+    def makedirs(self, arch_dest):
+        with self._lock:
+            if arch_dest in self._made_dirs:
+                return
+        if not os.path.exists(arch_dest):
+            self.log.debug("Make new directory: %r" % arch_dest)
+            DC.makedirs(arch_dest)
+        with self._lock:
+            self._made_dirs.add(arch_dest)
+
+    def deposit(self, src_file, dest_path):
+        '''
+        deposit a file, retrying with backoff
+
+        :raises ArchiveClientError: from the last attempt if all attempts fail
+        '''
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.makedirs(os.path.dirname(dest_path))
+                print(f'depositing file: {dest_path}')
+                DC.deposit(src_file, dest_path, force=True)
+            except ArchiveClientError as client_error:
+                if attempt == self.attempts:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                delay += random.uniform(0, delay)
+                self.log.warning(f'{dest_path}: deposit attempt {attempt} failed, retrying in {delay:.1f} s: '
+                                 f'{client_error}')
+                time.sleep(delay)
+            else:
+                return
+
+    def run(self, ingests):
+        '''
+        deposit the files of a list of moveToIngest, yielding each as its deposit finishes (straight away for those
+        with nothing to deposit) so that the source files can be removed after it
+
+        :param ingests: list of moveToIngest made with deposit_now=False
+        '''
+        latencies = []
+        with ThreadPoolExecutor(max_workers=self.n_concurrent) as pool:
+            futures = {}
+            for ingest in ingests:
+                if ingest.needs_deposit():
+                    futures[pool.submit(ingest.deposit, self)] = ingest
+                else:
+                    yield ingest
+
+            for future in as_completed(futures):
+                latency = future.result()
+                if latency is not None:
+                    latencies.append(latency)
+                yield futures[future]
+
+        if latencies:
+            self.log.info(f'{len(latencies)} files deposited with {self.n_concurrent} concurrent deposits, '
+                          f'mean {sum(latencies) / len(latencies):.1f} s, max {max(latencies):.1f} s per file')
+
+
+def _is_empty_dir(path):
+    # stops at the first entry rather than listing the whole directory
+    try:
+        with os.scandir(path) as entries:
+            return next(entries, None) is None
+    except FileNotFoundError:
+        return False
+
+
+class ArchiveCleanup():
+    '''
+    single files to remove from the archive, collected over a run and then removed together by a pool of threads,
+    after which the directories left empty are removed bottom-up: day, month, year, instrument and station, each
+    directory checked once
+
+    :param n_concurrent: number of removes to run at once
+    '''
+
+    # directory levels above a single file that are removed when left empty: day, month, year, instrument, station
+    DIR_LEVELS = 5
+
+    def __init__(self, n_concurrent=1):
+        self.n_concurrent = n_concurrent
+        self.log = logging.getLogger(__name__)
+        self.files = []
+
+    def add(self, single_file_path):
+        self.files.append(single_file_path)
+
+    def _remove(self, path, remove):
+        try:
+            remove(path)
+        except (ArchiveClientError, OSError) as ex:
+            self.log.error(f'unable to remove {path}: {ex}')
+            return False
+        return True
+
+    def _remove_all(self, pool, paths, remove):
+        done = pool.map(lambda path: self._remove(path, remove), paths)
+        return [path for path, removed in zip(paths, done) if removed]
+
+    def run(self):
+        '''
+        remove the files collected and then the empty directories
+
+        :return: (number of files removed, number of directories removed)
+        '''
+        start = time.perf_counter()
+        files = sorted(set(self.files))
+        self.files = []
+
+        removed_dirs = []
+        with ThreadPoolExecutor(max_workers=self.n_concurrent) as pool:
+            removed_files = self._remove_all(pool, files, DC.remove)
+            ARCHIVE_CATALOGUE.remove_many(removed_files)
+
+            candidates = {os.path.dirname(path) for path in removed_files}
+            for level in range(self.DIR_LEVELS):
+                empty_dirs = sorted(path for path in candidates if _is_empty_dir(path))
+                for path in empty_dirs:
+                    self.log.info(f'empty dir, can remove: {path}')
+                emptied = self._remove_all(pool, empty_dirs, DC.rmdir)
+                removed_dirs.extend(emptied)
+                candidates = {os.path.dirname(path) for path in emptied}
+
+        seconds = time.perf_counter() - start
+        if files:
+            self.log.info(f'{len(removed_files)} of {len(files)} single files and {len(removed_dirs)} directories '
+                          f'removed in {seconds:.1f} s ({len(removed_files) / max(seconds, 1e-6):.0f} files/s, '
+                          f'{len(removed_dirs) / max(seconds, 1e-6):.0f} directories/s)')
+        return len(removed_files), len(removed_dirs)
+
+
 class moveToIngest():
     
-    def __init__(self, inc_file, stream_options):
-    
+    def __init__(self, inc_file, stream_options, deposit_now=True):
+        '''
+        :param inc_file: daily file to ingest
+        :param stream_options: stream config
+        :param deposit_now: False to leave the deposit to a DepositQueue
+        '''
         self.src_file = inc_file
         self.log = logging.getLogger(__name__)
         self.stream_options = stream_options
-        dataset = Dataset(inc_file)
 
-        date_string = os.path.basename(inc_file).split('_')[2][1:-3]
-        ins_num = dataset.instrument_id
-
-        inst_type = INSTRUMENT_DICT[dataset.instrument_type]
-
-        loc_details = dataset.site_location.split(',')
-        location_name = re.sub('\_','-',loc_details[0]).lower()
-        
-        if location_name == 'aberystwyth':  #correcting for incorrect setting in incoming filename
-            location_name = 'capel-dewi'
-        
-        if location_name[-4:] == '-alc':
-            location_name = location_name[:-4]
-    
-        if location_name == 'chilbolton':
-            location_name = 'chilbolton-atmospheric-observatory'
-        title_details = dataset.title.split(' ')
+        # daily files appended to in place still have time as unlimited dimension, so fix that before ingest
+        if 'encoding_profile' in stream_options.options():
+            finalise_daily_file(inc_file, stream_options['encoding_profile'])
+        else:
+            finalise_daily_file(inc_file)
 
-        self.hist_set = set(re.findall('(L2_[\w-]{1,}.nc)', dataset.history))
+        with Dataset(inc_file) as dataset:
+            self.hist_set = read_manifest(dataset_attrs(dataset))
 
-        dataset.close()
+        date_string = os.path.basename(inc_file).split('_')[2][1:-3]
 
         self.log.info(inc_file)
         self.ingestState = False
+        self.dest_path = None
         try:
-            self.inst_name_dict = {'operator' : OPERATOR_DICT['-'.join(title_details[2:])],
-                          'instrument_type': inst_type,
-                          'country' : loc_details[1].replace('_','-').lower(),
-                          'location' : location_name,
-                          'inst_id' : ins_num,
-                          'datetime' : date_string,
-                          'yyyy' : date_string[0:4],
-                          'mm' : date_string[4:6],
-                          'dd' : date_string [6:8]
-                          }
+            # station details are cached per instrument, see eprofile_station_cache
+            self.inst_name_dict = STATION_CACHE.lookup(inc_file)
         except KeyError as e:
-            self.log.error("%s: %s" % (e, '|'.join(title_details)))
+            self.log.error(e.args[0])
             self.inst_name_dict= None
             
         else:
+            self.inst_name_dict.update({'datetime' : date_string,
+                                        'yyyy' : date_string[0:4],
+                                        'mm' : date_string[4:6],
+                                        'dd' : date_string [6:8]
+                                        })
+
             #new_filename = '%(operator)s-%(instrument_type)s_%(location)s_%(datetime)s_%(inst_id)s.nc'% inst_name_dict
             
-            arch_dest = '/badc/eprofile/data/daily_files/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(yyyy)s/'% self.inst_name_dict
+            arch_dest = ARCHIVE_BASE_PATH + '/daily_files/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(yyyy)s/'% self.inst_name_dict
             self.dest_path = os.path.join(arch_dest, os.path.basename(inc_file))
             self.log.debug(os.path.join(arch_dest,os.path.basename(inc_file)))
-            reTry = 0
 
-            if os.path.exists(os.path.join(arch_dest, os.path.basename(inc_file))):
-                dst_path = os.path.join(arch_dest, os.path.basename(inc_file))
-                if os.stat(dst_path).st_size >= os.stat(inc_file).st_size:
-                    #new file is the same size or smaller than the existing file in the archive, so DONT ingest!
-                    self.ingestState = True
+            # this guards the archived file against being overwritten by a smaller one, so it asks the archive
+            # itself rather than the catalogue, which may be behind
+            try:
+                dst_size = os.stat(self.dest_path).st_size
+            except FileNotFoundError:
+                dst_size = None
 
-                
-            while reTry < 3 and not self.ingestState:
-                try:
-                    if not os.path.exists(arch_dest):
-                        self.log.debug("Make new directory: %r" % arch_dest) 
+            if dst_size is not None and dst_size >= os.stat(inc_file).st_size:
+                #new file is the same size or smaller than the existing file in the archive, so DONT ingest!
+                self.ingestState = True
 
-                        DC.makedirs(arch_dest)
-                    
-                    print(f'depositing file: {os.path.join(arch_dest, os.path.basename(inc_file))}')
-                    DC.deposit(inc_file,self.dest_path, force=True)
-                except ArchiveClientError as client_error:
-                    reTry += 1
-                    if reTry == 3:
-                        self.log.error(client_error)
+            if deposit_now:
+                self.deposit(DepositQueue())
 
-                else:
-                    self.ingestState = True
+    def needs_deposit(self):
+        return self.dest_path is not None and not self.ingestState
+
+    def deposit(self, deposit_queue):
+        '''
+        deposit the file into the archive through a DepositQueue
 
-    def remove_single_files(self):
+        :return: seconds taken, None if the deposit failed
+        '''
+        start = time.perf_counter()
+        try:
+            deposit_queue.deposit(self.src_file, self.dest_path)
+        except ArchiveClientError as client_error:
+            self.log.error(client_error)
+            return None
+
+        self.ingestState = True
+        ARCHIVE_CATALOGUE.add(self.dest_path, os.stat(self.src_file).st_size)
+        latency = time.perf_counter() - start
+        self.log.info(f'{self.dest_path}: deposited in {latency:.1f} s')
+        return latency
+
+    def remove_single_files(self, cleanup=None):
         '''
-        Will read in history element and try and remove single time step files from the archive
+        Will read in the manifest of source files (or history for older files) and try and remove single time step
+        files from the archive
 
+        :param cleanup: ArchiveCleanup to add the files to, to be removed along with those of the other daily files
+                        of the run. Without one they are removed straight away
         :return:
         '''
         
@@ -111,46 +273,35 @@ class moveToIngest():
     
         if self.ingestState:
 
-            single_arch_dest = '/badc/eprofile/data/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(yyyy)s/%(mm)s/%(dd)s/'% self.inst_name_dict
+            single_arch_dest = ARCHIVE_BASE_PATH + '/%(country)s/%(location)s/%(operator)s-%(instrument_type)s_%(inst_id)s/%(yyyy)s/%(mm)s/%(dd)s/'% self.inst_name_dict
 
             
             if self.hist_set and self.stream_options['deleterchoice'] in ['arrivals', 'notArrivals'] and single_file_remove:
 
+                remove_now = cleanup is None
+                if remove_now:
+                    cleanup = ArchiveCleanup()
+
+                try:
+                    archived_single_files = set(ARCHIVE_CATALOGUE.single_files(self.src_file))
+                except CatalogueUnavailable:
+                    archived_single_files = None
 
+                self.log.info(f'removing source single files: {len(self.hist_set)}')
                 for archived_single_file in self.hist_set:
-                    self.log.info('removing source single files: {len(self.hist_set)}')
                     single_file_path = os.path.join(single_arch_dest,archived_single_file)
                     
-                    if os.path.exists(single_file_path):
+                    if archived_single_files is None:
+                        archived = os.path.exists(single_file_path)
+                    else:
+                        archived = single_file_path in archived_single_files
+
+                    if archived:
                         self.log.info(f'can remove : {single_file_path}')
-                        if self.stream_options['deleterchoice'] in ['arrivals','notArrivals']:
-                            DC.remove(single_file_path)
-
-                day_parent_dir = os.path.dirname(single_file_path)
-                'Now to tidy-up directories if they are empty...'
-                if glob.glob(os.path.join(day_parent_dir,'*')) == [] and os.path.exists(day_parent_dir):
-                    self.log.info(f'empty dir, can remove: {day_parent_dir}')
-                    DC.rmdir(day_parent_dir)
-
-                    month_parent_dir= os.path.dirname(day_parent_dir)
-                    if glob.glob(os.path.join(month_parent_dir,'*')) == [] and os.path.exists(month_parent_dir):
-                        self.log.info(f'empty dir, can remove: {month_parent_dir}')
-                        DC.rmdir(month_parent_dir)
-
-                    year_parent_dir = os.path.dirname(month_parent_dir)
-                    if glob.glob(os.path.join(year_parent_dir, '*')) == [] and os.path.exists(year_parent_dir):
-                        self.log.info(f'empty dir, can remove: {year_parent_dir}')
-                        DC.rmdir(year_parent_dir)
-
-                    inst_parent_dir = os.path.dirname(year_parent_dir)
-                    if glob.glob(os.path.join(inst_parent_dir, '*')) == [] and os.path.exists(inst_parent_dir):
-                        self.log.info(f'empty dir, can remove: {inst_parent_dir}')
-                        DC.rmdir(inst_parent_dir)
-
-                    station_parent_dir = os.path.dirname(inst_parent_dir)
-                    if glob.glob(os.path.join(station_parent_dir, '*')) == [] and os.path.exists(station_parent_dir):
-                        self.log.info(f'empty dir, can remove: {station_parent_dir}')
-                        DC.rmdir(station_parent_dir)
+                        cleanup.add(single_file_path)
+
+                if remove_now:
+                    cleanup.run()
 
     def remove_src_file(self):
         '''
@@ -190,29 +341,50 @@ def main(argList):
     log = logging.getLogger(__name__)
     logging.info('Running in verbose mode')
     
+    # SQLite file caching the station details used for archive paths, '' to read them from every file
+    if 'station_cache' in config.options():
+        STATION_CACHE.cache_file = config['station_cache']
+
+    # SQLite catalogue of the archive (see eprofile_archive_catalogue), '' to look in the archive directly
+    if 'archive_catalogue' in config.options():
+        ARCHIVE_CATALOGUE.cache_file = config['archive_catalogue']
+
+    # concurrent deposits into the archive, and the attempts at each with the seconds to wait before the first retry
+    deposit_queue = DepositQueue(n_concurrent=config.getint('deposit_jobs', default=1),
+                                 attempts=config.getint('deposit_attempts', default=3),
+                                 backoff=config.getint('deposit_backoff', default=2))
+
     arrivals = Arrivals(stream_config=config)
     
     file_list = arrivals.arrivals_files()
     log.debug(file_list)
-    file_regex = "L2_([\w-]{5,30})_(\w{1})(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).nc$"
 
     quarantine_period = datetime.timedelta(days=2)
 
+    files_to_ingest = []
     for file_to_ingest in file_list:
-        date_parts = re.search(file_regex,file_to_ingest)
-        if date_parts:
-            filedate = datetime.date(int(date_parts["year"]), int(date_parts["month"]), int(date_parts["day"]))
-            if filedate + quarantine_period <= datetime.date.today():
+        record = parse_l2_filename(file_to_ingest)
+        if record and record.is_daily:
+            if record.day + quarantine_period <= datetime.date.today():
 
                 #now do date check based on filename!
                 log.debug(file_to_ingest)
-                file_processed = moveToIngest(file_to_ingest, config)
-                file_processed.remove_src_file()
-                file_processed.remove_single_files()
+                files_to_ingest.append(moveToIngest(file_to_ingest, config, deposit_now=False))
             else:
                 print('file within quarantine, so leaving: %s' % file_to_ingest)
         else:
-            log.warning(f"{file_to_ingest} doesn't match regex")
+            log.warning(f"{file_to_ingest} isn't a daily file")
+
+    # single files are removed from the archive together once all the daily files are in, with this many removes
+    # at once
+    cleanup = ArchiveCleanup(n_concurrent=config.getint('cleanup_jobs', default=4))
+
+    # source files are only removed once the daily file is in the archive
+    for file_processed in deposit_queue.run(files_to_ingest):
+        file_processed.remove_src_file()
+        file_processed.remove_single_files(cleanup)
+
+    cleanup.run()
 
 if __name__=="__main__":
     args=sys.argv[1:]
@@ -0,0 +1,215 @@
+"""
+Fast integrity checks of netCDF files, to find truncated or corrupt 5-minute L2 files before they are concatenated.
+
+The checks read only the first few hundred bytes of a file:
+- netCDF-4 (HDF5) files: the HDF5 signature, the superblock (with its checksum for superblock versions 2 and 3, and
+  the flag left set by a writer that never closed the file) and that the file is at least as long as the end of file
+  address recorded in the superblock, which a truncated file is not
+- netCDF classic files: the CDF signature and version, and that the record count was written
+
+Optionally each file is also opened to check it holds the variables the concatenation needs. A batch of files is
+checked in a pool of threads, and the files that fail can be moved aside so the rest of the day is concatenated.
+
+"""
+
+import os
+import struct
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from netCDF4 import Dataset
+
+from eprofile_filenames import parse_l2_filename
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+CDF_SIGNATURE = b'CDF'
+
+# variables concat_single_inst needs in each L2 file
+L2_REQUIRED_VARIABLES = ('time', 'start_time', 'quality_flag')
+
+# undefined address in an HDF5 file
+_UNDEFINED = {4: 0xffffffff, 8: 0xffffffffffffffff}
+
+_MASK = 0xffffffff
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & _MASK
+
+
+def lookup3(data, initval=0):
+    '''
+    Bob Jenkins' lookup3 hash (hashlittle), used by HDF5 for its metadata checksums
+    '''
+    length = len(data)
+    a = b = c = (0xdeadbeef + length + initval) & _MASK
+    if not length:
+        return c
+
+    # the last block is padded out to 12 bytes with zeros, which adds nothing to the sums
+    data = bytes(data) + b'\0' * (-length % 12)
+    n_blocks = len(data) // 12
+    for i in range(n_blocks):
+        k0, k1, k2 = struct.unpack_from('<III', data, i * 12)
+        a = (a + k0) & _MASK
+        b = (b + k1) & _MASK
+        c = (c + k2) & _MASK
+        if i == n_blocks - 1:
+            break
+        a = (a - c) & _MASK; a ^= _rot(c, 4); c = (c + b) & _MASK
+        b = (b - a) & _MASK; b ^= _rot(a, 6); a = (a + c) & _MASK
+        c = (c - b) & _MASK; c ^= _rot(b, 8); b = (b + a) & _MASK
+        a = (a - c) & _MASK; a ^= _rot(c, 16); c = (c + b) & _MASK
+        b = (b - a) & _MASK; b ^= _rot(a, 19); a = (a + c) & _MASK
+        c = (c - b) & _MASK; c ^= _rot(b, 4); b = (b + a) & _MASK
+
+    c ^= b; c = (c - _rot(b, 14)) & _MASK
+    a ^= c; a = (a - _rot(c, 11)) & _MASK
+    b ^= a; b = (b - _rot(a, 25)) & _MASK
+    c ^= b; c = (c - _rot(b, 16)) & _MASK
+    a ^= c; a = (a - _rot(c, 4)) & _MASK
+    b ^= a; b = (b - _rot(a, 14)) & _MASK
+    c ^= b; c = (c - _rot(b, 24)) & _MASK
+    return c
+
+
+def _check_hdf5_superblock(header, file_size):
+    '''
+    :param header: bytes from the start of the superblock
+    :param file_size: size of the file in bytes
+    :return: reason the file is bad, '' if it looks sound
+    '''
+    version = header[8]
+    if version in (0, 1):
+        size_of_offsets = header[13]
+        addresses_at = 24 if version == 0 else 28
+        flags = 0
+    elif version in (2, 3):
+        size_of_offsets = header[9]
+        addresses_at = 12
+        flags = header[11]
+    else:
+        return f'unknown HDF5 superblock version {version}'
+
+    if size_of_offsets not in _UNDEFINED:
+        return f'bad HDF5 size of offsets {size_of_offsets}'
+
+    n_addresses = 4
+    end = addresses_at + n_addresses * size_of_offsets
+    if len(header) < end + (4 if version >= 2 else 0):
+        return 'truncated HDF5 superblock'
+
+    address_format = '<' + ('I' if size_of_offsets == 4 else 'Q') * n_addresses
+    base_address, _, eof_address, _ = struct.unpack_from(address_format, header, addresses_at)
+
+    if version >= 2:
+        checksum, = struct.unpack_from('<I', header, end)
+        if lookup3(header[:end]) != checksum:
+            return 'HDF5 superblock checksum mismatch'
+        if version == 3 and flags & 0x1:
+            return 'HDF5 file was not closed by its writer'
+
+    if eof_address == _UNDEFINED[size_of_offsets]:
+        return 'HDF5 end of file address not set'
+    if base_address + eof_address > file_size:
+        return f'truncated: {file_size} bytes of {base_address + eof_address}'
+    return ''
+
+
+def check_structure(path):
+    '''
+    check the signature and superblock or header of a netCDF file
+
+    :return: reason the file is bad, '' if it looks sound
+    '''
+    try:
+        file_size = os.stat(path).st_size
+        with open(path, 'rb') as nc_file:
+            start = nc_file.read(96)
+            if start.startswith(CDF_SIGNATURE):
+                if len(start) < 8 or start[3] not in (1, 2, 5):
+                    return 'bad netCDF classic header'
+                numrecs = start[4:12] if start[3] == 5 else start[4:8]
+                if numrecs == b'\xff' * len(numrecs):
+                    return 'netCDF classic record count not written'
+                return ''
+
+            # the HDF5 superblock is at 0, or 512, 1024, 2048... after a user block
+            offset = 0
+            while offset + len(HDF5_SIGNATURE) <= file_size:
+                if offset:
+                    nc_file.seek(offset)
+                    start = nc_file.read(96)
+                if start.startswith(HDF5_SIGNATURE):
+                    return _check_hdf5_superblock(start, file_size)
+                offset = offset * 2 if offset else 512
+    except OSError as ex:
+        return f'unreadable: {ex}'
+
+    return 'not a netCDF file'
+
+
+def check_variables(path, required_variables):
+    '''
+    :return: reason the file is bad, '' if it opens and holds the required variables
+    '''
+    try:
+        with Dataset(path) as dataset:
+            missing = [name for name in required_variables if name not in dataset.variables]
+    except OSError as ex:
+        return f'unreadable: {ex}'
+    if missing:
+        return f"missing variables: {', '.join(missing)}"
+    return ''
+
+
+def validate_files(paths, jobs=8, required_variables=()):
+    '''
+    check a batch of files
+
+    :param paths: files to check
+    :param jobs: threads reading the file headers
+    :param required_variables: variables each file must have. Checking these means opening every file with netCDF4,
+                               which is done one file at a time as netCDF and HDF5 calls aren't thread safe
+    :return: dict of path: reason for the files that fail
+    '''
+    log = logging.getLogger(__name__)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        reasons = dict(zip(paths, pool.map(check_structure, paths)))
+
+    if required_variables:
+        for path, reason in reasons.items():
+            if not reason:
+                reasons[path] = check_variables(path, required_variables)
+
+    bad_files = {path: reason for path, reason in reasons.items() if reason}
+    for path, reason in bad_files.items():
+        log.warning(f'{path} failed integrity check: {reason}')
+    return bad_files
+
+
+def quarantine_files(bad_files, quarantine_dir):
+    '''
+    move files that failed the integrity check into their block directory under quarantine_dir
+
+    :param bad_files: dict of path: reason from validate_files
+    :return: list of the new paths
+    '''
+    log = logging.getLogger(__name__)
+
+    moved = []
+    for path, reason in bad_files.items():
+        record = parse_l2_filename(path)
+        dest_dir = os.path.join(quarantine_dir, record.block if record else '')
+        os.makedirs(dest_dir, exist_ok=True)
+        dest = os.path.join(dest_dir, os.path.basename(path))
+        try:
+            shutil.move(path, dest)
+        except OSError as ex:
+            log.error(f'unable to move {path} to {dest_dir}: {ex}')
+            continue
+        log.info(f'{path} moved to {dest_dir}: {reason}')
+        moved.append(dest)
+    return moved
@@ -0,0 +1,206 @@
+"""
+Timing metrics for the stages of concatenating an instrument-day, so that slow block runs can be broken down.
+
+concat_single_inst collects a StageMetrics for each instrument-day when asked to, and the records are written out
+at the end of a run as JSON lines (appended, one record per instrument-day) and/or as a Prometheus textfile for the
+node_exporter textfile collector (rewritten each run). When metrics are off the shared NULL_METRICS is used, whose
+methods do nothing.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+import socket
+import datetime
+import resource
+from contextlib import contextmanager, nullcontext
+
+# prefix of the Prometheus metric names
+PROMETHEUS_PREFIX = 'eprofile_concat'
+
+
+def reset_peak_rss():
+    '''
+    start the peak resident memory of this process again from its current size (Linux 4.0 and later), so that
+    peak_rss_bytes covers one instrument-day in a worker process that handles several
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_bytes():
+    '''
+    peak resident memory of this process, since the last reset_peak_rss where that works
+    '''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss_bytes():
+    '''
+    resident memory of this process now
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+class StageMetrics():
+    '''
+    times and counts for one instrument-day
+
+    :param filename_out: daily file being made
+    :param labels: any other fields to go in the record, e.g. engine
+    '''
+
+    def __init__(self, filename_out, **labels):
+        self.filename_out = filename_out
+        self.labels = labels
+        self.stages = {}
+        self.counts = {'files_in': 0, 'bytes_read': 0, 'bytes_written': 0}
+        self.status = 'done'
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        time a stage, adding to any earlier time for a stage of the same name
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def read_files(self, filenames):
+        '''
+        count files read in, and their size
+        '''
+        self.counts['files_in'] += len(filenames)
+        self.counts['bytes_read'] += sum(os.stat(fn).st_size for fn in filenames if os.path.exists(fn))
+
+    def wrote_file(self, filename):
+        if os.path.exists(filename):
+            self.counts['bytes_written'] += os.stat(filename).st_size
+
+    def record(self):
+        '''
+        :return: dict for the instrument-day, as written to the JSON lines file
+        '''
+        basename = os.path.basename(self.filename_out)
+        return {'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'host': socket.gethostname(),
+                'filename_out': self.filename_out,
+                'instrument': basename[3:-11],
+                'date': basename[-11:-3],
+                'status': self.status,
+                'total_seconds': round(time.perf_counter() - self._start, 6),
+                'stage_seconds': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                'peak_rss_bytes': peak_rss_bytes(),
+                **self.counts,
+                **self.labels}
+
+
+class NullMetrics():
+    '''
+    stands in for StageMetrics when metrics are off
+    '''
+    status = 'done'
+    _null_stage = nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def read_files(self, filenames):
+        pass
+
+    def wrote_file(self, filename):
+        pass
+
+    def record(self):
+        return None
+
+
+NULL_METRICS = NullMetrics()
+
+
+def append_jsonl(filename, records):
+    '''
+    append records to a JSON lines file, locked so runs from other blocks can write to the same file
+    '''
+    with open(filename, 'a') as jsonl_file:
+        fcntl.flock(jsonl_file, fcntl.LOCK_EX)
+        try:
+            jsonl_file.write(''.join(json.dumps(record) + '\n' for record in records))
+        finally:
+            fcntl.flock(jsonl_file, fcntl.LOCK_UN)
+
+
+def _prometheus_labels(**labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def write_prometheus_textfile(filename, records, run_labels=None):
+    '''
+    write the records of a run as a Prometheus textfile. The file is written alongside and renamed into place so
+    the collector never sees it half written
+
+    :param filename: textfile, normally in the node_exporter textfile directory and ending .prom
+    :param records: records from StageMetrics.record
+    :param run_labels: dict of labels to add to every metric, e.g. the stream name
+    '''
+    run_labels = run_labels or {}
+    p = PROMETHEUS_PREFIX
+    lines = [f'# HELP {p}_stage_seconds Time spent in each stage of concatenating an instrument-day',
+             f'# TYPE {p}_stage_seconds gauge']
+    for record in records:
+        for stage, seconds in record['stage_seconds'].items():
+            labels = _prometheus_labels(**run_labels, instrument=record['instrument'], date=record['date'],
+                                        stage=stage)
+            lines.append(f'{p}_stage_seconds{labels} {seconds}')
+
+    for count, help_text in (('total_seconds', 'Total time to concatenate an instrument-day'),
+                             ('files_in', 'Files read to concatenate an instrument-day'),
+                             ('bytes_read', 'Bytes of the files read to concatenate an instrument-day'),
+                             ('bytes_written', 'Bytes of the daily file written'),
+                             ('peak_rss_bytes', 'Peak resident memory of the process concatenating an instrument-day')):
+        lines.extend([f'# HELP {p}_{count} {help_text}', f'# TYPE {p}_{count} gauge'])
+        for record in records:
+            labels = _prometheus_labels(**run_labels, instrument=record['instrument'], date=record['date'],
+                                        status=record['status'])
+            lines.append(f'{p}_{count}{labels} {record[count]}')
+
+    lines.extend([f'# HELP {p}_last_run_timestamp_seconds Time the last run finished',
+                  f'# TYPE {p}_last_run_timestamp_seconds gauge',
+                  f'{p}_last_run_timestamp_seconds{_prometheus_labels(**run_labels)} {time.time():.0f}'])
+
+    temp_filename = os.path.join(os.path.dirname(filename) or '.', f'.{os.path.basename(filename)}.{os.getpid()}')
+    with open(temp_filename, 'w') as prom_file:
+        prom_file.write('\n'.join(lines) + '\n')
+    os.rename(temp_filename, filename)
+
+
+def emit_metrics(records, jsonl_file='', prometheus_file='', run_labels=None):
+    '''
+    write out the records of a run to whichever of the outputs are set
+    '''
+    records = [record for record in records if record]
+    if jsonl_file and records:
+        append_jsonl(jsonl_file, records)
+    if prometheus_file:
+        write_prometheus_textfile(prometheus_file, records, run_labels)
@@ -0,0 +1,325 @@
+"""
+Provenance of E-PROFILE daily files: which 5-minute L2 files have gone into each daily file.
+
+The contributing files are held in the daily file as a compact manifest in two global attributes:
+  source_file_prefix: common start of the source filenames, e.g. 'L2_0-20000-0-06610_A20211018'
+  source_files: space separated sorted list of the rest of each filename (the HHMM part, '.nc' dropped),
+                or the full filename for any file not starting with the prefix
+so that the history attribute only needs a short line per concatenation run. Daily files made before the
+manifest was added have the filenames listed in the history, which is read instead.
+
+"""
+
+import os
+import re
+import datetime
+
+from netCDF4 import Dataset
+
+MANIFEST_ATTR = 'source_files'
+MANIFEST_PREFIX_ATTR = 'source_file_prefix'
+
+# filenames as listed in the history of daily files made before the manifest
+HISTORY_FILE_REGEX = re.compile(r'(L2_[\w-]{1,}.nc)')
+
+# prefix (instrument and day) and time of day of a 5-minute L2 filename
+SOURCE_FILE_REGEX = re.compile(r'^(L2_[\w-]+_\w\d{8})(\d{4})\.nc$')
+
+# the comments of the source files in the comment attribute of a daily file (see format_comment): a header line
+# naming the source files, then a line per distinct comment with the times of the files that carry it
+COMMENT_HEADER_START = 'Comments of the source files '
+COMMENT_HEADER_REGEX = re.compile(r'^' + COMMENT_HEADER_START + r'(\S*)HHMM\.nc:$', re.MULTILINE)
+COMMENT_LINE_REGEX = re.compile(r'^([\w,.-]+): (.*)$')
+
+# source comments as they were listed before, 'L2_0-20000-0-06610_A202110180005.nc: comment', joined by '|'
+LEGACY_COMMENT_REGEX = re.compile(r'(L2_[\w-]+\.nc): (.*?)(?=\|L2_[\w-]+\.nc: | \n|$)', re.DOTALL)
+
+# size limits of the comment attribute and of each comment in it
+COMMENT_MAX_CHARS = 4096
+COMMENT_TEXT_MAX_CHARS = 512
+
+# spacing of the 5-minute L2 files, for listing runs of them as time ranges
+SOURCE_CADENCE_MINUTES = 5
+
+# global attributes of the source files kept by HeaderHarvest: the comment and history for the daily file and
+# those the station details are resolved from (see eprofile_station_cache.HEADER_ATTRS)
+SOURCE_HEADER_ATTRS = ('comment', 'history', 'title', 'instrument_type', 'instrument_id', 'site_location')
+
+
+def dataset_attrs(dataset):
+    '''
+    global attributes of a netCDF4.Dataset as a dict
+    '''
+    return {att: dataset.getncattr(att) for att in dataset.ncattrs()}
+
+
+class HeaderHarvest():
+    '''
+    global attributes of the source files of a daily file, gathered as each file is opened to read its data rather
+    than by opening every file again afterwards
+
+    :param attrs: names of the global attributes to keep
+    '''
+
+    def __init__(self, attrs=SOURCE_HEADER_ATTRS):
+        self.attrs = attrs
+        self.headers = {}
+
+    def add(self, path, attrs):
+        '''
+        :param path: source file
+        :param attrs: its global attributes, a dict or a netCDF4.Dataset
+        '''
+        if isinstance(attrs, dict):
+            header = {att: attrs[att] for att in self.attrs if att in attrs}
+        else:
+            names = set(attrs.ncattrs())
+            header = {att: attrs.getncattr(att) for att in self.attrs if att in names}
+        self.headers[os.path.abspath(path)] = header
+
+    def preprocess(self, ds):
+        '''
+        for the preprocess argument of xr.open_mfdataset, which calls it with each file as it is opened
+        '''
+        self.add(ds.encoding['source'], ds.attrs)
+        return ds
+
+    def header(self, path):
+        '''
+        harvested attributes of a file, read from the file itself if it wasn't harvested
+        '''
+        key = os.path.abspath(path)
+        if key not in self.headers:
+            with Dataset(path) as dataset:
+                self.add(path, dataset)
+        return self.headers[key]
+
+    def comments(self, paths):
+        '''
+        :return: list of (path, comment) for update_comment
+        '''
+        return [(path, self.header(path).get('comment', '')) for path in paths]
+
+
+def read_manifest(attrs):
+    '''
+    set of the source filenames that have gone into a daily file
+
+    :param attrs: dict of the global attributes of the daily file
+    :return: set of basenames
+    '''
+    if MANIFEST_ATTR not in attrs:
+        return set(HISTORY_FILE_REGEX.findall(attrs.get('history', '')))
+
+    prefix = attrs.get(MANIFEST_PREFIX_ATTR, '')
+    manifest = set()
+    for token in attrs[MANIFEST_ATTR].split():
+        if token.startswith('L2_'):
+            manifest.add(token)
+        else:
+            manifest.add(f'{prefix}{token}.nc')
+    return manifest
+
+
+def write_manifest(attrs, manifest):
+    '''
+    set the manifest attributes for a set of source filenames
+
+    :param attrs: dict of the global attributes of the daily file, updated in place
+    :param manifest: set of basenames
+    '''
+    prefix = attrs.get(MANIFEST_PREFIX_ATTR, '')
+    if not prefix:
+        for name in sorted(manifest):
+            match = SOURCE_FILE_REGEX.match(name)
+            if match:
+                prefix = match.group(1)
+                break
+
+    tokens = []
+    for name in manifest:
+        match = SOURCE_FILE_REGEX.match(name)
+        if prefix and match and match.group(1) == prefix:
+            tokens.append(match.group(2))
+        else:
+            tokens.append(name)
+
+    attrs[MANIFEST_PREFIX_ATTR] = prefix
+    attrs[MANIFEST_ATTR] = ' '.join(sorted(tokens))
+
+
+def update_provenance(attrs, source_files, script_name):
+    '''
+    add the source files contributing to a daily file to its manifest and put a short summary line in the history
+
+    :param attrs: dict of the global attributes of the daily file, updated in place
+    :param source_files: paths of the files that have been added
+    :param script_name: name of the script doing the concatenation
+    :return: list of the basenames that were new to the daily file
+    '''
+    manifest = read_manifest(attrs)
+
+    contrib = []
+    for fn in source_files:
+        base_name = os.path.basename(fn)
+        if base_name not in manifest:
+            manifest.add(base_name)
+            contrib.append(base_name)
+
+    file_hist = attrs.get('history', '')
+
+    if contrib:
+        if file_hist:
+            file_hist = file_hist + ' \n'
+        file_hist_entry = datetime.datetime.now().strftime('%Y%m%dT%H:%M:%S')
+        if 'concatenated by' not in file_hist:
+            file_hist += f'{file_hist_entry}: concatenated by {script_name} from {len(contrib)} files ' \
+                         f'(listed in {MANIFEST_ATTR})'
+        else:
+            file_hist += f'{file_hist_entry}: {len(contrib)} additional files added to concatenated file by ' \
+                         f'{script_name}'
+
+    attrs['history'] = file_hist
+    write_manifest(attrs, manifest)
+
+    return contrib
+
+
+def _minutes(time_of_day):
+    return int(time_of_day[:2]) * 60 + int(time_of_day[2:])
+
+
+def _format_times(names, prefix):
+    '''
+    compact list of source files: the time of day of each file of the prefix, with runs of files
+    SOURCE_CADENCE_MINUTES apart as a range (e.g. '0000-0055,0110'), and the full name of any other file
+    '''
+    times = []
+    others = []
+    for name in names:
+        match = SOURCE_FILE_REGEX.match(name)
+        if match and match.group(1) == prefix:
+            times.append(match.group(2))
+        else:
+            others.append(name)
+
+    ranges = []
+    for time_of_day in sorted(set(times)):
+        if ranges and _minutes(time_of_day) - _minutes(ranges[-1][1]) == SOURCE_CADENCE_MINUTES:
+            ranges[-1][1] = time_of_day
+        else:
+            ranges.append([time_of_day, time_of_day])
+
+    tokens = [start if start == end else f'{start}-{end}' for start, end in ranges]
+    return ','.join(tokens + sorted(others))
+
+
+def _parse_times(tokens, prefix):
+    '''
+    source filenames from a list made by _format_times
+    '''
+    names = []
+    for token in tokens.split(','):
+        if token.startswith('L2_'):
+            names.append(token)
+            continue
+        start, _, end = token.partition('-')
+        minutes = _minutes(start)
+        while minutes <= _minutes(end or start):
+            names.append(f'{prefix}{minutes // 60:02d}{minutes % 60:02d}.nc')
+            minutes += SOURCE_CADENCE_MINUTES
+    return names
+
+
+def parse_comment(file_comments):
+    '''
+    split the comment attribute of a daily file into its own comment and the comments of its source files. Reads the
+    grouped layout written by format_comment as well as the older one, of 'filename: comment' entries joined by '|'
+    after the daily file's comment, repeated as that was copied onto itself on each run
+
+    :param file_comments: comment attribute
+    :return: (comment of the daily file, dict of source filename: comment)
+    '''
+    source_comments = {}
+    header = COMMENT_HEADER_REGEX.search(file_comments)
+
+    if header:
+        own_comment = file_comments[:header.start()].strip()
+        prefix = header.group(1)
+        for line in file_comments[header.end():].splitlines():
+            match = COMMENT_LINE_REGEX.match(line)
+            if match:
+                for name in _parse_times(match.group(1), prefix):
+                    source_comments[name] = match.group(2)
+        return own_comment, source_comments
+
+    entries = list(LEGACY_COMMENT_REGEX.finditer(file_comments))
+    for entry in entries:
+        source_comments[entry.group(1)] = ' '.join(entry.group(2).split())
+    own_comment = file_comments[:entries[0].start()] if entries else file_comments
+    # the daily file's comment was copied onto itself each run, ' \n' between each copy
+    own_comment = own_comment.split(' \n')[0].strip()
+    return own_comment, source_comments
+
+
+def format_comment(own_comment, source_comments, max_chars=COMMENT_MAX_CHARS):
+    '''
+    comment attribute for a daily file: its own comment, then each distinct comment of the source files once, with
+    the times of the files that carry it, e.g.
+        Comments of the source files L2_0-20000-0-06610_A20211018HHMM.nc:
+        0000-0055,0110: window cleaned
+    Lines are dropped from the end to keep within max_chars, noting how many were
+
+    :param own_comment: comment of the daily file, left out if it is just that of one of its source files
+    :param source_comments: dict of source filename: comment
+    :param max_chars: size limit of the attribute
+    :return: comment attribute
+    '''
+    names_by_comment = {}
+    for name, comment in sorted(source_comments.items()):
+        if comment:
+            names_by_comment.setdefault(comment, []).append(name)
+
+    own_comment = own_comment[:COMMENT_TEXT_MAX_CHARS]
+    lines = [own_comment] if own_comment and ' '.join(own_comment.split()) not in names_by_comment else []
+    if not names_by_comment:
+        return '\n'.join(lines)[:max_chars]
+
+    prefix = ''
+    for name in sorted(source_comments):
+        match = SOURCE_FILE_REGEX.match(name)
+        if match:
+            prefix = match.group(1)
+            break
+    lines.append(f'{COMMENT_HEADER_START}{prefix}HHMM.nc:')
+
+    # in order of the first file with each comment
+    groups = sorted(names_by_comment.items(), key=lambda group: group[1][0])
+    for n, (comment, names) in enumerate(groups):
+        line = f'{_format_times(names, prefix)}: {comment[:COMMENT_TEXT_MAX_CHARS]}'
+        dropped = len(groups) - n
+        note = f'(and {dropped} more comments, from {sum(len(names) for _, names in groups[n:])} files)'
+        # leave room for the note about any lines dropped after this one
+        if sum(len(kept) + 1 for kept in lines) + len(line) + (len(note) + 1 if dropped > 1 else 0) > max_chars:
+            lines.append(note)
+            break
+        lines.append(line)
+
+    return '\n'.join(lines)[:max_chars]
+
+
+def update_comment(file_comments, source_comments):
+    '''
+    add the comments of the source files to the comment attribute of the daily file. Each distinct comment is
+    listed once with the times of the files it came from (see format_comment), a newer comment from a file
+    replacing an older one
+
+    :param file_comments: existing comment attribute ('' if none)
+    :param source_comments: list of (filename, comment) of the files that have been added
+    :return: new comment attribute
+    '''
+    own_comment, comments = parse_comment(file_comments)
+    for fn, comment in source_comments:
+        if comment:
+            comments[os.path.basename(fn)] = ' '.join(str(comment).split())
+    return format_comment(own_comment, comments)
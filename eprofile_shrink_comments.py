@@ -0,0 +1,128 @@
+"""
+Migration of the comment attribute of existing E-PROFILE daily files to the grouped layout of
+eprofile_provenance.format_comment.
+
+Daily files made before it have the comment of each source file listed one by one, and the whole comment copied
+onto itself on each concatenation run, so that in files added to many times it has grown to many times the size of
+the rest of the header. The attribute is rewritten in place, so the data isn't touched and the file isn't copied,
+and a line is added to the history.
+
+Files being concatenated in quarantine are skipped, and concatenation of a file is held off while its comment is
+rewritten (see eprofile_concat_engines.DailyFileLock). A concatenation reading a file from readyToIngest or the
+archive, whether through a hard link or in place, sees from its size and modification time that it was changed (see
+eprofile_concat_engines.PinnedFile) and tries again.
+
+usage: python eprofile_shrink_comments.py [-n] [-v] file_or_directory...
+    n: dry run, report the saving without changing any file
+    v: verbose
+
+"""
+
+import os
+import sys
+import getopt
+import logging
+import datetime
+
+from netCDF4 import Dataset
+
+from eprofile_concat_engines import DailyFileLock
+from eprofile_filenames import parse_l2_filename
+from eprofile_provenance import update_comment
+
+
+def find_daily_files(paths):
+    '''
+    daily files given or under the directories given
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    record = parse_l2_filename(filename)
+                    if record and record.is_daily:
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def shrink_comment(daily_file, dry_run=False):
+    '''
+    rewrite the comment attribute of a daily file if that makes it smaller
+
+    :param daily_file: daily file
+    :param dry_run: only work out the new size
+    :return: (old size, new size) of the attribute in characters, None if the file is locked
+    '''
+    log = logging.getLogger(__name__)
+
+    lock = DailyFileLock(daily_file)
+    if not lock.acquire():
+        log.info(f'{daily_file} is being concatenated, skipped')
+        return None
+    try:
+        with Dataset(daily_file, 'r' if dry_run else 'a') as dataset:
+            if 'comment' not in dataset.ncattrs():
+                return 0, 0
+            old_comment = dataset.comment
+            new_comment = update_comment(old_comment, [])
+            if len(new_comment) >= len(old_comment):
+                return len(old_comment), len(old_comment)
+
+            if not dry_run:
+                dataset.comment = new_comment
+                history = dataset.history + ' \n' if 'history' in dataset.ncattrs() else ''
+                dataset.history = f"{history}{datetime.datetime.now().strftime('%Y%m%dT%H:%M:%S')}: comment " \
+                                  f"compacted by {os.path.basename(__file__)}"
+    finally:
+        lock.release()
+
+    log.info(f'{daily_file}: comment {len(old_comment)} -> {len(new_comment)} characters')
+    return len(old_comment), len(new_comment)
+
+
+def main(arg_list):
+    try:
+        opts, args = getopt.getopt(arg_list, "nv")
+    except getopt.GetoptError as ex:
+        print(__doc__)
+        raise ex
+
+    dry_run = False
+    verbose = 0
+    for opt, argu in opts:
+        if opt == '-n':
+            dry_run = True
+        elif opt == '-v':
+            verbose = 1
+
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    log = logging.getLogger(__name__)
+
+    if not args:
+        print(__doc__)
+        sys.exit(2)
+
+    n_files = n_shrunk = n_failed = 0
+    old_total = new_total = 0
+    for daily_file in find_daily_files(args):
+        n_files += 1
+        try:
+            sizes = shrink_comment(daily_file, dry_run)
+        except OSError as ex:
+            log.error(f'{daily_file}: {ex}')
+            n_failed += 1
+            continue
+        if sizes and sizes[1] < sizes[0]:
+            n_shrunk += 1
+            old_total += sizes[0]
+            new_total += sizes[1]
+
+    print(f"{n_files} daily files, {n_shrunk} comments {'to be ' if dry_run else ''}shrunk from {old_total} to "
+          f"{new_total} characters, {n_failed} failed")
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,171 @@
+"""
+Persistent cache of the station/instrument details used to build archive paths for E-PROFILE files.
+
+The details (operator, instrument type, country, location, instrument id) are resolved from the global
+attributes of the L2 files but are constant for an instrument, so they are resolved once and kept in a local
+SQLite file keyed on the WIGOS id and instrument letter from the filename (e.g. '0-20000-0-06610_A'). Each entry
+holds a fingerprint of the header attributes it was resolved from. Lookups within max_age of the last check need
+no file to be opened; after that the header of the next file for the instrument is read again and the entry is
+only re-resolved if the fingerprint has changed. A header already read by the caller (e.g. during a concatenation)
+is checked against the fingerprint whatever the age of the entry.
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from hashlib import md5
+
+from netCDF4 import Dataset
+
+from eprofile_filenames import parse_l2_filename
+
+log = logging.getLogger(__name__)
+
+METADATA_CACHE_FILE = '/datacentre/processing3/eprofile/station_metadata_cache.sqlite'
+
+# seconds before the header of a cached instrument is checked again
+MAX_AGE = 86400
+
+# global attributes the station details are resolved from
+HEADER_ATTRS = ('instrument_id', 'instrument_type', 'site_location', 'title')
+
+
+def station_key(inc_file):
+    '''
+    cache key for an L2 or daily file: wigos id and instrument letter, e.g. '0-20000-0-06610_A'
+    '''
+    record = parse_l2_filename(inc_file)
+    if not record:
+        return None
+    return record.instrument
+
+
+def read_header(inc_file):
+    '''
+    global attributes of a file that the station details are resolved from
+    '''
+    with Dataset(inc_file) as dataset:
+        return {att: dataset.getncattr(att) for att in HEADER_ATTRS}
+
+
+def header_fingerprint(header):
+    return md5(json.dumps(header, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SqliteStore():
+    '''
+    local SQLite file shared between runs, processes and threads. If the file can't be used the store is switched off
+    (cache_file '') and callers fall back to the filesystem
+
+    :param cache_file: SQLite file, '' to switch off
+    '''
+
+    # statements creating the tables
+    SCHEMA = ()
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._local = threading.local()
+
+    def _connection(self):
+        # a connection can't be shared with the worker processes of a pool or between threads, so open one per
+        # process and thread, and again if cache_file has been set to another file since (e.g. from a stream config)
+        if not self.cache_file:
+            return None
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid() or local.cache_file != self.cache_file:
+            local.cache_file = self.cache_file
+            try:
+                local.conn = sqlite3.connect(self.cache_file, timeout=30)
+                with local.conn:
+                    for statement in self.SCHEMA:
+                        local.conn.execute(statement)
+            except sqlite3.Error as ex:
+                log.warning(f'{self.cache_file} unavailable, using the filesystem instead: {ex}')
+                self.cache_file = ''
+                local.conn = None
+            local.pid = os.getpid()
+        return local.conn
+
+    def _execute(self, sql, params=(), many=False):
+        '''
+        run a statement in its own transaction
+
+        :return: rows, [] if the store is unavailable or on error
+        '''
+        conn = self._connection()
+        if conn is None:
+            return []
+        try:
+            with conn:
+                if many:
+                    return conn.executemany(sql, params).fetchall()
+                return conn.execute(sql, params).fetchall()
+        except sqlite3.Error as ex:
+            log.warning(f'{self.cache_file} error: {ex}')
+            return []
+
+
+class StationCache(SqliteStore):
+    '''
+    SQLite cache of resolved station details
+
+    :param resolve: function taking the dict from read_header and returning the station details dict, raising
+    KeyError if they can't be resolved (nothing is cached then)
+    :param cache_file: SQLite file, '' to always read the header
+    :param max_age: seconds before the header of a cached instrument is checked again
+    '''
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS station (key TEXT PRIMARY KEY, fingerprint TEXT, details TEXT, '
+              'checked REAL)',)
+
+    def __init__(self, resolve, cache_file=METADATA_CACHE_FILE, max_age=MAX_AGE):
+        super().__init__(cache_file)
+        self.resolve = resolve
+        self.max_age = max_age
+
+    def lookup(self, inc_file, header=None):
+        '''
+        station details for the instrument of a file
+
+        :param inc_file: L2 or daily file
+        :param header: global attributes of inc_file if they have been read already (e.g. by a HeaderHarvest), so
+                       that the file needn't be opened again to check the entry
+        :return: copy of the station details dict
+        '''
+        key = station_key(inc_file)
+        now = time.time()
+        if header is not None and any(att not in header for att in HEADER_ATTRS):
+            header = None
+
+        row = None
+        if key:
+            rows = self._execute('SELECT fingerprint, details, checked FROM station WHERE key = ?', (key,))
+            row = rows[0] if rows else None
+            # an entry is trusted for max_age without opening a file, but a header to hand is always checked so
+            # that a change (a station moved, an instrument swapped) is picked up straight away
+            if row and header is None and now - row[2] < self.max_age:
+                return json.loads(row[1])
+
+        if header is None:
+            header = read_header(inc_file)
+        else:
+            header = {att: header[att] for att in HEADER_ATTRS}
+        fingerprint = header_fingerprint(header)
+
+        if row and row[0] == fingerprint:
+            self._execute('UPDATE station SET checked = ? WHERE key = ?', (now, key))
+            return json.loads(row[1])
+
+        details = self.resolve(header)
+
+        if key:
+            if row:
+                log.info(f'header of {key} has changed, station details updated: {details}')
+            self._execute('INSERT OR REPLACE INTO station VALUES (?, ?, ?, ?)',
+                          (key, fingerprint, json.dumps(details), now))
+        return dict(details)
@@ -0,0 +1,252 @@
+"""
+Synthetic E-PROFILE L2 files for testing and benchmarking the concat and ingest code
+away from the CEDA arrivals area.
+
+Files follow the layout of the 5-minute L2 files delivered by the E-PROFILE hub, with random data.
+
+usage: python eprofile_synthetic_l2.py -o output directory [-s stations] [-n files per day] [-a altitude bins]
+                                       [-i instrument types, comma separated] [-d date YYYYMMDD]
+
+"""
+
+import os
+import sys
+import getopt
+import datetime
+import numpy as np
+
+from netCDF4 import Dataset
+
+# days since 1970 as used in the incoming L2 files
+L2_TIME_UNITS = 'days since 1970-01-01 00:00:00.000'
+
+# profiles per 5-minute file and altitude bins of each instrument type
+INSTRUMENT_LAYOUTS = {'CHM15k': dict(n_profiles=20, n_altitude=1024, altitude_step=15.),
+                      'CHM8k': dict(n_profiles=20, n_altitude=512, altitude_step=15.),
+                      'CL51': dict(n_profiles=19, n_altitude=1540, altitude_step=10.),
+                      'CL31': dict(n_profiles=19, n_altitude=770, altitude_step=10.),
+                      'Mini-MPL': dict(n_profiles=10, n_altitude=2000, altitude_step=15.)}
+
+# wigos id, site_location and operator (as in the title) of the stations used for synthetic networks. Networks
+# larger than this get made up stations
+SYNTHETIC_STATIONS = [('0-20000-0-06610', 'Payerne,Switzerland', 'METEOSWISS'),
+                      ('0-20000-0-03808', 'Camborne,United_Kingdom', 'Met-Office'),
+                      ('0-20000-0-10393', 'Lindenberg,Germany', 'DWD'),
+                      ('0-20000-0-06260', 'De_Bilt,Netherlands', 'KNMI'),
+                      ('0-20000-0-07145', 'Trappes,France', 'MeteoFrance'),
+                      ('0-20000-0-03502', 'Aberystwyth,United_Kingdom', 'NCAS'),
+                      ('0-20000-0-02963', 'Jokioinen,Finland', 'FMI'),
+                      ('0-20000-0-08221', 'Madrid,Spain', 'AEMET')]
+
+
+def l2_filename(wigos_id, file_time, date_prefix='A'):
+    '''
+    name of the 5-minute L2 file for an instrument, e.g. L2_0-20000-0-06610_A202110181205.nc
+    '''
+    return f"L2_{wigos_id}_{date_prefix}{file_time:%Y%m%d%H%M}.nc"
+
+
+def write_l2_file(filename, file_time, n_profiles=20, n_altitude=1024, n_layer=3, instrument_type='CHM15k',
+                  instrument_id='A', site_location='Payerne,Switzerland', operator='METEOSWISS', comment='',
+                  seed=None, altitude_step=15.):
+    '''
+    write a single L2 file holding the profiles measured in the 5 minutes from file_time
+
+    Profiles have a boundary layer decaying with height, a cloud layer and noise growing with height, with the
+    quality flag set to 1 from 1000m above cloud base, so that the files compress roughly like real ones.
+
+    :param filename: file to write
+    :param file_time: datetime of the start of the 5 minute period
+    :param n_profiles: number of profiles in the file
+    :param n_altitude: number of altitude bins
+    :param n_layer: number of cloud layers
+    :param altitude_step: altitude bin size in m
+    :return: filename
+    '''
+    rng = np.random.default_rng(seed)
+    epoch = datetime.datetime(1970, 1, 1)
+
+    period_start = (file_time - epoch).total_seconds() / 86400.
+    step = 5. / 60. / 24. / n_profiles
+    times = period_start + step * np.arange(n_profiles)
+
+    with Dataset(filename, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('altitude', n_altitude)
+        ds.createDimension('layer', n_layer)
+
+        var = ds.createVariable('time', 'f8', ('time',))
+        var.units = L2_TIME_UNITS
+        var.long_name = 'End time (UTC) of the measurement'
+        var[:] = times
+
+        var = ds.createVariable('start_time', 'f8', ('time',))
+        var.units = L2_TIME_UNITS
+        var.long_name = 'Start time (UTC) of the measurement'
+        var[:] = times - step
+
+        var = ds.createVariable('altitude', 'f4', ('altitude',))
+        var.units = 'm'
+        var.long_name = 'Altitude of measurement bin above mean sea level'
+        altitude = 500. + altitude_step * np.arange(n_altitude)
+        var[:] = altitude
+
+        for name, units in (('latitude', 'degrees_north'), ('longitude', 'degrees_east'), ('station_altitude', 'm')):
+            var = ds.createVariable(name, 'f4', ())
+            var.units = units
+            var[...] = {'latitude': 46.81, 'longitude': 6.94, 'station_altitude': 491.}[name]
+
+        var = ds.createVariable('attenuated_backscatter_0', 'f4', ('time', 'altitude'), fill_value=np.float32(-999.))
+        var.units = '1e-6*m-1*sr-1'
+        var.long_name = 'Attenuated backscatter coefficient'
+        range_m = altitude - altitude[0]
+        cloud_base = 1500. + 500. * rng.random() + 50. * rng.standard_normal(n_profiles)
+        signal = 2. * np.exp(-range_m / 1200.)[np.newaxis, :] \
+            + 20. * np.exp(-((altitude[np.newaxis, :] - cloud_base[:, np.newaxis]) / 60.) ** 2)
+        noise = (0.01 + (range_m / 5000.) ** 2)[np.newaxis, :]
+        var[:] = (signal + noise * rng.standard_normal((n_profiles, n_altitude))).astype('f4')
+
+        var = ds.createVariable('uncertainties_att_backscatter_0', 'f4', ('time', 'altitude'),
+                                fill_value=np.float32(-999.))
+        var.units = '1e-6*m-1*sr-1'
+        var[:] = (noise * (1. + 0.1 * rng.random((n_profiles, n_altitude)))).astype('f4')
+
+        var = ds.createVariable('quality_flag', 'i8', ('time', 'altitude'))
+        var.long_name = 'Quality flag'
+        var.flag_values = np.array([0, 1, 2], dtype='i8')
+        var.comments = 'flag_values: 0,1,2.  flag_meanings: 0: valid data;  1: do_not_use; 2: no_information'
+        var[:] = (altitude[np.newaxis, :] > cloud_base[:, np.newaxis] + 1000.).astype('i8')
+
+        var = ds.createVariable('cloud_base_height', 'f4', ('time', 'layer'), fill_value=np.float32(-999.))
+        var.units = 'm'
+        cbh = np.full((n_profiles, n_layer), -999., dtype='f4')
+        cbh[:, 0] = cloud_base
+        var[:] = cbh
+
+        var = ds.createVariable('cloud_amount', 'i4', ('time',))
+        var.units = 'octa'
+        var[:] = rng.integers(0, 9, n_profiles)
+
+        ds.title = f'E-PROFILE L2 {operator}'
+        ds.instrument_type = instrument_type
+        ds.instrument_id = instrument_id
+        ds.site_location = site_location
+        ds.history = f'{datetime.datetime.now():%Y%m%dT%H:%M:%S}: created by {os.path.basename(__file__)}'
+        ds.comment = comment
+
+    return filename
+
+
+def write_l2_day(directory, wigos_id, date, n_files=288, first_file=0, **kwargs):
+    '''
+    write a day of 5-minute L2 files for one instrument
+
+    :param directory: directory to write the files to
+    :param wigos_id: wigos id of the instrument
+    :param date: datetime.date of the day
+    :param n_files: number of files, 288 for a full day
+    :param first_file: number of the first 5-minute period of the day to write, for writing a day in parts
+    :param kwargs: passed on to write_l2_file
+    :return: list of files written
+    '''
+    os.makedirs(directory, exist_ok=True)
+    day_start = datetime.datetime(date.year, date.month, date.day)
+
+    files = []
+    for i in range(first_file, first_file + n_files):
+        file_time = day_start + datetime.timedelta(minutes=5 * i)
+        filename = os.path.join(directory, l2_filename(wigos_id, file_time))
+        files.append(write_l2_file(filename, file_time, seed=i, **kwargs))
+
+    return files
+
+
+def synthetic_stations(n_stations, instrument_types=('CHM15k',)):
+    '''
+    stations for a synthetic network, taking instrument types in turn
+
+    :param n_stations: number of stations
+    :param instrument_types: instrument types, from INSTRUMENT_LAYOUTS
+    :return: list of dicts of wigos_id, site_location, operator and instrument_type
+    '''
+    stations = []
+    for i in range(n_stations):
+        if i < len(SYNTHETIC_STATIONS):
+            wigos_id, site_location, operator = SYNTHETIC_STATIONS[i]
+        else:
+            _, site_location, operator = SYNTHETIC_STATIONS[i % len(SYNTHETIC_STATIONS)]
+            wigos_id = f'0-20000-0-{90000 + i}'
+            site_location = f"Synthetic-{i},{site_location.split(',')[1]}"
+        stations.append(dict(wigos_id=wigos_id, site_location=site_location, operator=operator,
+                             instrument_type=instrument_types[i % len(instrument_types)]))
+    return stations
+
+
+def write_l2_network(directory, date, n_stations=8, n_files=288, instrument_types=('CHM15k',), n_altitude=None,
+                     first_file=0, comment=''):
+    '''
+    write a day of 5-minute L2 files for a network of stations into one directory, as they arrive in an arrivals
+    block
+
+    :param directory: directory to write the files to
+    :param date: datetime.date of the day
+    :param n_stations: number of stations
+    :param n_files: number of files per station
+    :param instrument_types: instrument types, from INSTRUMENT_LAYOUTS, taken in turn by the stations
+    :param n_altitude: altitude bins for all instruments, None for those of each instrument type
+    :param first_file: number of the first 5-minute period of the day to write
+    :param comment: comment attribute of the files
+    :return: list of files written
+    '''
+    files = []
+    for station in synthetic_stations(n_stations, instrument_types):
+        layout = dict(INSTRUMENT_LAYOUTS[station['instrument_type']])
+        if n_altitude:
+            layout['n_altitude'] = n_altitude
+        files.extend(write_l2_day(directory, station['wigos_id'], date, n_files=n_files, first_file=first_file,
+                                  instrument_type=station['instrument_type'],
+                                  site_location=station['site_location'], operator=station['operator'],
+                                  comment=comment, **layout))
+    return files
+
+
+def main(arg_list):
+
+    try:
+        opts, args = getopt.getopt(arg_list, "o:s:n:a:i:d:")
+    except getopt.GetoptError as ex:
+        print(__doc__)
+        raise ex
+
+    directory = ''
+    n_stations = 8
+    n_files = 288
+    n_altitude = None
+    instrument_types = ('CHM15k',)
+    date = datetime.date.today() - datetime.timedelta(days=1)
+
+    for opt, argu in opts:
+        if "-o" in opt:
+            directory = argu
+        elif "-s" in opt:
+            n_stations = int(argu)
+        elif "-n" in opt:
+            n_files = int(argu)
+        elif "-a" in opt:
+            n_altitude = int(argu)
+        elif "-i" in opt:
+            instrument_types = argu.split(',')
+        elif "-d" in opt:
+            date = datetime.datetime.strptime(argu, '%Y%m%d').date()
+
+    if not directory:
+        print(__doc__)
+        sys.exit(2)
+
+    files = write_l2_network(directory, date, n_stations=n_stations, n_files=n_files,
+                             instrument_types=instrument_types, n_altitude=n_altitude)
+    print(f'{len(files)} files written to {directory}')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
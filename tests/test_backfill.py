@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+pytest.importorskip('deposit_client')  # CEDA ingest libraries
+
+import eprofile_backfill
+from eprofile_backfill import read_journal, backfill
+
+
+def test_read_journal(tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    assert read_journal(str(journal)) == set()
+
+    entries = [{'dir': 'a', 'status': 'done'}, {'dir': 'b', 'status': 'done'}, {'dir': 'c', 'status': 'failed'},
+               {'dir': 'b', 'status': 'failed'}, {'dir': 'c', 'status': 'done'}]
+    # the last line cut short by the driver being killed while writing it
+    journal.write_text(''.join(json.dumps(entry) + '\n' for entry in entries) + '{"dir": "d", "sta')
+    assert read_journal(str(journal)) == {'a', 'c'}
+
+
+class Killed(BaseException):
+    '''
+    the driver being killed, which unlike an error in a directory isn't caught and journalled
+    '''
+
+
+def test_backfill_resumes(tmp_path, monkeypatch):
+    journal = str(tmp_path / 'journal.jsonl')
+    day_dirs = [f'/archive/switzerland/payerne/{day:02d}' for day in range(1, 7)]
+    processed = []
+    killed_at = [day_dirs[3]]
+
+    def backprocess_dir(day_dir, engine):
+        processed.append(day_dir)
+        if day_dir.endswith('02'):
+            raise RuntimeError('bad day')
+        if day_dir in killed_at:
+            killed_at.clear()
+            raise Killed
+        return day_dir + '.nc'
+    monkeypatch.setattr(eprofile_backfill, 'backprocess_dir', backprocess_dir)
+
+    # killed part way through the fourth directory, which isn't journalled
+    with pytest.raises(Killed):
+        backfill(day_dirs, journal, jobs=1)
+    assert read_journal(journal) == {day_dirs[0], day_dirs[2]}
+
+    processed.clear()
+    assert backfill(day_dirs, journal, jobs=1) == (3, 1)
+    # the failed day is tried again along with those not yet done
+    assert processed == [day_dirs[1], day_dirs[3], day_dirs[4], day_dirs[5]]
+    assert read_journal(journal) == set(day_dirs) - {day_dirs[1]}
+
+    processed.clear()
+    assert backfill(day_dirs, journal, jobs=1) == (0, 1)
+    assert processed == [day_dirs[1]]
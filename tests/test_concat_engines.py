@@ -0,0 +1,248 @@
+import os
+import fcntl
+import shutil
+import datetime
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+import eprofile_concat_engines
+from eprofile_concat_engines import DailyFileLock, PinnedFile
+from eprofile_synthetic_l2 import write_l2_day
+
+WIGOS_ID = '0-20000-0-06610'
+DATE = datetime.date(2021, 10, 18)
+
+
+def test_daily_file_lock_removed_on_release(tmp_path):
+    daily_file = str(tmp_path / 'L2_0-20000-0-06610_A20211018.nc')
+    lock = DailyFileLock(daily_file)
+
+    assert lock.acquire()
+    assert not DailyFileLock(daily_file).acquire()
+    lock.release()
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_daily_file_lock_not_taken_on_removed_lock_file(tmp_path):
+    daily_file = str(tmp_path / 'L2_0-20000-0-06610_A20211018.nc')
+    first = DailyFileLock(daily_file)
+    assert first.acquire()
+
+    # a process that opened the lock file just before the holder removed it and released the lock
+    with open(first.lock_filename, 'a') as stale:
+        first.release()
+        fcntl.flock(stale, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        second = DailyFileLock(daily_file)
+        assert second.acquire()
+        assert os.path.exists(second.lock_filename)
+        assert os.fstat(stale.fileno()).st_nlink == 0
+        second.release()
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_pinned_file_hardlink(tmp_path):
+    daily_file = str(tmp_path / 'L2_0-20000-0-06610_A20211018.nc')
+    _write(daily_file, b'first')
+
+    pinned = PinnedFile(daily_file, str(tmp_path / '.L2_0-20000-0-06610_A20211018.nc'))
+    assert pinned.method == 'hardlink'
+
+    # replaced by a newer version: the pin still reads the one it found
+    _write(daily_file + '.new', b'second version')
+    os.rename(daily_file + '.new', daily_file)
+    assert not pinned.changed()
+    with open(pinned.path, 'rb') as f:
+        assert f.read() == b'first'
+
+    # modified in place through the shared inode
+    with open(pinned.path, 'ab') as f:
+        f.write(b' and more')
+    assert pinned.changed()
+
+    pinned.release()
+    assert os.listdir(tmp_path) == ['L2_0-20000-0-06610_A20211018.nc']
+
+
+def test_pinned_file_in_place(tmp_path, monkeypatch):
+    daily_file = str(tmp_path / 'L2_0-20000-0-06610_A20211018.nc')
+    _write(daily_file, b'first')
+
+    def refuse(*args):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', refuse)
+    monkeypatch.setattr(eprofile_concat_engines, '_reflink', refuse)
+
+    pinned = PinnedFile(daily_file, str(tmp_path / '.L2_0-20000-0-06610_A20211018.nc'))
+    assert (pinned.method, pinned.path) == ('in place', daily_file)
+    assert not pinned.changed()
+
+    _write(daily_file + '.new', b'second version')
+    os.rename(daily_file + '.new', daily_file)
+    assert pinned.changed()
+
+    pinned.release()
+    assert os.path.exists(daily_file)
+
+
+def test_append_failure_leaves_daily_file_as_it_was(tmp_path, monkeypatch):
+    files = write_l2_day(str(tmp_path), WIGOS_ID, DATE, n_files=4, n_profiles=5, n_altitude=16)
+    daily_file = str(tmp_path / f'L2_{WIGOS_ID}_A{DATE:%Y%m%d}.nc')
+    eprofile_concat_engines.concat_netcdf4(files[:2], daily_file, 'test', time_as_limited_dim=False)
+    with open(daily_file, 'rb') as f:
+        before = f.read()
+
+    def dies(*args):
+        raise RuntimeError('killed')
+    monkeypatch.setattr(eprofile_concat_engines, 'update_comment', dies)
+    with pytest.raises(RuntimeError):
+        eprofile_concat_engines.append_to_daily_file(daily_file, files[2:], 'test')
+    with open(daily_file, 'rb') as f:
+        assert f.read() == before
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(fn) for fn in files + [daily_file])
+
+    monkeypatch.undo()
+    assert eprofile_concat_engines.append_to_daily_file(daily_file, files[2:], 'test')
+    with Dataset(daily_file) as daily:
+        assert len(daily.dimensions['time']) == 20
+
+
+def expand(plan):
+    '''
+    (file, time step) written to each output time step by a plan
+    '''
+    n_time, segments = plan
+    out = [None] * n_time
+    for i, src_start, src_stop, out_start in segments:
+        out[out_start:out_start + src_stop - src_start] = [(i, j) for j in range(src_start, src_stop)]
+    return out
+
+
+def test_slot_plan_used_on_grid_data(tmp_path, monkeypatch):
+    files = write_l2_day(str(tmp_path), WIGOS_ID, DATE, n_files=4, n_profiles=20, n_altitude=16)
+    # the last file sent again, as the newest copy of those time steps
+    files.append(str(tmp_path / 'resent.nc'))
+    shutil.copyfile(files[-2], files[-1])
+
+    plans = []
+    plan_slots = eprofile_concat_engines.slot_plan
+
+    def slot_plan(keys_per_file, slot_seconds):
+        plans.append((eprofile_concat_engines.merge_plan(keys_per_file), plan_slots(keys_per_file, slot_seconds)))
+        return plans[-1][1]
+    monkeypatch.setattr(eprofile_concat_engines, 'slot_plan', slot_plan)
+
+    slotted, sorted_file = str(tmp_path / 'slotted.nc'), str(tmp_path / 'sorted.nc')
+    eprofile_concat_engines.concat_netcdf4(files, slotted, 'test', slot_seconds=15)
+    eprofile_concat_engines.concat_netcdf4(files, sorted_file, 'test')
+
+    [(merged, slots)] = plans
+    assert slots is not None
+    assert expand(slots) == expand(merged)
+    assert len(expand(slots)) == 80
+    with Dataset(slotted) as slotted, Dataset(sorted_file) as sorted_file:
+        for name, var in slotted.variables.items():
+            np.testing.assert_array_equal(var[...], sorted_file.variables[name][...])
+
+
+def test_slot_plan_off_grid_falls_back_with_warning(caplog):
+    keys = [np.array([0, 15000, 30000]), np.array([45000, 61000])]
+    with caplog.at_level('WARNING'):
+        assert eprofile_concat_engines.slot_plan(keys, 15) is None
+    assert 'off the 15 second grid' in caplog.text
+    assert eprofile_concat_engines.slot_plan(keys, 7.3) is None
+    assert expand(eprofile_concat_engines.slot_plan(keys, 0.5)) == expand(eprofile_concat_engines.merge_plan(keys))
+
+
+def test_integer_times_kept_as_float_days(tmp_path):
+    files = []
+    for n, start in enumerate((1634515200, 1634515500)):
+        fn = str(tmp_path / f'L2_{WIGOS_ID}_A20211018000{5 * n}.nc')
+        with Dataset(fn, 'w') as ds:
+            ds.createDimension('time', None)
+            for name, offset in (('time', 15), ('start_time', 0)):
+                var = ds.createVariable(name, 'i4', ('time',))
+                var.units = 'seconds since 1970-01-01 00:00:00'
+                var[:] = start + offset + 15 * np.arange(20)
+            ds.createVariable('cloud_amount', 'i4', ('time',))[:] = np.arange(20)
+        files.append(fn)
+
+    daily_file = str(tmp_path / f'L2_{WIGOS_ID}_A20211018.nc')
+    eprofile_concat_engines.concat_netcdf4(files, daily_file, 'test')
+    with Dataset(daily_file) as daily:
+        assert daily.variables['time'].dtype == np.float64
+        assert daily.variables['start_time'].dtype == np.float64
+        np.testing.assert_allclose(daily.variables['time'][:] * 86400, 1634515215 + 15 * np.arange(40))
+
+
+def last_of_each_time(keys):
+    '''
+    index of the last time step holding each time, in time order: what merge_runs should pick
+    '''
+    keys = np.asarray(keys)
+    unique, reversed_idx = np.unique(keys[::-1], return_index=True)
+    return list(len(keys) - 1 - reversed_idx)
+
+
+def taken(ranges):
+    return [i for start, stop in ranges for i in range(start, stop)]
+
+
+@pytest.mark.parametrize('keys', [
+    [],
+    [5],
+    [1, 2, 3, 4],
+    [1, 2, 3, 2, 3, 4],                 # a resent file overlapping the end of the last
+    [10, 20, 30, 0, 15, 30, 40],
+    [3, 3, 3],
+    [4, 3, 2, 1],
+    [1, 5, 9, 2, 6, 10, 3, 7, 11],      # interleaved runs
+])
+def test_merge_runs(keys):
+    ranges = eprofile_concat_engines.merge_runs(keys)
+    assert taken(ranges) == last_of_each_time(keys)
+    assert all(stop > start for start, stop in ranges)
+
+
+def test_merge_runs_random():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        runs = [np.sort(rng.choice(50, size=rng.integers(1, 15), replace=False)) for _ in range(rng.integers(1, 6))]
+        keys = np.concatenate(runs)
+        assert taken(eprofile_concat_engines.merge_runs(keys)) == last_of_each_time(keys)
+
+
+def test_merge_runs_takes_leading_run_in_one_go():
+    # the existing day, then new files after it: nothing overlaps so it is all copied in one go
+    assert eprofile_concat_engines.merge_runs([0, 1, 2, 3, 10, 11, 12, 20, 21]) == [(0, 9)]
+    # only where the runs overlap is it taken a time step at a time
+    assert eprofile_concat_engines.merge_runs([0, 1, 2, 3, 2, 3, 4, 5]) == [(0, 2), (4, 5), (5, 6), (6, 8)]
+
+
+def test_merge_plan_splits_runs_at_file_ends():
+    keys_per_file = [np.array([0, 15, 30]), np.array([45, 60]), np.array([30, 45, 75])]
+    n_time, segments = eprofile_concat_engines.merge_plan(keys_per_file)
+    assert n_time == 6
+    assert expand((n_time, segments)) == [(0, 0), (0, 1), (2, 0), (2, 1), (1, 1), (2, 2)]
+    # segments come in output order, each within one file
+    assert [out_start for _, _, _, out_start in segments] == sorted(out_start for _, _, _, out_start in segments)
+    assert all(src_stop <= len(keys_per_file[i]) for i, _, src_stop, _ in segments)
+
+
+def test_slot_plan():
+    day = 18918 * 86400000
+    keys_per_file = [day + 15000 * np.arange(0, 20), day + 15000 * np.arange(20, 40), day + 15000 * np.arange(10, 30)]
+    plan = eprofile_concat_engines.slot_plan(keys_per_file, 15)
+    assert plan == (40, [(0, 0, 10, 0), (2, 0, 20, 10), (1, 10, 20, 30)])
+    assert expand(plan) == expand(eprofile_concat_engines.merge_plan(keys_per_file))
+
+    assert eprofile_concat_engines.slot_plan([], 15) is None
+    # past the end of the day of the first time step
+    assert eprofile_concat_engines.slot_plan([day + np.array([0, 86400000])], 15) is None
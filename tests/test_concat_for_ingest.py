@@ -0,0 +1,139 @@
+import os
+import datetime
+
+import pytest
+from netCDF4 import Dataset
+
+pytest.importorskip('deposit_client')  # CEDA ingest libraries
+
+import eprofile_concat_engines
+import eprofile_concat_for_ingest as concat
+import eprofile_shrink_comments
+from eprofile_synthetic_l2 import write_l2_day
+
+WIGOS_ID = '0-20000-0-06610'
+DATE = datetime.date(2021, 10, 18)
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    '''
+    arrivals, quarantine and readyToIngest areas with no archive behind them
+    '''
+    monkeypatch.setattr(concat, 'find_archived_single_files', lambda sample_file: [])
+    monkeypatch.setattr(concat, 'find_archived_daily_file', lambda daily_file, inc_file: '')
+    monkeypatch.setattr(concat, 'refresh_station_cache', lambda harvest, source_files: None)
+
+    for area in ('arrivals', 'quarantine/block-06', 'readyToIngest/block-06'):
+        os.makedirs(tmp_path / area)
+    return tmp_path
+
+
+@pytest.mark.parametrize('engine', ['xarray', 'netcdf4'])
+def test_existing_daily_file_read_in_place_is_kept(pipeline, monkeypatch, engine):
+    files = write_l2_day(str(pipeline / 'arrivals'), WIGOS_ID, DATE, n_files=6, n_profiles=5, n_altitude=16)
+    filename_out = str(pipeline / f'quarantine/block-06/L2_{WIGOS_ID}_A{DATE:%Y%m%d}.nc')
+    ready_file = filename_out.replace('quarantine', 'readyToIngest')
+
+    concat.concat_single_inst(files[:3], filename_out, engine=engine)
+    os.rename(filename_out, ready_file)
+
+    # neither a hard link nor a reflink can be made, as from the archive on another filesystem
+    def refuse(*args):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', refuse)
+    monkeypatch.setattr(eprofile_concat_engines, '_reflink', refuse)
+
+    concat.concat_single_inst(files[3:], filename_out, delete_after_concat=True, deleterchoice='notArrivals',
+                              engine=engine)
+
+    assert os.path.exists(ready_file)
+    with Dataset(ready_file) as dataset:
+        assert len(dataset.dimensions['time']) == 15
+    with Dataset(filename_out) as dataset:
+        assert len(dataset.dimensions['time']) == 30
+    assert [os.path.exists(fn) for fn in files] == [True] * 3 + [False] * 3
+    assert sorted(os.listdir(os.path.dirname(filename_out))) == [os.path.basename(filename_out)]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_parallel_concat_leaves_no_lock_files(pipeline, jobs):
+    concat_tasks = {}
+    for wigos_id in ('0-20000-0-06610', '0-20000-0-06620', '0-20000-0-06630'):
+        files = write_l2_day(str(pipeline / 'arrivals'), wigos_id, DATE, n_files=3, n_profiles=5, n_altitude=16)
+        concat_tasks[str(pipeline / f'quarantine/block-06/L2_{wigos_id}_A{DATE:%Y%m%d}.nc')] = files
+
+    finished = concat.run_parallel_concat(concat_tasks, {}, jobs)
+
+    assert sorted(finished['done']) == sorted(concat_tasks)
+    assert sorted(os.listdir(pipeline / 'quarantine/block-06')) == sorted(map(os.path.basename, concat_tasks))
+
+
+def test_locked_daily_file_is_skipped(pipeline):
+    files = write_l2_day(str(pipeline / 'arrivals'), WIGOS_ID, DATE, n_files=3, n_profiles=5, n_altitude=16)
+    filename_out = str(pipeline / f'quarantine/block-06/L2_{WIGOS_ID}_A{DATE:%Y%m%d}.nc')
+
+    lock = eprofile_concat_engines.DailyFileLock(filename_out)
+    assert lock.acquire()
+    try:
+        assert concat.run_parallel_concat({filename_out: files}, {}, 1)['locked'] == [filename_out]
+    finally:
+        lock.release()
+    assert not os.path.exists(filename_out)
+
+    assert concat.run_parallel_concat({filename_out: files}, {}, 1)['done'] == [filename_out]
+
+
+def test_archive_walk(tmp_path):
+    instruments = {'switzerland/payerne/meteoswiss-lufft-chm15k_A': '0-20000-0-06610',
+                   'united-kingdom/camborne/met-office-vaisala-cl31_A': '0-20000-0-03808'}
+    for instrument, wigos_id in instruments.items():
+        for day in (17, 18, 19):
+            path_day = tmp_path / instrument / f'2021/10/{day}'
+            path_day.mkdir(parents=True)
+            for hhmm in ('0000', '0005'):
+                (path_day / f'L2_{wigos_id}_A202110{day}{hhmm}.nc').touch()
+    (tmp_path / 'daily_files/switzerland/payerne/meteoswiss-lufft-chm15k_A/2021/10/18').mkdir(parents=True)
+
+    start, end = datetime.date(2021, 10, 18), datetime.date(2021, 10, 19)
+    instdays = concat.find_alc_instdays(start, end, str(tmp_path), jobs=2)
+    assert sorted(filename_out for _, filename_out in instdays) == sorted(
+        f'{tmp_path}/{instrument}/2021/10/L2_{wigos_id}_A202110{day}.nc'
+        for instrument, wigos_id in instruments.items() for day in (18, 19))
+    assert all(len(files) == 2 for files, _ in instdays)
+
+    assert concat.find_alc_day_dirs(start, end, str(tmp_path), jobs=2, instruments=['switzerland/*/*']) == [
+        f'{tmp_path}/switzerland/payerne/meteoswiss-lufft-chm15k_A/2021/10/18',
+        f'{tmp_path}/switzerland/payerne/meteoswiss-lufft-chm15k_A/2021/10/19']
+    assert len(concat.find_alc_day_dirs(start, end, str(tmp_path))) == 4
+
+
+def test_shrink_during_concat_is_detected(pipeline, monkeypatch):
+    files = write_l2_day(str(pipeline / 'arrivals'), WIGOS_ID, DATE, n_files=6, n_profiles=5, n_altitude=16)
+    filename_out = str(pipeline / f'quarantine/block-06/L2_{WIGOS_ID}_A{DATE:%Y%m%d}.nc')
+    ready_file = filename_out.replace('quarantine', 'readyToIngest')
+
+    concat.concat_single_inst(files[:3], filename_out, engine='netcdf4')
+    os.rename(filename_out, ready_file)
+    # a comment in the layout from before format_comment, that eprofile_shrink_comments rewrites
+    legacy = '|'.join(f'{os.path.basename(fn)}: window cleaned' for fn in files[:3])
+    with Dataset(ready_file, 'a') as dataset:
+        dataset.comment = ' \n'.join([legacy] * 20)
+
+    concat_netcdf4 = concat.concat_netcdf4
+
+    def shrink_meanwhile(*args, **kwargs):
+        concat_netcdf4(*args, **kwargs)
+        sizes = eprofile_shrink_comments.shrink_comment(ready_file)
+        assert sizes[1] < sizes[0]
+    monkeypatch.setattr(concat, 'concat_netcdf4', shrink_meanwhile)
+
+    with pytest.raises(RuntimeError, match='changed while it was being read'):
+        concat.concat_single_inst(files[3:], filename_out, engine='netcdf4')
+    assert os.listdir(os.path.dirname(filename_out)) == []
+
+    monkeypatch.setattr(concat, 'concat_netcdf4', concat_netcdf4)
+    concat.concat_single_inst(files[3:], filename_out, engine='netcdf4')
+    with Dataset(filename_out) as dataset:
+        assert len(dataset.dimensions['time']) == 30
+        assert dataset.comment.count('window cleaned') == 1
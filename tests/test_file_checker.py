@@ -0,0 +1,101 @@
+import os
+import sys
+import types
+import shutil
+import sqlite3
+import datetime
+import importlib
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+
+@pytest.fixture
+def checker(tmp_path, monkeypatch):
+    '''
+    the file checker reading a throwaway SQLite database, which the state changes of the run are made in
+    '''
+    db_file = tmp_path / 'eprofile.sqlite'
+    due = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    with sqlite3.connect(db_file) as db:
+        db.execute('CREATE TABLE file_table (id INTEGER PRIMARY KEY, name TEXT, process_state TEXT)')
+        db.execute('CREATE TABLE other_table (log_id INTEGER PRIMARY KEY, times_ran INTEGER, when_ran_next DATETIME)')
+        for id, name, state, times_ran, when_ran_next in [
+                (1, 'L2_0-20000-0-06610_A20211018.nc', 'aggregated', 0, due),
+                (2, 'L2_0-20000-0-03808_A20211018.nc', 'aggregated', 4, due),
+                (3, 'L2_0-20000-0-10393_A20211018.nc', 'aggregated', 5, due),     # tried too many times
+                (4, 'L2_0-20000-0-06260_A20211018.nc', 'aggregated', 0, later),   # not due yet
+                (5, 'L2_0-20000-0-07145_A20211018.nc', 'delivered', 0, due)]:
+            db.execute('INSERT INTO file_table VALUES (?, ?, ?)', (id, name, state))
+            db.execute('INSERT INTO other_table VALUES (?, ?, ?)', (id, times_ran, when_ran_next.isoformat(' ')))
+
+    master_control = tmp_path / 'Master_control.txt'
+    master_control.write_text('file_checker:on\n')
+
+    # only connect is used, and only without EPROFILE_DB_URL
+    monkeypatch.setitem(sys.modules, 'eprofile_database_functions', types.ModuleType('eprofile_database_functions'))
+
+    monkeypatch.setenv('EPROFILE_MASTER_CONTROL', str(master_control))
+    monkeypatch.setenv('EPROFILE_DB_URL', f'sqlite:///{db_file}')
+    monkeypatch.setenv('EPROFILE_FILE_TABLE', 'file_table')
+    monkeypatch.delitem(sys.modules, 'eprofile_file_checker', raising=False)
+    module = importlib.import_module('eprofile_file_checker')
+    module.db_file = db_file
+    yield module
+    module.conn.close()
+    sys.modules.pop('eprofile_file_checker', None)
+
+
+def test_eligible_files(checker):
+    assert sorted(checker.eligible_files(checker.conn)) == [(1, 'L2_0-20000-0-06610_A20211018.nc'),
+                                                            (2, 'L2_0-20000-0-03808_A20211018.nc')]
+
+
+def test_transitions_in_one_batch(checker):
+    assert checker.apply_transitions([1, 2, 5], [4], [3]) == (2, 1, 1)
+    with sqlite3.connect(checker.db_file) as db:
+        states = dict(db.execute('SELECT id, process_state FROM file_table'))
+        runs = dict(db.execute('SELECT log_id, times_ran FROM other_table'))
+    assert states == {1: 'delivered', 2: 'delivered', 3: 'failed', 4: 'aggregated', 5: 'delivered'}
+    assert runs == {1: 0, 2: 4, 3: 5, 4: 1, 5: 0}
+    assert checker.eligible_files(checker.conn) == []
+
+
+@pytest.fixture
+def ready_to_ingest(checker, tmp_path, monkeypatch):
+    names = ['L2_0-20000-0-06610_A20211018.nc', 'L2_0-20000-0-06610_A20211019.nc', 'L2_0-20000-0-06610_A20211020.nc']
+    source = tmp_path / 'readyToIngest'
+    source.mkdir()
+    for name in names:
+        (source / name).write_bytes(b'CDF\x01')
+    monkeypatch.setattr(checker, 'READY_TO_INGEST', f'{source}/')
+    return source, names
+
+
+@pytest.mark.skipif(not shutil.which('rsync'), reason='needs rsync')
+def test_rsync_block_to_local_directory(checker, ready_to_ingest, tmp_path):
+    source, names = ready_to_ingest
+    dest = tmp_path / 'block-06'
+    dest.mkdir()
+    missing = 'L2_0-20000-0-06610_A20211021.nc'
+
+    # the missing file makes rsync exit with 23 after sending the others
+    assert checker.rsync_block(names + [missing], f'{dest}/') == set(names)
+    assert sorted(os.listdir(dest)) == names
+    assert os.listdir(source) == []
+
+
+def test_rsync_block_cut_short(checker, ready_to_ingest, tmp_path, monkeypatch):
+    source, names = ready_to_ingest
+    # an rsync that sends the first file, itemizes the second without removing it and then loses the connection
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    rsync = bin_dir / 'rsync'
+    rsync.write_text(f'#!/bin/sh\nrm {source}/{names[0]}\necho ">f+++++++++ {names[0]}"\n'
+                     f'echo ">f+++++++++ {names[1]}"\necho "rsync error: timeout" >&2\nexit 12\n')
+    rsync.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    assert checker.rsync_block(names, f'{tmp_path}/block-06/') == {names[0]}
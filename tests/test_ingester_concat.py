@@ -0,0 +1,43 @@
+import os
+import datetime
+
+import pytest
+
+pytest.importorskip('deposit_client')  # CEDA ingest libraries
+
+import eprofile_ingester_concat as ingester
+from eprofile_archive_catalogue import ARCHIVE_CATALOGUE
+from eprofile_concat_engines import concat_netcdf4
+from eprofile_synthetic_l2 import write_l2_day
+
+WIGOS_ID = '0-20000-0-06610'
+DATE = datetime.date(2021, 10, 18)
+STATION = {'operator': 'meteoswiss', 'instrument_type': 'lufft-chm15k', 'country': 'switzerland',
+           'location': 'payerne', 'inst_id': 'A'}
+
+
+class Options(dict):
+    def options(self):
+        return list(self)
+
+
+def test_smaller_daily_file_not_deposited_over_archived_one(tmp_path, monkeypatch):
+    files = write_l2_day(str(tmp_path / 'arrivals'), WIGOS_ID, DATE, n_files=6, n_profiles=5, n_altitude=16)
+    daily_name = f'L2_{WIGOS_ID}_A{DATE:%Y%m%d}.nc'
+    archived = tmp_path / f'archive/daily_files/switzerland/payerne/meteoswiss-lufft-chm15k_A/{DATE:%Y}/{daily_name}'
+    archived.parent.mkdir(parents=True)
+    concat_netcdf4(files, str(archived), 'test')
+    os.makedirs(tmp_path / 'readyToIngest')
+    daily_file = str(tmp_path / 'readyToIngest' / daily_name)
+    concat_netcdf4(files[:3], daily_file, 'test')
+
+    monkeypatch.setattr(ingester, 'ARCHIVE_BASE_PATH', str(tmp_path / 'archive'))
+    monkeypatch.setattr(ingester.STATION_CACHE, 'lookup', lambda inc_file: dict(STATION))
+    # a catalogue that hasn't caught up with the archived daily file
+    monkeypatch.setattr(ARCHIVE_CATALOGUE, 'cache_file', str(tmp_path / 'catalogue.sqlite'))
+    ARCHIVE_CATALOGUE.rebuild(str(tmp_path / 'empty'))
+
+    file_processed = ingester.moveToIngest(daily_file, Options(deleterchoice='keep'), deposit_now=False)
+
+    assert file_processed.dest_path == str(archived)
+    assert not file_processed.needs_deposit()
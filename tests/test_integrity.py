@@ -0,0 +1,94 @@
+import struct
+import datetime
+
+import pytest
+
+from eprofile_integrity import lookup3, _check_hdf5_superblock, check_structure, HDF5_SIGNATURE
+from eprofile_synthetic_l2 import write_l2_file, l2_filename
+
+
+def test_lookup3():
+    # test vectors from lookup3.c
+    assert lookup3(b'') == 0xdeadbeef
+    assert lookup3(b'', 0xdeadbeef) == 0xbd5b7dde
+    assert lookup3(b'Four score and seven years ago') == 0x17770551
+    assert lookup3(b'Four score and seven years ago', 1) == 0xcd628161
+
+
+def superblock(version, eof_address, base_address=0, flags=0, size_of_offsets=8):
+    address_format = '<' + ('I' if size_of_offsets == 4 else 'Q') * 4
+    undefined = 0xffffffff if size_of_offsets == 4 else 0xffffffffffffffff
+    if version in (0, 1):
+        # versions, sizes of offsets and lengths, group node K values and flags, then for version 1 the indexed
+        # storage K value
+        fields = bytes([version, 0, 0, 0, 0, size_of_offsets, 8, 0]) + struct.pack('<HHI', 4, 16, 0)
+        if version == 1:
+            fields += struct.pack('<HH', 32, 0)
+        return HDF5_SIGNATURE + fields + struct.pack(address_format, base_address, undefined, eof_address, undefined)
+    header = HDF5_SIGNATURE + bytes([version, size_of_offsets, 8, flags]) + \
+        struct.pack(address_format, base_address, undefined, eof_address, 48)
+    return header + struct.pack('<I', lookup3(header))
+
+
+@pytest.mark.parametrize('version', [0, 1, 2, 3])
+def test_superblock_versions(version):
+    header = superblock(version, 4000)
+    assert _check_hdf5_superblock(header, 4000) == ''
+    assert _check_hdf5_superblock(header, 3999) == 'truncated: 3999 bytes of 4000'
+    assert _check_hdf5_superblock(superblock(version, 4000, base_address=512), 4512) == ''
+    assert _check_hdf5_superblock(superblock(version, 4000, size_of_offsets=4), 4000) == ''
+    assert _check_hdf5_superblock(superblock(version, 0xffffffffffffffff), 4000) == 'HDF5 end of file address not set'
+    assert _check_hdf5_superblock(header[:-6], 4000) == 'truncated HDF5 superblock'
+
+
+@pytest.mark.parametrize('version', [2, 3])
+def test_superblock_checksum(version):
+    header = bytearray(superblock(version, 4000))
+    header[30] ^= 0x01
+    assert _check_hdf5_superblock(bytes(header), 4000) == 'HDF5 superblock checksum mismatch'
+
+
+def test_superblock_flags():
+    assert _check_hdf5_superblock(superblock(3, 4000, flags=0x1), 4000) == 'HDF5 file was not closed by its writer'
+    # version 2 has no file consistency flags to check
+    assert _check_hdf5_superblock(superblock(2, 4000, flags=0x1), 4000) == ''
+
+
+def test_unknown_superblock():
+    assert _check_hdf5_superblock(HDF5_SIGNATURE + bytes([4]) + bytes(60), 4000) == 'unknown HDF5 superblock version 4'
+    assert _check_hdf5_superblock(superblock(2, 4000, size_of_offsets=2), 4000) == 'bad HDF5 size of offsets 2'
+
+
+@pytest.fixture
+def l2_file(tmp_path):
+    file_time = datetime.datetime(2021, 10, 18)
+    return write_l2_file(str(tmp_path / l2_filename('0-20000-0-06610', file_time)), file_time, n_altitude=16)
+
+
+def test_check_structure(l2_file):
+    assert check_structure(l2_file) == ''
+
+
+def test_check_structure_truncated(l2_file):
+    with open(l2_file, 'r+b') as nc_file:
+        nc_file.truncate(nc_file.seek(0, 2) // 2)
+    assert check_structure(l2_file).startswith('truncated')
+
+
+def test_check_structure_after_user_block(tmp_path, l2_file):
+    # a superblock after a user block has addresses relative to its own position
+    shifted = tmp_path / 'shifted.nc'
+    with open(l2_file, 'rb') as nc_file:
+        data = nc_file.read()
+    header = superblock(2, len(data), base_address=512)
+    shifted.write_bytes(bytes(512) + header + bytes(len(data) - len(header)))
+    assert check_structure(str(shifted)) == ''
+
+
+def test_check_structure_not_netcdf(tmp_path):
+    path = tmp_path / 'empty.nc'
+    path.write_bytes(b'')
+    assert check_structure(str(path)) == 'not a netCDF file'
+    path.write_bytes(b'CDF\x01' + b'\xff' * 4 + bytes(24))
+    assert check_structure(str(path)) == 'netCDF classic record count not written'
+    assert check_structure(str(tmp_path / 'missing.nc')).startswith('unreadable')
@@ -0,0 +1,63 @@
+from eprofile_provenance import (parse_comment, format_comment, update_comment, _format_times, _parse_times,
+                                 COMMENT_HEADER_START, COMMENT_TEXT_MAX_CHARS)
+
+PREFIX = 'L2_0-20000-0-06610_A20211018'
+
+
+def names(*times):
+    return [f'{PREFIX}{time_of_day}.nc' for time_of_day in times]
+
+
+def test_format_and_parse_times():
+    files = names('0000', '0005', '0010', '0020', '2350', '2355') + ['L2_0-20000-0-06620_A202110180000.nc']
+    tokens = _format_times(files, PREFIX)
+    assert tokens == '0000-0010,0020,2350-2355,L2_0-20000-0-06620_A202110180000.nc'
+    assert sorted(_parse_times(tokens, PREFIX)) == sorted(files)
+
+
+def test_round_trip():
+    source_comments = {name: 'window cleaned' for name in names('0000', '0005', '0010')}
+    source_comments.update({name: 'blower fault' for name in names('0015', '0025')})
+    comment = format_comment('daily comment', source_comments)
+    assert comment.splitlines() == ['daily comment', f'{COMMENT_HEADER_START}{PREFIX}HHMM.nc:',
+                                    '0000-0010: window cleaned', '0015,0025: blower fault']
+    assert parse_comment(comment) == ('daily comment', source_comments)
+
+
+def test_own_comment_left_out_when_a_source_comment():
+    source_comments = {name: 'window cleaned' for name in names('0000', '0005')}
+    assert format_comment('window  cleaned', source_comments).splitlines()[0].startswith(COMMENT_HEADER_START)
+
+
+def test_legacy_layout():
+    # as the concat scripts used to build it, the daily file's comment copied onto itself on each run and the
+    # source file comments added after
+    file_comments = 'daily comment'
+    for times in (('0000',), ('0005',)):
+        file_comments += ' \n'
+        file_comments += f"{file_comments} {'|'.join(f'{name}: window cleaned' for name in names(*times))}"
+    own_comment, source_comments = parse_comment(file_comments)
+    assert own_comment == 'daily comment'
+    assert source_comments == {name: 'window cleaned' for name in names('0000', '0005')}
+
+    comment = update_comment(file_comments, [(names('0010')[0], 'window cleaned')])
+    assert comment.splitlines()[-1] == '0000-0010: window cleaned'
+    assert len(comment) < len(file_comments)
+
+
+def test_cap_and_note():
+    source_comments = {name: f'comment {n} ' + 'x' * 100 for n, name in enumerate(names(
+        *[f'{minutes // 60:02d}{minutes % 60:02d}' for minutes in range(0, 1440, 5)]))}
+    comment = format_comment('', source_comments, max_chars=1000)
+    assert len(comment) <= 1000
+    lines = comment.splitlines()
+    kept = len(lines) - 2
+    assert lines[-1] == f'(and {288 - kept} more comments, from {288 - kept} files)'
+
+    _, parsed = parse_comment(comment)
+    assert len(parsed) == kept
+
+
+def test_long_comment_text_cut():
+    comment = format_comment('', {names('0000')[0]: 'y' * 2000})
+    assert comment.splitlines()[-1] == '0000: ' + 'y' * COMMENT_TEXT_MAX_CHARS
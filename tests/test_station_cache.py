@@ -0,0 +1,25 @@
+import datetime
+
+from eprofile_station_cache import StationCache, read_header
+from eprofile_synthetic_l2 import write_l2_file, l2_filename
+
+
+def resolve(header):
+    return {'location': header['site_location'].split(',')[0].lower(), 'inst_id': header['instrument_id']}
+
+
+def test_changed_header_is_picked_up_within_max_age(tmp_path):
+    file_time = datetime.datetime(2021, 10, 18, 12)
+    inc_file = write_l2_file(str(tmp_path / l2_filename('0-20000-0-06610', file_time)), file_time, n_profiles=2,
+                             n_altitude=8)
+    cache = StationCache(resolve, cache_file=str(tmp_path / 'stations.sqlite'))
+
+    assert cache.lookup(inc_file) == {'location': 'payerne', 'inst_id': 'A'}
+
+    header = read_header(inc_file)
+    assert cache.lookup(inc_file, header=header) == {'location': 'payerne', 'inst_id': 'A'}
+
+    # the instrument has moved: the header read during a concatenation updates the entry straight away
+    header['site_location'] = 'Granges-pres-Marnand,Switzerland'
+    assert cache.lookup(inc_file, header=header) == {'location': 'granges-pres-marnand', 'inst_id': 'A'}
+    assert cache.lookup(inc_file) == {'location': 'granges-pres-marnand', 'inst_id': 'A'}